@@ -11,16 +11,19 @@ bl_info = {
     "category" : "Render"
 }
 
-import bpy
-from .src.worker.worker import Worker
+import bpy, bpy.utils.previews
+from .src.worker.worker import Worker, parse_supervisor_weights
 from .src.supervisor.supervisor import Supervisor, WorkerView
-from .src.blender.blender import create_render_job
+from .src.worker.render_slot import create_render_slots
+from .src.blender.blender import create_render_job, create_render_settings, collect_dependencies
+from .src.supervisor.scheduling import create_policy
 
 class ARMBController:
     def __init__(self):
         self.node_type = None # SUPERVISOR, WORKER
         self.worker = None
         self.supervisor = None
+        self.preview_icons = None # frame previews loaded for the panel
 
     def started(self):
         return self.node_type is not None
@@ -31,10 +34,12 @@ class ARMBController:
     def is_supervisor(self):
         return self.node_type == 'SUPERVISOR'
 
-    def worker_start(self, output_dir, port):
-        self.worker = Worker(bpy.path.abspath(output_dir), port, timeout=5)
+    def worker_start(self, output_dir, port, slot_count=1, local_slot=True, devices=None, threads=None, storage_quota=None, announce=True, max_supervisors=4, supervisor_weights=None):
+        slots = create_render_slots(slot_count, create_render_settings(), local_slot, devices, threads)
+        self.worker = Worker(bpy.path.abspath(output_dir), port, timeout=5, slots=slots, storage_quota=storage_quota, announce=announce, max_supervisors=max_supervisors, supervisor_weights=supervisor_weights)
         self.worker.start()
         self.node_type = 'WORKER'
+        self.update_metrics_export(bpy.context.window_manager.armb.metrics_path, bpy.context.window_manager.armb.metrics_format)
 
     def worker_stop(self):
         self.worker.stop()
@@ -45,11 +50,33 @@ class ARMBController:
         self.node_type = 'SUPERVISOR'
         bpy.context.window_manager.armb.worker_list.clear()
         bpy.context.window_manager.armb.worker_index = 0
+        self.supervisor_update_discovery(bpy.context.window_manager.armb.discover_workers)
+        self.supervisor_update_upload_limits(bpy.context.window_manager.armb)
+        self.update_metrics_export(bpy.context.window_manager.armb.metrics_path, bpy.context.window_manager.armb.metrics_format)
 
     def supervisor_stop(self):
-        self.supervisor.remove_all_workers()
+        self.supervisor.stop()
+        self.free_previews()
         self.node_type = None
 
+    def supervisor_preview_icon(self, frame):
+        previews = self.supervisor.previews
+        key = previews.key(frame)
+
+        if self.preview_icons is None:
+            self.preview_icons = bpy.utils.previews.new()
+        if key not in self.preview_icons:
+            path = previews.path(frame)
+            if not path:
+                return 0
+            self.preview_icons.load(key, path, 'IMAGE')
+        return self.preview_icons[key].icon_id
+
+    def free_previews(self):
+        if self.preview_icons is not None:
+            bpy.utils.previews.remove(self.preview_icons)
+            self.preview_icons = None
+
     def supervisor_add_worker(self, host, port):
         self.supervisor.add_worker(host, port)
 
@@ -66,11 +93,59 @@ class ARMBController:
         self.supervisor.clean_workers()
 
     def supervisor_start_render(self):
-        self.supervisor.start_job(create_render_job(display_mode=bpy.context.window_manager.armb.render_display_mode))
+        settings = bpy.context.window_manager.armb
+        profile = settings.render_profile if settings.render_profile != 'SCENE' else None
+        job = create_render_job(display_mode=settings.render_display_mode, profile=profile)
+        if settings.shared_output and settings.shared_output_dir:
+            job.settings.shared_output = bpy.path.abspath(settings.shared_output_dir)
+        self.supervisor.configure_calibration(settings.calibration if settings.calibrate else 0)
+        job.policy = create_policy(settings.scheduling)
+        if settings.shard_output:
+            job.settings.shard_size = settings.shard_size
+            job.resume = settings.resume
+        if settings.sync_files:
+            job.manifest = self.supervisor.build_manifest(bpy.data.filepath, collect_dependencies())
+        self.supervisor.start_job(job)
 
     def supervisor_cancel_render(self):
         self.supervisor.stop_job()
 
+    def supervisor_update_discovery(self, val):
+        if self.is_supervisor():
+            try:
+                if val:
+                    self.supervisor.enable_discovery()
+                else:
+                    self.supervisor.disable_discovery()
+            except OSError as e:
+                print("Unable to listen for workers:", e)
+
+    def supervisor_update_upload_limits(self, settings):
+        if self.is_supervisor():
+            megabytes = lambda value: value * 1e6 if value > 0 else None
+            self.supervisor.configure_uploads(megabytes(settings.upload_rate), megabytes(settings.worker_upload_rate), settings.max_uploads or None)
+
+    def supervisor_update_worker_upload_limit(self, item):
+        if self.is_supervisor():
+            self.supervisor.shaper.set_worker_rate((item.host, int(item.port)), item.upload_rate * 1e6 if item.upload_rate > 0 else None)
+
+    def supervisor_sync_worker_list(self):
+        worker_list = bpy.context.window_manager.armb.worker_list
+
+        for worker in self.supervisor.workers[len(worker_list):]:
+            new_item = worker_list.add()
+            new_item.temp_name = f"{worker.address[0]}:{worker.address[1]}"
+            new_item.host = worker.address[0]
+            new_item.port = str(worker.address[1])
+
+    def update_metrics_export(self, path, format):
+        node = self.worker if self.is_worker() else self.supervisor if self.is_supervisor() else None
+
+        if node and path:
+            node.enable_metrics_export(bpy.path.abspath(path), format)
+        elif node:
+            node.disable_metrics_export()
+
     def supervisor_update_supervisor_rendering(self, val):
         if self.is_supervisor():
             if val:
@@ -86,16 +161,21 @@ class ARMBController:
                 self.worker.update()
         elif self.is_supervisor():
             self.supervisor.update()
+            self.supervisor_sync_worker_list()
 
             if self.supervisor_working():
                 bpy.context.window_manager.armb.progress_indicator = round(self.supervisor.job_progress()*100)
 
 ARMB = ARMBController()
 
+def update_worker_upload_limit(item, context):
+    ARMB.supervisor_update_worker_upload_limit(item)
+
 class ARMBWorkerListItem(bpy.types.PropertyGroup):
     temp_name: bpy.props.StringProperty(name="Name", description="A temporary name for this worker")
     host: bpy.props.StringProperty(name="Host IP", description="The IP address of the worker computer")
     port: bpy.props.StringProperty(name="Port", description="The port the worker process is running on")
+    upload_rate: bpy.props.FloatProperty(name="Worker Upload Limit (MB/s)", description="Limit uploads from this worker, instead of the limit for every worker (0 for that limit)", default=0, min=0, update=update_worker_upload_limit)
 
 render_display_values = (
     ('WINDOW', "New Window", "Render in a separate window"),
@@ -105,13 +185,59 @@ render_display_values = (
     ('PREFERENCES', "User Preferences", "Use the value in User Preferences (Interface > Temporary Editors > Render In)")
 )
 
+render_profile_values = (
+    ('SCENE', "Scene Settings", "Render with each computer's own scene settings"),
+    ('DRAFT', "Draft", "Low samples, half resolution, simplified scene, for quick lookdev passes"),
+    ('REVIEW', "Review", "Moderate samples at full resolution, for reviewing a shot"),
+    ('FINAL', "Final", "The scene's own quality settings at full resolution")
+)
+
+def update_discovery(prop, context):
+    ARMB.supervisor_update_discovery(context.window_manager.armb.discover_workers)
+
+scheduling_values = (
+    ('speed', "Speed Aware", "Keep the last frames of a job for the workers that finish them soonest, and render a second copy of frames that take far too long"),
+    ('in-order', "In Order", "Give every worker the next frame waiting, whatever its speed")
+)
+
+metrics_format_values = (
+    ('json', "JSON", "Write metrics as a JSON document"),
+    ('prometheus', "Prometheus", "Write metrics in the Prometheus text format, e.g. for the node exporter's textfile collector")
+)
+
+def update_metrics_export(prop, context):
+    ARMB.update_metrics_export(context.window_manager.armb.metrics_path, context.window_manager.armb.metrics_format)
+
 def update_supervisor_rendering(prop, context):
     ARMB.supervisor_update_supervisor_rendering(context.window_manager.armb.render_on_supervisor)
 
+def update_upload_limits(prop, context):
+    ARMB.supervisor_update_upload_limits(context.window_manager.armb)
+
 class ARMBSettings(bpy.types.PropertyGroup):
     render_display_mode: bpy.props.EnumProperty(name="Render display mode", description="How to display an in-progress render", default='AREA', items=render_display_values)
+    render_profile: bpy.props.EnumProperty(name="Render profile", description="Quality settings to push to every worker", default='SCENE', items=render_profile_values)
+    discover_workers: bpy.props.BoolProperty(name="Discover workers", description="Automatically connect to workers that announce themselves on the local network", default=True, update=update_discovery)
+    shared_output: bpy.props.BoolProperty(name="Shared storage", description="Have workers render straight into the shared output path instead of uploading frames", default=False)
+    shared_output_dir: bpy.props.StringProperty(name="Shared Path", description="A directory every worker mounts at the same path", subtype='DIR_PATH', default="")
+    shard_output: bpy.props.BoolProperty(name="Long sequence", description="Put every few hundred or thousand frames in a subdirectory of their own and keep an index of the frames written, so that very long sequences don't slow the output directory down", default=False)
+    shard_size: bpy.props.IntProperty(name="Frames per Directory", description="How many frames go in each subdirectory", default=1000, min=1)
+    resume: bpy.props.BoolProperty(name="Skip written frames", description="Only render the frames the index doesn't have yet, e.g. to continue a render that was stopped", default=False)
+    sync_files: bpy.props.BoolProperty(name="Synchronize files", description="Send the saved .blend file and the files it depends on to every worker, transferring only the parts that changed", default=False)
+    calibrate: bpy.props.BoolProperty(name="Calibrate workers", description="Have each worker render a sample frame at a reduced resolution first, so the last frames of a job go to the workers that finish them soonest", default=False)
+    calibration: bpy.props.IntProperty(name="Sample Resolution", description="Percentage of the render resolution for the sample frame", subtype='PERCENTAGE', default=25, min=1, max=100)
+    scheduling: bpy.props.EnumProperty(name="Scheduling", description="How frames are shared out between workers", default='speed', items=scheduling_values)
     render_on_supervisor: bpy.props.BoolProperty(name="Render on supervisor", description="Use the supervisor computer as another rendering worker", default=True, update=update_supervisor_rendering)
     output_dir: bpy.props.StringProperty(name="Output Path", description="The directory in which to store rendered frames", subtype='DIR_PATH', default="//armb/")
+    metrics_path: bpy.props.StringProperty(name="Metrics File", description="Periodically write network metrics to this file (leave empty to disable)", subtype='FILE_PATH', default="", update=update_metrics_export)
+    metrics_format: bpy.props.EnumProperty(name="Metrics format", description="The format of the metrics file", default='json', items=metrics_format_values, update=update_metrics_export)
+    show_metrics: bpy.props.BoolProperty(name="Network Metrics", description="Show network metrics for each worker", default=False)
+    show_previews: bpy.props.BoolProperty(name="Previews", description="Show small previews of frames as soon as they are rendered", default=False)
+    preview_frame: bpy.props.IntProperty(name="Frame", description="The frame to preview; step through the frames to play them as a flipbook", default=1)
+    show_uploads: bpy.props.BoolProperty(name="Upload Limits", description="Show limits on how fast workers upload frames", default=False)
+    upload_rate: bpy.props.FloatProperty(name="Total (MB/s)", description="Limit uploads from all workers together (0 for no limit)", default=0, min=0, update=update_upload_limits)
+    worker_upload_rate: bpy.props.FloatProperty(name="Per Worker (MB/s)", description="Limit uploads from each worker (0 for no limit)", default=0, min=0, update=update_upload_limits)
+    max_uploads: bpy.props.IntProperty(name="Uploads at Once", description="Limit how many workers upload at the same time (0 for no limit)", default=0, min=0, update=update_upload_limits)
     worker_list: bpy.props.CollectionProperty(type=ARMBWorkerListItem)
     worker_index: bpy.props.IntProperty(name="Active Worker Index", default=0)
     progress_indicator: bpy.props.FloatProperty(name="Progress", subtype='PERCENTAGE', min=0, max=100, precision=0, default=30)
@@ -122,12 +248,14 @@ class ARMB_UL_WorkerList(bpy.types.UIList):
 
         if worker.ok() and not worker.connected() or worker.status == WorkerView.STATUS_INITIALIZING:
             status_icon = 'LAYER_USED'
+        elif worker.status in { WorkerView.STATUS_READY, WorkerView.STATUS_RENDERING } and worker.rendering():
+            status_icon = 'VIEW_CAMERA'
         elif worker.status == WorkerView.STATUS_READY:
             status_icon = 'LAYER_ACTIVE'
         elif worker.status == WorkerView.STATUS_SYNCHRONIZING:
             status_icon = 'FILE_REFRESH'
-        elif worker.status == WorkerView.STATUS_RENDERING:
-            status_icon = 'VIEW_CAMERA'
+        elif worker.status == WorkerView.STATUS_CALIBRATING:
+            status_icon = 'TIME'
         elif worker.status == WorkerView.STATUS_UPLOADING:
             status_icon = 'EXPORT'
         else:
@@ -143,6 +271,9 @@ class ARMB_UL_WorkerList(bpy.types.UIList):
                 layout.label(text=worker.error_description())
             elif not worker.connected():
                 layout.label(text="Disconnected")
+            elif worker.slot_count() > 1:
+                busy = worker.slot_count() - worker.slot_frames.count(None)
+                layout.label(text=f"{busy}/{worker.slot_count()} slots")
 
         elif self.layout_type in {'GRID'}:
             layout.alignment = 'CENTER'
@@ -195,11 +326,27 @@ class ARMB_OT_StartWorker(bpy.types.Operator):
     bl_description = "Start an ARMB worker"
 
     port: bpy.props.StringProperty(name="Worker Port", description="The port to run on", default="7210")
+    slots: bpy.props.IntProperty(name="Render Slots", description="How many frames to render at the same time", default=1, min=1, max=64)
+    local_slot: bpy.props.BoolProperty(name="Render in this window", description="Render the first slot inside this Blender window, other slots render in background processes", default=True)
+    devices: bpy.props.StringProperty(name="Devices", description="Comma-separated devices for background slots, e.g. CPU,CUDA:0,CUDA:1")
+    threads: bpy.props.IntProperty(name="Threads per slot", description="Limit the number of threads used by each background slot (0 for automatic)", default=0, min=0)
+    announce: bpy.props.BoolProperty(name="Announce on network", description="Let supervisors on the local network find this worker automatically", default=True)
+    storage_quota: bpy.props.FloatProperty(name="Disk Quota (GB)", description="Delete frames that the supervisor already received once they take up more than this (0 to keep everything)", default=0, min=0)
+    max_supervisors: bpy.props.IntProperty(name="Supervisors", description="How many supervisors may share this worker at once", default=4, min=1, max=16)
+    supervisor_weights: bpy.props.StringProperty(name="Weights", description="Share of render time per supervisor host, relative to the default of 1, e.g. studio=3,laptop=1")
 
     def execute(self, context):
+        try:
+            weights = parse_supervisor_weights(self.supervisor_weights)
+        except ValueError:
+            self.report({'WARNING'}, f"{self.supervisor_weights} is not a valid list of weights, e.g. studio=3,laptop=1")
+            return {'FINISHED'}
+
         try:
             port = int(self.port)
-            ARMB.worker_start(context.window_manager.armb.output_dir, port)
+            devices = [ d.strip() for d in self.devices.split(",") if d.strip() ] or None
+            quota = int(self.storage_quota * 1e9) if self.storage_quota > 0 else None
+            ARMB.worker_start(context.window_manager.armb.output_dir, port, self.slots, self.local_slot, devices, self.threads or None, quota, self.announce, self.max_supervisors, weights)
             bpy.ops.wm.armb_update_timer()
             self.report({'INFO'}, f"Successfully started worker on port {self.port}")
         except ValueError as e:
@@ -261,6 +408,13 @@ class ARMB_OT_StartRender(bpy.types.Operator):
         return not ARMB.supervisor_working()
 
     def execute(self, context):
+        if context.window_manager.armb.sync_files and not bpy.data.filepath:
+            self.report({'WARNING'}, "Save the file before synchronizing it with the workers")
+            return {'CANCELLED'}
+
+        if context.window_manager.armb.render_on_supervisor and bpy.data.filepath and bpy.data.is_dirty:
+            self.report({'WARNING'}, "The supervisor renders the saved file, without unsaved changes")
+
         ARMB.supervisor_start_render()
         return {'FINISHED'}
 
@@ -316,39 +470,59 @@ class ARMB_OT_ShowRenderStats(bpy.types.Operator):
         return ARMB.supervisor.job is not None
 
     def draw(self, context):
-        stats = ARMB.supervisor.job.worker_statistics()
+        job = ARMB.supervisor.job
+        stats = job.worker_statistics()
+        utilization = ARMB.supervisor.utilization()
+        rows = []
+
+        speeds = ARMB.supervisor.speeds
+
+        if ARMB.supervisor.supervisor_worker in stats:
+            rows.append(("Supervisor", stats[ARMB.supervisor.supervisor_worker], utilization.get("supervisor"), None, speeds.factor(ARMB.supervisor.supervisor_worker.speed)))
+        for worker in ARMB.supervisor.workers:
+            rows.append((worker.name(), stats.get(worker), utilization.get(worker.track), worker.health, speeds.factor(worker.speed)))
+
+            if worker.slot_count() > 1:
+                slot_stats = job.slot_statistics(worker)
+                for slot in range(worker.slot_count()):
+                    rows.append((f"    Slot {slot}", slot_stats.get(slot), None, None, None))
 
         row = self.layout.row()
         split = row.split(factor=0.5)
         col = split.column()
         col.label(text="Name")
-        if ARMB.supervisor.supervisor_worker in stats:
-            col.label(text="Supervisor")
-        for worker in ARMB.supervisor.workers:
-            if worker.identity:
-                col.label(text=worker.identity)
-            else:
-                col.label(text=f"{worker.address[0]}:{worker.address[1]}")
+        for name, _, _, _, _ in rows:
+            col.label(text=name)
 
         col = split.column()
         col.label(text="Number")
-        if ARMB.supervisor.supervisor_worker in stats:
-            col.label(text=str(stats[ARMB.supervisor.supervisor_worker][0]))
-        for worker in ARMB.supervisor.workers:
-            if worker in stats:
-                col.label(text=str(stats[worker][0]))
-            else:
-                col.label(text='0')
+        for _, worker_stats, _, _, _ in rows:
+            col.label(text=str(worker_stats[0]) if worker_stats else '0')
 
         col = split.column()
         col.label(text="Average Time")
-        if ARMB.supervisor.supervisor_worker in stats:
-            col.label(text=self.time_string(stats[ARMB.supervisor.supervisor_worker][1]))
-        for worker in ARMB.supervisor.workers:
-            if worker in stats:
-                col.label(text=self.time_string(stats[worker][1]))
-            else:
-                col.label(text='-')
+        for _, worker_stats, _, _, _ in rows:
+            col.label(text=self.time_string(worker_stats[1]) if worker_stats else '-')
+
+        col = split.column()
+        col.label(text="Idle")
+        for _, _, usage, _, _ in rows:
+            col.label(text=f"{(1 - usage['utilization'])*100:.0f}%" if usage else '')
+
+        col = split.column()
+        col.label(text="Health")
+        for _, _, _, health, _ in rows:
+            col.label(text=f"{health.score()*100:.0f}% ({health.failures} failed)" if health else '')
+
+        col = split.column()
+        col.label(text="Speed")
+        for _, _, _, _, speed in rows:
+            col.label(text=f"{speed:.2f}x" if speed is not None else '')
+
+        if job.frames_failed:
+            self.layout.label(text=f"{job.frames_failed} frames kept failing and were given up on", icon='ERROR')
+
+        self.layout.operator("wm.export_armb_trace")
 
     def execute(self, context):
         return {'FINISHED'}
@@ -361,6 +535,35 @@ class ARMB_OT_ShowRenderStats(bpy.types.Operator):
         hours = int(mins/60)
         return f"{(hours%60):02}:{(mins%60):02}:{(secs%60):05.02f}"
 
+class ARMB_OT_ExportTrace(bpy.types.Operator):
+    bl_idname = "wm.export_armb_trace"
+    bl_label = "Export Trace"
+    bl_description = "Export a timeline of renders, uploads and synchronization, which chrome://tracing or ui.perfetto.dev can open"
+
+    filepath: bpy.props.StringProperty(name="File Path", subtype='FILE_PATH', default="armb_trace.json")
+
+    @classmethod
+    def poll(cls, context):
+        return ARMB.started()
+
+    def execute(self, context):
+        path = bpy.path.abspath(self.filepath)
+
+        try:
+            if ARMB.is_supervisor():
+                ARMB.supervisor.export_trace(path)
+            else:
+                ARMB.worker.export_trace(path)
+        except OSError as e:
+            self.report({'ERROR'}, f"Unable to export trace: {e}")
+            return {'CANCELLED'}
+
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
 class ARMB_OT_UpdateTimer(bpy.types.Operator):
     bl_idname = "wm.armb_update_timer"
     bl_label = "ARMB Update Timer"
@@ -385,6 +588,43 @@ class ARMB_OT_UpdateTimer(bpy.types.Operator):
     def cancel(self, context):
         context.window_manager.event_timer_remove(self._timer)
 
+def draw_metrics_table(layout, connections):
+    columns = [ ("Name", lambda name, m: name),
+                ("Received", lambda name, m: f"{m.bytes_received/1e6:.1f} MB"),
+                ("Sent", lambda name, m: f"{m.bytes_sent/1e6:.1f} MB"),
+                ("Messages", lambda name, m: str(m.messages("sent") + m.messages("received"))),
+                ("Latency", lambda name, m: f"{m.mean_latency()*1000:.0f} ms"),
+                ("Rate", lambda name, m: f"{m.bandwidth()/1e6:.2f} MB/s"),
+                ("Stalled", lambda name, m: f"{m.stall_time:.1f} s") ]
+
+    row = layout.row()
+    for title, value in columns:
+        col = row.column()
+        col.label(text=title)
+        for name, metrics in connections.items():
+            col.label(text=value(name, metrics))
+
+def draw_previews(layout, settings, strip_length=5):
+    frames = ARMB.supervisor.previews.frames()
+
+    if not frames:
+        layout.label(text="No frames rendered yet")
+        return
+
+    # the previewed frame, or the nearest one that has arrived, with its neighbours as a filmstrip
+    current = min(range(len(frames)), key=lambda i: abs(frames[i] - settings.preview_frame))
+    first = max(0, min(current - strip_length // 2, len(frames) - strip_length))
+
+    layout.template_icon(icon_value=ARMB.supervisor_preview_icon(frames[current]), scale=10)
+    layout.prop(settings, "preview_frame")
+
+    row = layout.row(align=True)
+    for frame in frames[first:first + strip_length]:
+        col = row.column(align=True)
+        col.template_icon(icon_value=ARMB.supervisor_preview_icon(frame), scale=2.5)
+        col.label(text=str(frame), icon='RIGHTARROW_THIN' if frame == frames[current] else 'NONE')
+    layout.label(text=f"{len(frames)} of {ARMB.supervisor.job.frame_count} frames")
+
 class ARMB_PT_UI(bpy.types.Panel):
     bl_label = "ARMB Network Render"
     bl_space_type = 'PROPERTIES'
@@ -407,6 +647,9 @@ class ARMB_PT_UI(bpy.types.Panel):
 
             layout.separator()
             layout.prop(wm.armb, "output_dir")
+            row = layout.row()
+            row.prop(wm.armb, "metrics_path")
+            row.prop(wm.armb, "metrics_format", text="")
         elif ARMB.node_type == 'SUPERVISOR':
             row = layout.row()
             row.operator("wm.start_armb_render", icon='RENDER_ANIMATION')
@@ -417,6 +660,7 @@ class ARMB_PT_UI(bpy.types.Panel):
             row = layout.row()
             row.operator("wm.add_armb_worker", icon='ADD')
             row.operator("wm.remove_armb_worker", icon='REMOVE')
+            layout.prop(wm.armb, "discover_workers")
 
             layout.separator()
 
@@ -424,7 +668,27 @@ class ARMB_PT_UI(bpy.types.Panel):
             row.label(text="Render display mode: ")
             row.prop(wm.armb, "render_display_mode", text="")
 
+            row = layout.row()
+            row.label(text="Render profile: ")
+            row.prop(wm.armb, "render_profile", text="")
+
+            row = layout.row()
+            row.label(text="Scheduling: ")
+            row.prop(wm.armb, "scheduling", text="")
+
+            layout.prop(wm.armb, "sync_files")
             layout.prop(wm.armb, "render_on_supervisor")
+            layout.prop(wm.armb, "calibrate")
+            if wm.armb.calibrate:
+                layout.prop(wm.armb, "calibration")
+            layout.prop(wm.armb, "shared_output")
+            if wm.armb.shared_output:
+                layout.prop(wm.armb, "shared_output_dir")
+            layout.prop(wm.armb, "shard_output")
+            if wm.armb.shard_output:
+                row = layout.row()
+                row.prop(wm.armb, "shard_size")
+                row.prop(wm.armb, "resume")
 
             layout.separator()
 
@@ -446,6 +710,10 @@ class ARMB_PT_UI(bpy.types.Panel):
                 row.label(text=f"{ARMB.supervisor.job.frames_rendered}/{ARMB.supervisor.job.frame_count} frames rendered")
                 row.label(text=f"{ARMB.supervisor.job.frames_uploaded}/{ARMB.supervisor.job.frame_count} frames uploaded")
 
+                queue_depth, average_latency, max_latency = ARMB.supervisor.write_statistics()
+                if queue_depth or average_latency:
+                    box.label(text=f"Disk writes: {queue_depth} queued, {average_latency*1000:.0f} ms average, {max_latency*1000:.0f} ms max")
+
                 if ARMB.supervisor_working():
                     box.prop(wm.armb, "progress_indicator", slider=True)
                 else:
@@ -453,6 +721,29 @@ class ARMB_PT_UI(bpy.types.Panel):
 
                 layout.separator()
 
+            if ARMB.supervisor.job:
+                box = layout.box()
+                box.prop(wm.armb, "show_previews", icon='TRIA_DOWN' if wm.armb.show_previews else 'TRIA_RIGHT', emboss=False)
+                if wm.armb.show_previews:
+                    draw_previews(box, wm.armb)
+
+            box = layout.box()
+            box.prop(wm.armb, "show_uploads", icon='TRIA_DOWN' if wm.armb.show_uploads else 'TRIA_RIGHT', emboss=False)
+            if wm.armb.show_uploads:
+                row = box.row()
+                row.prop(wm.armb, "upload_rate")
+                row.prop(wm.armb, "worker_upload_rate")
+                box.prop(wm.armb, "max_uploads")
+                if 0 <= wm.armb.worker_index < len(wm.armb.worker_list):
+                    item = wm.armb.worker_list[wm.armb.worker_index]
+                    box.prop(item, "upload_rate", text=f"{item.temp_name} (MB/s)")
+                box.label(text=f"{ARMB.supervisor.uploads_in_progress()} uploading, {ARMB.supervisor.shaper.estimate()/1e6:.1f} MB per frame")
+
+            box = layout.box()
+            box.prop(wm.armb, "show_metrics", icon='TRIA_DOWN' if wm.armb.show_metrics else 'TRIA_RIGHT', emboss=False)
+            if wm.armb.show_metrics:
+                draw_metrics_table(box, ARMB.supervisor.connection_metrics())
+
             layout.operator("wm.disconnect_armb_supervisor")
         else:
             if ARMB.worker.ok():
@@ -460,6 +751,12 @@ class ARMB_PT_UI(bpy.types.Panel):
             else:
                 layout.label(text=ARMB.worker.status_message(), icon='ERROR')
 
+            if len(ARMB.worker.supervisors) > 1:
+                box = layout.box()
+                for name, stats in ARMB.worker.supervisor_statistics().items():
+                    box.label(text=f"{name}: {stats['frames_rendered']} frames, {stats['render_seconds']:.0f} s (weight {stats['weight']:g})")
+
+            layout.operator("wm.export_armb_trace")
             layout.operator("wm.disconnect_armb_worker", text="Disconnect")
 
 classes = [
@@ -477,6 +774,7 @@ classes = [
     ARMB_OT_ShowRenderStats,
     ARMB_OT_AddWorker,
     ARMB_OT_RemoveWorker,
+    ARMB_OT_ExportTrace,
     ARMB_OT_UpdateTimer,
     ARMB_PT_UI
 ]
@@ -488,6 +786,7 @@ def register():
     bpy.types.WindowManager.armb = bpy.props.PointerProperty(type=ARMBSettings)
 
 def unregister():
+    ARMB.free_previews()
     for c in classes:
         bpy.utils.unregister_class(c)
 
@@ -0,0 +1,108 @@
+# Measures the per-message cost of ARMBConnection, without Blender or a network.
+#
+# Two connections talk over a local socket pair; one sends a stream of messages and the other
+# receives them, checking every payload. Run from the repository root, for example:
+#
+#     python -m bench.connection --messages 100000 --data-size 0
+#     python -m bench.connection --messages 2000 --data-size 500000 --no-pool
+#     python -m bench.connection --messages 200 --data-size 20000000 --control-interval 0.01
+#
+# The receive time and allocations are reported per message. --no-pool disables buffer reuse,
+# for comparison. --control-interval also sends a small control message that often, and reports
+# how long those took to arrive while the large messages were being sent.
+
+import argparse, json, socket, time, tracemalloc
+from bench.farm import percentile
+
+from src.protocol.buffers import BufferPool
+from src.protocol.connection import ARMBConnection
+
+def payload(i, size):
+    return bytes([ i % 251 ]) * size
+
+def run(args, trace_allocations=False):
+    pool = BufferPool(max_size=0) if args.no_pool else BufferPool()
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    b.setblocking(False)
+    sender = ARMBConnection(a, args.timeout, pool=pool)
+    receiver = ARMBConnection(b, args.timeout, pool=pool)
+
+    sent = received = 0
+    receive_time = 0.0
+    corrupt = 0
+    control_latencies = []
+    next_control = 0.0
+    started = time.perf_counter()
+
+    if trace_allocations:
+        tracemalloc.start()
+        snapshot_before = tracemalloc.take_snapshot()
+
+    while received < args.messages and time.perf_counter() - started < args.time_limit:
+        # keep a few messages in flight, like a supervisor talking to a busy worker
+        while sent < args.messages and len(sender.outgoing) + len(sender.bulk) < args.in_flight:
+            sender.send(b"COMPLETE RENDER %d" % sent, payload(sent, args.data_size) if args.data_size else None)
+            sent += 1
+        if args.control_interval and time.perf_counter() >= next_control:
+            next_control = time.perf_counter() + args.control_interval
+            sender.send(b"CANCEL %f" % time.perf_counter())
+        sender.update()
+
+        t = time.perf_counter()
+        receiver.update()
+        while receiver.finished_receiving():
+            message = receiver.receive()
+            if message.message[:7] == b"CANCEL ":
+                control_latencies.append(time.perf_counter() - float(message.message[7:].tobytes()))
+                continue
+            if message.message.tobytes() != b"COMPLETE RENDER %d" % received or (args.data_size and message.data[-1] != received % 251):
+                corrupt += 1
+            received += 1
+        receive_time += time.perf_counter() - t
+
+    allocations = 0
+    if trace_allocations:
+        stats = tracemalloc.take_snapshot().compare_to(snapshot_before, 'filename')
+        allocations = sum(s.count_diff for s in stats if s.count_diff > 0)
+        tracemalloc.stop()
+
+    elapsed = time.perf_counter() - started
+    sender.close()
+    receiver.close()
+
+    return {
+        "config": vars(args),
+        "messages": received,
+        "corrupt": corrupt,
+        "elapsed": elapsed,
+        "us_per_message": 1e6 * elapsed / max(received, 1),
+        "receive_us_per_message": 1e6 * receive_time / max(received, 1),
+        "recv_calls_per_message": receiver.metrics.recv_calls / max(received, 1),
+        "buffers_allocated": pool.allocated,
+        "buffers_reused": pool.reused,
+        "live_allocations_per_message": allocations / max(received, 1) if trace_allocations else None,
+        "control_messages": len(control_latencies),
+        "control_latency_ms_p50": 1000 * percentile(control_latencies, 0.5),
+        "control_latency_ms_max": 1000 * max(control_latencies, default=0.0)
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ARMBConnection message handling over a local socket pair")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--data-size", type=int, default=0, help="bytes of data per message")
+    parser.add_argument("--in-flight", type=int, default=32, help="messages queued on the sender at once")
+    parser.add_argument("--no-pool", action="store_true", help="allocate a new buffer for every message")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--time-limit", type=float, default=120)
+    parser.add_argument("--allocations", action="store_true", help="also count allocations, in a slower second run")
+    parser.add_argument("--control-interval", type=float, default=0, help="seconds between small control messages sent alongside the others (0 for none)")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    if args.allocations:
+        result["live_allocations_per_message"] = run(args, trace_allocations=True)["live_allocations_per_message"]
+    print(json.dumps(result, indent=1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+# Simulates a whole render farm over loopback, without Blender.
+#
+# A real Supervisor and N real Workers talk over TCP on this machine, while the workers'
+# render slots only wait and write a file of the configured size. Run from the repository
+# root, for example:
+#
+#     python -m bench.farm --workers 200 --frames 2000 --frame-time 0.05 --output-size 200000
+#
+# Results are appended to a JSON lines file, so runs can be compared with --baseline.
+
+import argparse, json, os, random, shutil, sys, tempfile, time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from src.blender import blender
+from src.supervisor.render_job import RenderJob
+from src.supervisor.supervisor import Supervisor
+from src.supervisor.scheduling import POLICIES, create_policy
+from src.worker.render_slot import RenderSlot
+from src.worker.worker import Worker
+
+class SimulatedRenderSlot(RenderSlot):
+    def __init__(self, index, rng, frame_time, frame_spread, distribution, output_size, failure_rate):
+        super().__init__(index)
+        self.rng = rng
+        self.frame_time = frame_time
+        self.frame_spread = frame_spread
+        self.distribution = distribution
+        self.output_size = output_size
+        self.failure_rate = failure_rate
+        self.finish_time = None
+        self.cancelled = False
+        self.path = None
+
+    def duration(self):
+        if self.distribution == 'uniform':
+            return max(0.0, self.rng.uniform(self.frame_time - self.frame_spread, self.frame_time + self.frame_spread))
+        elif self.distribution == 'normal':
+            return max(0.0, self.rng.gauss(self.frame_time, self.frame_spread))
+        elif self.distribution == 'lognormal' and self.frame_time > 0:
+            return self.rng.lognormvariate(0, self.frame_spread) * self.frame_time
+        return self.frame_time
+
+    def start(self, settings, path, blend_file=None):
+        self.path = path + blender.filename_extension()
+        # a calibration render at a reduced resolution has fewer pixels to render
+        self.finish_time = time.time() + self.duration() * (settings.percentage / 100) ** 2
+        return True
+
+    def poll(self):
+        if self.cancelled:
+            self.cancelled = False
+            return RenderSlot.RESULT_CANCELLED
+
+        if self.finish_time is not None and time.time() >= self.finish_time:
+            self.finish_time = None
+
+            if self.rng.random() < self.failure_rate:
+                return RenderSlot.RESULT_CANCELLED
+
+            # Blender creates missing output directories too
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "wb") as f:
+                f.write(bytes(self.output_size))
+            return RenderSlot.RESULT_FINISHED
+
+    def cancel(self):
+        # stops at once, as a terminated render process does
+        if self.finish_time is not None:
+            self.finish_time = None
+            self.cancelled = True
+
+def max_rss_mb():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024 if sys.platform != 'darwin' else usage / (1024*1024)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run(args):
+    rng = random.Random(args.seed)
+    root = tempfile.mkdtemp(prefix="armb-bench-")
+    # loopback stands in for a network, unless the local transport is what's being measured
+    supervisor = Supervisor(os.path.join(root, "supervisor", ""), timeout=args.timeout, local_transport=args.local)
+    supervisor.disable_supervisor_rendering()
+    supervisor.configure_uploads(args.upload_rate * 1e6 if args.upload_rate else None, None, args.max_uploads)
+    supervisor.configure_calibration(args.calibrate)
+    workers = []
+
+    try:
+        for i in range(args.workers):
+            # the first --slow-workers are that many times slower than the others
+            scale = args.slow_factor if i < args.slow_workers else 1.0
+            # a lognormal spread is relative to the frame time already
+            spread = args.frame_spread * (scale if args.distribution != 'lognormal' else 1.0)
+            slots = [ SimulatedRenderSlot(s, rng, args.frame_time * scale, spread, args.distribution, args.output_size, args.failure_rate) for s in range(args.slots) ]
+            worker = Worker(os.path.join(root, f"worker{i}", ""), args.base_port + i, timeout=args.timeout, slots=slots, local_socket=args.local)
+            worker.start()
+            workers.append(worker)
+            supervisor.add_worker("127.0.0.1", args.base_port + i)
+
+        settings = blender.create_render_settings()
+        if args.shared_output:
+            # a local directory stands in for storage every worker mounts
+            settings.shared_output = os.path.join(root, "shared", "")
+        settings.shard_size = args.shard_size
+        job = RenderJob(1, args.frames, settings, settings)
+        job.policy = create_policy(args.policy)
+        supervisor.start_job(job)
+
+        tick_times = []
+        tick_cpu = []
+        started = time.time()
+        rendering_finished = None
+
+        while not supervisor.job.uploading_complete() and time.time() - started < args.time_limit:
+            for worker in workers:
+                if worker.closed and not worker.error():
+                    worker.restart()
+                elif worker.ok():
+                    worker.update()
+
+            wall, cpu = time.perf_counter(), time.thread_time()
+            supervisor.update()
+            tick_times.append(time.perf_counter() - wall)
+            tick_cpu.append(time.thread_time() - cpu)
+
+            if rendering_finished is None and supervisor.job.rendering_complete():
+                rendering_finished = time.time()
+
+        finished = time.time()
+        metrics = supervisor.metrics()
+        render_messages = sum(m.messages for (d, t), m in metrics.types.items() if d == "sent" and t == "RENDER")
+        upload_bytes = sum(m.bytes for (d, t), m in metrics.types.items() if d == "received" and t == "COMPLETE UPLOAD")
+        upload_time = finished - (rendering_finished or finished)
+        job = supervisor.job
+
+        return {
+            "timestamp": time.time(),
+            "config": vars(args),
+            "completed": job.uploading_complete(),
+            "frames_rendered": job.frames_rendered,
+            "frames_uploaded": job.frames_uploaded,
+            "frames_irretrievable": job.frames_irretrievable,
+            "elapsed": finished - started,
+            "frames_per_second_dispatched": render_messages / max(finished - started, 1e-9),
+            "upload_mb_per_second": upload_bytes / 1e6 / upload_time if upload_time > 0 else 0.0,
+            "upload_seconds": upload_time,
+            "supervisor_ticks": len(tick_times),
+            "supervisor_tick_ms_mean": 1000 * sum(tick_times) / max(len(tick_times), 1),
+            "supervisor_tick_ms_p99": 1000 * percentile(tick_times, 0.99),
+            "supervisor_cpu_ms_per_tick": 1000 * sum(tick_cpu) / max(len(tick_cpu), 1),
+            "max_rss_mb": max_rss_mb(),
+            "send_calls": metrics.send_calls,
+            "recv_calls": metrics.recv_calls,
+            "uploads_throttled": supervisor.shaper.throttled,
+            "backup_frames": job.backup_copies
+        }
+    finally:
+        if args.trace:
+            # e.g. to replay the job against other policies with bench.simulate
+            supervisor.export_trace(args.trace)
+        supervisor.stop()
+        for worker in workers:
+            if not worker.closed:
+                worker.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+COMPARED = [ "elapsed", "frames_per_second_dispatched", "upload_mb_per_second", "supervisor_tick_ms_mean", "supervisor_tick_ms_p99", "supervisor_cpu_ms_per_tick", "max_rss_mb", "send_calls", "recv_calls" ]
+
+def compare(result, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.loads(f.readlines()[-1])
+
+    for key in COMPARED:
+        old, new = baseline.get(key, 0), result[key]
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"  {key:32} {old:12.3f} -> {new:12.3f}  {change}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark an ARMB farm over loopback with simulated renders")
+    parser.add_argument("--workers", type=int, default=20)
+    parser.add_argument("--slots", type=int, default=1, help="render slots per worker")
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--frame-time", type=float, default=0.05, help="mean seconds per simulated frame")
+    parser.add_argument("--frame-spread", type=float, default=0.02, help="spread of the frame time distribution")
+    parser.add_argument("--distribution", choices=["constant", "uniform", "normal", "lognormal"], default="normal")
+    parser.add_argument("--output-size", type=int, default=100000, help="bytes per rendered frame")
+    parser.add_argument("--slow-workers", type=int, default=0, help="how many of the workers are slower than the rest")
+    parser.add_argument("--slow-factor", type=float, default=4.0, help="how many times longer the slow workers take per frame")
+    parser.add_argument("--policy", choices=list(POLICIES), default="speed", help="how frames are shared out between workers")
+    parser.add_argument("--calibrate", type=int, default=0, metavar="PERCENT", help="have each worker render a sample frame at this percentage of the resolution first")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probability that a render attempt fails")
+    parser.add_argument("--shared-output", action="store_true", help="render into a directory shared by all workers, instead of uploading")
+    parser.add_argument("--shard-size", type=int, default=0, help="frames per output subdirectory, with a frame index")
+    parser.add_argument("--local", action="store_true", help="connect over Unix domain sockets and hand frames over by path, as for workers on the supervisor's computer")
+    parser.add_argument("--upload-rate", type=float, help="limit uploads to the supervisor to this many MB/s")
+    parser.add_argument("--max-uploads", type=int, help="limit how many workers upload at once")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--time-limit", type=float, default=600)
+    parser.add_argument("--base-port", type=int, default=17000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", help="write the supervisor's Chrome trace of the run to this file")
+    parser.add_argument("--results", default="bench_results.jsonl", help="append results to this file")
+    parser.add_argument("--baseline", help="compare with the last result in this file")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    print(json.dumps(result, indent=1))
+
+    if args.baseline:
+        compare(result, args.baseline)
+
+    with open(args.results, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+# Replays a recorded job against the scheduling policies in simulated time, to see what
+# another policy would have made of the same farm without rendering anything again.
+#
+# The job comes from the Chrome trace a supervisor writes with --trace, from the command line
+# or from bench.farm: how long each worker took for each frame it rendered, which attempts
+# failed, and how large each frame's upload was. Run from the repository root, for example:
+#
+#     python -m bench.farm --workers 20 --slow-workers 5 --policy in-order --trace farm.json
+#     python -m bench.simulate farm.json
+#
+# A frame a worker never rendered takes it its usual time, scaled by how much longer or shorter
+# than usual the frame took wherever it was rendered. A worker fails a frame as many times as
+# it did in the trace, and uploads at the rate it did, sharing --link-rate with the workers
+# uploading at the same time. Frames are handed out the moment a slot is free, without the
+# round trips of a real farm, so makespans come out a little shorter; a slot left free is
+# offered a frame again every --interval, as a supervisor does on each update.
+
+import argparse, heapq, json, statistics
+
+from src.supervisor.render_job import RenderJob
+from src.supervisor.scheduling import POLICIES, create_policy
+from src.supervisor.worker_speed import SpeedTable
+
+class RecordedWorker:
+    def __init__(self, name):
+        self.name = name
+        self.slots = set()
+        self.times = {} # frame -> seconds, for the frames it rendered
+        self.failures = {} # frame -> seconds of each failed attempt
+        self.upload_bytes = 0
+        self.upload_seconds = 0.0
+        self.local = False # handed frames over by path, moving no bytes
+        self.usual_time = None
+
+    def upload_rate(self):
+        return self.upload_bytes / self.upload_seconds if self.upload_seconds > 0 else None
+
+class Recording:
+    def __init__(self):
+        self.workers = {} # name -> RecordedWorker
+        self.sizes = {} # frame -> bytes uploaded
+        self.frames = set()
+        self.costs = {} # frame -> its time relative to its workers' usual times
+        self.started = None
+        self.finished = None
+
+    def worker(self, name):
+        return self.workers.setdefault(name, RecordedWorker(name))
+
+    def finish(self):
+        for worker in self.workers.values():
+            if worker.times:
+                worker.usual_time = statistics.median(worker.times.values())
+
+        relative = {}
+        for worker in self.workers.values():
+            for frame, seconds in worker.times.items():
+                if worker.usual_time:
+                    relative.setdefault(frame, []).append(seconds / worker.usual_time)
+        self.costs = { frame: statistics.mean(values) for frame, values in relative.items() }
+
+    def rendering_workers(self):
+        # the supervisor renders last, as in its updates; a worker that completed nothing can't be replayed
+        return sorted((w for w in self.workers.values() if w.usual_time is not None), key=lambda w: (w.name == "supervisor", w.name))
+
+    def render_time(self, worker, frame):
+        if frame in worker.times:
+            return worker.times[frame]
+        return worker.usual_time * self.costs.get(frame, 1.0)
+
+    def size(self, frame):
+        if frame in self.sizes:
+            return self.sizes[frame]
+        return statistics.median(self.sizes.values()) if self.sizes else 0
+
+    def recorded_seconds(self):
+        if self.started is not None and self.finished is not None:
+            return self.finished - self.started
+
+def load_trace(path):
+    with open(path) as f:
+        events = json.load(f)["traceEvents"]
+
+    tracks = { e["tid"]: e["args"]["name"] for e in events if e["ph"] == "M" and e["name"] == "thread_name" }
+    recording = Recording()
+
+    for e in events:
+        track, args = tracks.get(e.get("tid"), ""), e.get("args", {})
+
+        if e["ph"] == "i" and e["name"] == "start job":
+            recording.started = e["ts"] / 1e6 # the last job in the trace is the one replayed
+            recording.finished = None
+            recording.workers, recording.sizes, recording.frames = {}, {}, set()
+        if e["ph"] != "X" or args.get("unfinished") or recording.started is None:
+            continue
+
+        seconds = e["dur"] / 1e6
+        end = (e["ts"] + e["dur"]) / 1e6
+        if e["cat"] == "render" and e["name"].startswith("render "):
+            if track == "supervisor":
+                name, slot = track, 0
+            elif " slot " in track:
+                name, slot = track.rsplit(" slot ", 1)
+            else:
+                continue
+
+            frame = int(e["name"][len("render "):])
+            worker = recording.worker(name)
+            worker.slots.add(int(slot))
+            recording.frames.add(frame)
+
+            if args.get("result") == "complete":
+                worker.times.setdefault(frame, seconds)
+            elif args.get("result") in ("failed", "lost", "missing"):
+                worker.failures.setdefault(frame, []).append(seconds)
+            recording.finished = max(recording.finished or end, end)
+        elif e["cat"] == "upload" and track.endswith(" upload") and "size" in args:
+            frame = int(e["name"][len("upload "):])
+            worker = recording.worker(track[:-len(" upload")])
+            recording.sizes[frame] = args["size"]
+
+            if args.get("local"):
+                worker.local = True
+            else:
+                worker.upload_bytes += args["size"]
+                worker.upload_seconds += seconds
+            recording.finished = max(recording.finished or end, end)
+
+    recording.finish()
+    return recording
+
+class SimulatedWorker:
+    # what a policy and a job ask of a WorkerView
+    def __init__(self, recorded, speed):
+        self.recorded = recorded
+        self.identity = recorded.name
+        self.speed = speed
+        self.slot_frames = [ None ] * len(recorded.slots)
+        self.slot_started = [ None ] * len(recorded.slots)
+        self.attempts = {} # frame -> render attempts so far
+        self.uploading = None
+
+    def ok(self):
+        return True
+
+    def render_ages(self, now):
+        return [ now - started if started is not None else 0.0 for started in self.slot_started ]
+
+class Simulation:
+    # Renders and uploads the recorded job on simulated workers, as events in simulated time,
+    # and provides the farm a policy asks about, see scheduling.
+    def __init__(self, recording, policy, upload_rate, link_rate=None, interval=None):
+        self.recording = recording
+        self.upload_rate = upload_rate # bytes per second for workers that uploaded nothing
+        self.link_rate = link_rate # bytes per second for all uploads together, None for unlimited
+        self.interval = interval or statistics.median(w.usual_time for w in recording.rendering_workers()) / 20
+        self.waking = False
+        self.speeds = SpeedTable()
+        self.workers = [ SimulatedWorker(w, self.speeds.speed(w.name)) for w in recording.rendering_workers() ]
+        self.job = RenderJob(min(recording.frames), max(recording.frames), None, None)
+        self.job.policy = policy
+        self.job.clock = lambda: self.now
+        self.now = 0.0
+        self.rounds = 0
+        self.events = [] # (time, sequence, handler, args)
+        self.sequence = 0
+        self.uploading = 0
+        self.rendering_finished = None
+        self.busy = 0.0 # slot seconds spent rendering, up to the end of rendering
+        self.wasted = 0.0 # slot seconds spent on failed attempts and on copies stopped or finished second
+        self.bytes_moved = 0
+
+    def render_candidates(self):
+        return self.workers
+
+    def may_back_up(self, frame, worker):
+        # the supervisor's own frames are written where an upload would go, see Supervisor
+        return "supervisor" not in (worker.identity, frame.assignee.identity)
+
+    def schedule(self, delay, handler, *args):
+        heapq.heappush(self.events, (self.now + delay, self.sequence, handler, args))
+        self.sequence += 1
+
+    def run(self):
+        self.dispatch()
+
+        while self.events and not self.job.uploading_complete():
+            self.now = self.events[0][0]
+            # everything finishing at the same moment first, as one supervisor update would see it
+            while self.events and self.events[0][0] <= self.now:
+                when, sequence, handler, args = heapq.heappop(self.events)
+                handler(*args)
+            self.dispatch()
+
+        return self.results()
+
+    def dispatch(self):
+        self.rounds += 1
+        if self.job.check_failures:
+            self.job.abandon_frames(self.workers)
+
+        if not self.job.rendering_complete():
+            idle = False
+            for worker in self.workers:
+                for slot in range(len(worker.slot_frames)):
+                    if worker.slot_frames[slot] is None and not self.start_render(worker, slot):
+                        idle = True
+                        break
+
+            # a policy may give an idle slot a frame later, e.g. a second copy of a straggler
+            if idle and not self.waking and any(frame is not None for worker in self.workers for frame in worker.slot_frames):
+                self.waking = True
+                self.schedule(self.interval, self.wake)
+        else:
+            if self.rendering_finished is None:
+                self.rendering_finished = self.now
+            for worker in self.workers:
+                if worker.uploading is None:
+                    self.start_upload(worker)
+
+    def wake(self):
+        self.waking = False
+
+    def start_render(self, worker, slot):
+        fnum = self.job.assign_next_frame(worker, slot, self)
+        if fnum is None:
+            return False
+
+        attempt = worker.attempts.get(fnum, 0)
+        worker.attempts[fnum] = attempt + 1
+        failures = worker.recorded.failures.get(fnum, [])
+
+        failed = attempt < len(failures)
+        seconds = failures[attempt] if failed else self.recording.render_time(worker.recorded, fnum)
+        worker.slot_frames[slot] = fnum
+        worker.slot_started[slot] = self.now
+        self.schedule(seconds, self.finish_render, worker, slot, fnum, seconds, failed)
+        return True
+
+    def finish_render(self, worker, slot, fnum, seconds, failed):
+        if worker.slot_frames[slot] != fnum:
+            return # stopped when the other copy finished first
+
+        started = worker.slot_started[slot]
+        worker.slot_frames[slot] = worker.slot_started[slot] = None
+        self.busy += seconds if self.rendering_finished is None else max(0.0, self.rendering_finished - started)
+
+        if failed:
+            self.wasted += seconds
+            self.job.record_failure(fnum, worker)
+            return
+
+        worker.speed.record_frame(seconds)
+        if self.job.assignment(fnum).rendered:
+            self.wasted += seconds # the other copy finished first
+        else:
+            self.job.mark_rendered(fnum, worker)
+            if worker.identity == "supervisor":
+                self.job.mark_uploaded(fnum)
+
+        for loser, frame in self.job.take_stopped_copies():
+            self.stop_render(loser, frame)
+
+    def stop_render(self, worker, fnum):
+        # as the supervisor cancels the copy of a frame that another worker finished first
+        if fnum not in worker.slot_frames:
+            return
+
+        slot = worker.slot_frames.index(fnum)
+        seconds = self.now - worker.slot_started[slot]
+        worker.slot_frames[slot] = worker.slot_started[slot] = None
+        self.busy += seconds
+        self.wasted += seconds
+
+    def start_upload(self, worker):
+        fnum = self.job.next_for_uploading(worker)
+        if fnum is None:
+            return
+
+        size = self.recording.size(fnum)
+        rate = worker.recorded.upload_rate() or self.upload_rate
+        self.uploading += 1
+        if self.link_rate:
+            rate = min(rate, self.link_rate / self.uploading)
+
+        worker.uploading = fnum
+        self.job.mark_writing(fnum)
+        self.schedule(size / rate, self.finish_upload, worker, fnum, size)
+
+    def finish_upload(self, worker, fnum, size):
+        self.uploading -= 1
+        worker.uploading = None
+        self.job.mark_uploaded(fnum)
+        if not worker.recorded.local:
+            self.bytes_moved += size
+
+    def results(self):
+        slots = sum(len(worker.slot_frames) for worker in self.workers)
+        rendering = self.rendering_finished if self.rendering_finished is not None else self.now
+        idle = max(0.0, slots * rendering - self.busy)
+
+        return {
+            "policy": self.job.policy.name,
+            "completed": self.job.uploading_complete(),
+            "makespan": self.now,
+            "rendering_seconds": rendering,
+            "idle_slot_seconds": idle,
+            "idle_fraction": idle / (slots * rendering) if rendering > 0 else 0.0,
+            "wasted_slot_seconds": self.wasted,
+            "bytes_moved": self.bytes_moved,
+            "frames_rendered": self.job.frames_rendered,
+            "frames_failed": self.job.frames_failed,
+            "backup_copies": self.job.backup_copies
+        }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded ARMB job against scheduling policies in simulated time")
+    parser.add_argument("trace", help="a Chrome trace written by a supervisor with --trace")
+    parser.add_argument("--policy", action="append", choices=list(POLICIES), help="simulate this policy (repeatable, default: all of them)")
+    parser.add_argument("--upload-rate", type=float, default=100, help="MB/s for workers that uploaded nothing in the trace")
+    parser.add_argument("--link-rate", type=float, help="MB/s the supervisor receives at from all workers together, unlimited by default")
+    parser.add_argument("--interval", type=float, help="seconds between offers of frames to idle slots, by default a twentieth of the usual frame time")
+    parser.add_argument("--results", help="append results to this JSON lines file")
+    args = parser.parse_args(argv)
+
+    recording = load_trace(args.trace)
+    workers = recording.rendering_workers()
+    if not workers:
+        raise SystemExit(f"{args.trace} has no completed renders to replay")
+
+    recorded = recording.recorded_seconds()
+    print(f"{len(recording.frames)} frames on {len(workers)} workers with {sum(len(w.slots) for w in workers)} slots" + (f", {recorded:.2f} s as recorded" if recorded else ""))
+
+    for name in args.policy or POLICIES:
+        result = Simulation(recording, create_policy(name), args.upload_rate * 1e6, args.link_rate * 1e6 if args.link_rate else None, args.interval).run()
+        result["trace"] = args.trace
+        print(f"  {name:10} {result['makespan']:9.2f} s, rendering {result['rendering_seconds']:9.2f} s, {result['idle_fraction']:6.1%} idle,"
+              f" {result['bytes_moved'] / 1e6:9.1f} MB moved, {result['backup_copies']} backup copies, {result['wasted_slot_seconds']:.2f} slot s wasted"
+              + ("" if result["completed"] else ", STALLED"))
+
+        if args.results:
+            with open(args.results, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import os, re, glob, json, tempfile
 from ..shared.render_settings import RenderSettings
 from ..supervisor.render_job import RenderJob
 
@@ -8,33 +9,79 @@ try:
 except ImportError:
     print('WARINING: unable to import bpy')
 
-def create_render_settings():
+def render_option_targets(scene):
+    # maps profile options to the Blender properties they control for the active engine
+    targets = {
+        "use_motion_blur": (scene.render, "use_motion_blur"),
+        "use_simplify": (scene.render, "use_simplify"),
+        "simplify_subdivision": (scene.render, "simplify_subdivision_render")
+    }
+
+    if scene.render.engine == 'CYCLES':
+        targets.update({
+            "samples": (scene.cycles, "samples"),
+            "adaptive_threshold": (scene.cycles, "adaptive_threshold"),
+            "use_denoising": (scene.cycles, "use_denoising"),
+            "denoiser": (scene.cycles, "denoiser"),
+            "max_bounces": (scene.cycles, "max_bounces")
+        })
+    elif scene.render.engine == 'BLENDER_EEVEE':
+        targets.update({
+            "samples": (scene.eevee, "taa_render_samples"),
+            "use_motion_blur": (scene.eevee, "use_motion_blur")
+        })
+
+    return targets
+
+def create_render_settings(include_options=True):
+    # options are only needed to restore the scene, a job only pushes its profile's options
     if bpy:
-        props = bpy.context.scene.render
+        scene = bpy.context.scene
+        props = scene.render
         prefs = bpy.context.preferences
-        return RenderSettings(props.resolution_x, props.resolution_y, props.resolution_percentage, prefs.view.render_display_type)
-    return RenderSettings(1920, 1280, 100)
+        options = {}
+        if include_options:
+            options = { name: getattr(owner, attr) for name, (owner, attr) in render_option_targets(scene).items() }
+        return RenderSettings(props.resolution_x, props.resolution_y, props.resolution_percentage, prefs.view.render_display_type, options=options)
+    return RenderSettings(1920, 1280, 100, 'AREA')
 
 def apply_render_settings(settings):
     if bpy and settings is not None:
-        props = bpy.context.scene.render
+        scene = bpy.context.scene
+        props = scene.render
         prefs = bpy.context.preferences
+        targets = render_option_targets(scene)
+        changes = [ (props, "resolution_x", settings.resolution_x), (props, "resolution_y", settings.resolution_y), (props, "resolution_percentage", settings.percentage) ]
+        changes += [ targets[name] + (value,) for name, value in settings.options.items() if name in targets ]
+        previous = []
 
-        props.resolution_x = settings.resolution_x
-        props.resolution_y = settings.resolution_y
-        props.resolution_percentage = settings.percentage
+        # apply every setting or none of them, so a bad value can't leave a half-applied profile
+        try:
+            for owner, attr, value in changes:
+                previous.append((owner, attr, getattr(owner, attr)))
+                setattr(owner, attr, value)
+        except (AttributeError, TypeError, ValueError) as e:
+            print("Unable to apply render settings:", e)
+            for owner, attr, value in reversed(previous):
+                setattr(owner, attr, value)
+            return
 
         if settings.display_mode in {'SCREEN', 'AREA', 'WINDOW', 'NONE'}:
             prefs.view.render_display_type = settings.display_mode
 
-def create_render_job(display_mode=None):
+def create_render_job(display_mode=None, profile=None):
     if bpy:
         scene = bpy.context.scene
-        settings = create_render_settings()
+        settings = create_render_settings(include_options=False)
         if display_mode is not None:
             settings.display_mode = display_mode
+        if profile is not None:
+            settings.apply_profile(profile)
         return RenderJob(scene.frame_start, scene.frame_end, settings, create_render_settings())
-    return RenderJob(1, 250, create_render_settings())
+    settings = create_render_settings()
+    if profile is not None:
+        settings.apply_profile(profile)
+    return RenderJob(1, 250, settings, create_render_settings())
 
 def set_render_callbacks(finished_callback, cancelled_callback):
     if bpy:
@@ -50,8 +97,165 @@ def render_frame(frame, path):
     if bpy:
         bpy.context.scene.render.filepath = path
         bpy.context.scene.frame_set(frame)
-        return bpy.ops.render.render('INVOKE_DEFAULT', write_still=True)
+        # without a UI, renders block until they finish and the render handlers run before returning
+        return bpy.ops.render.render('EXEC_DEFAULT' if bpy.app.background else 'INVOKE_DEFAULT', write_still=True)
     return {'RUNNING_MODAL'}
 
+def import_root():
+    # the directory this module is imported from, as the add-on (ARMB.src.blender.blender) or
+    # from a checkout by the command line (src.blender.blender), a level up per package
+    root = os.path.abspath(__file__)
+    for package in __name__.split("."):
+        root = os.path.dirname(root)
+    return root
+
+def render_process_command(frame, path, settings, device=None, threads=None, blend_file=None):
+    # renders the saved (or given) .blend file in a separate background Blender process
+    blend_file = blend_file or current_file()
+    if bpy and blend_file:
+        serialized = settings.serialize() if settings else ""
+        script = "; ".join([
+            "import sys, importlib",
+            f"sys.path.insert(0, {import_root()!r})",
+            f"sys.exit(importlib.import_module({__name__!r}).render_in_background({frame}, {path!r}, {serialized!r}, {device!r}))"
+        ])
+        command = [bpy.app.binary_path, "--background", blend_file]
+        if threads:
+            command += ["--threads", str(threads)]
+        return command + ["--python-exit-code", "1", "--python-expr", script]
+
+def render_in_background(frame, path, serialized_settings, device=None):
+    if serialized_settings:
+        apply_render_settings(RenderSettings.deserialize(serialized_settings))
+    if device:
+        select_render_device(device)
+
+    bpy.context.scene.render.filepath = path
+    bpy.context.scene.frame_set(frame)
+    if 'FINISHED' not in bpy.ops.render.render(write_still=True):
+        return 1
+
+    # only this process has the scene that was rendered, so it lists what its File Output nodes wrote
+    write_output_list(path, file_output_paths(frame))
+    return 0
+
+def select_render_device(device):
+    # device is CPU or a Cycles compute backend, optionally pinned to one device, e.g. CUDA:1
+    scene = bpy.context.scene
+    backend, _, index = device.upper().partition(":")
+
+    if backend == 'CPU':
+        scene.cycles.device = 'CPU'
+    elif 'cycles' in bpy.context.preferences.addons:
+        cycles_prefs = bpy.context.preferences.addons['cycles'].preferences
+        cycles_prefs.compute_device_type = backend
+        cycles_prefs.get_devices()
+        devices = [ d for d in cycles_prefs.devices if d.type == backend ]
+
+        for i, d in enumerate(devices):
+            d.use = not index or str(i) == index
+        scene.cycles.device = 'GPU'
+
+def current_file():
+    if bpy:
+        return bpy.data.filepath or None
+
+def collect_dependencies():
+    # every file the open .blend file needs to render, including image sequences and caches
+    paths = []
+
+    if bpy:
+        for path in bpy.utils.blend_paths(absolute=True):
+            if '#' in path:
+                paths.extend(glob.glob(re.sub("#+", "*", path)))
+            else:
+                paths.append(path)
+
+        for image in bpy.data.images:
+            if image.source == 'SEQUENCE' and image.filepath:
+                directory, name = os.path.split(bpy.path.abspath(image.filepath))
+                prefix = re.sub("\d+(\.\w+)\Z", "", name)
+                paths.extend(glob.glob(os.path.join(directory, glob.escape(prefix) + "*")))
+
+    return paths
+
+def create_preview(path, size):
+    # a small JPEG of a rendered frame, at most size pixels across, or None
+    if bpy and size:
+        image = None
+        preview_path = os.path.join(tempfile.gettempdir(), f"armb_preview_{os.getpid()}.jpg")
+
+        try:
+            image = bpy.data.images.load(path, check_existing=False)
+            width, height = image.size
+            scale = size / max(width, height, 1)
+            if scale < 1:
+                image.scale(max(1, round(width * scale)), max(1, round(height * scale)))
+            image.filepath_raw = preview_path
+            image.file_format = 'JPEG'
+            image.save()
+
+            with open(preview_path, "rb") as f:
+                return f.read()
+        except (RuntimeError, OSError) as e:
+            print("Unable to create a preview of", path, e)
+        finally:
+            if image:
+                bpy.data.images.remove(image)
+
+def frame_pattern(path, frame):
+    # Blender replaces a run of #s with the padded frame number, or appends it padded to four digits
+    if "#" in path:
+        return re.sub("#+", lambda m: str(frame).rjust(len(m.group(0)), "0"), path)
+    return path + str(frame).rjust(4, "0")
+
+def file_output_paths(frame):
+    # the files the open scene's compositor File Output nodes wrote for a frame, as (name, path)
+    # pairs, named by their path below the node's base path in a directory named after the node
+    outputs = []
+    scene = bpy.context.scene if bpy else None
+
+    if scene and scene.use_nodes and scene.node_tree:
+        for node in scene.node_tree.nodes:
+            if node.type != 'OUTPUT_FILE' or node.mute:
+                continue
+
+            base = bpy.path.abspath(node.base_path)
+            folder = re.sub("[^\w\-. ]", "_", node.name).strip(". ") or "output"
+            if node.format.file_format == 'OPEN_EXR_MULTILAYER':
+                # every slot is a layer of one file, named by the base path
+                root, prefixes = os.path.dirname(base), [ base ]
+            else:
+                root, prefixes = base, [ os.path.join(base, slot.path) for slot in node.file_slots ]
+
+            for prefix in prefixes:
+                path = frame_pattern(prefix, frame)
+                for found in sorted(set(glob.glob(glob.escape(path) + ".*") + ([ path ] if os.path.isfile(path) else []))):
+                    name = "/".join([ folder ] + os.path.relpath(found, root).split(os.sep))
+                    if ".." not in name.split("/"):
+                        outputs.append((name, found))
+
+    return outputs
+
+def output_list_path(path):
+    # beside the frame rendered to path, without its extension
+    return path + ".armb_outputs"
+
+def write_output_list(path, outputs):
+    with open(output_list_path(path), "w", encoding="utf-8") as f:
+        json.dump(outputs, f)
+
+def read_output_list(path):
+    # what a render process listed with write_output_list, or None if it listed nothing
+    try:
+        with open(output_list_path(path), encoding="utf-8") as f:
+            outputs = [ tuple(output) for output in json.load(f) ]
+        os.remove(output_list_path(path))
+        return outputs
+    except (OSError, ValueError):
+        return None
+
 def filename_extension():
-    return bpy.context.scene.render.file_extension or ""
+    if bpy:
+        return bpy.context.scene.render.file_extension or ""
+    return ".png"
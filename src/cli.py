@@ -0,0 +1,295 @@
+# Runs an ARMB worker or supervisor without the Blender UI, as a service or from scripts.
+#
+# Nodes that render need Blender, so start them in background mode with the .blend file:
+#
+#     blender -b scene.blend --python src/cli.py -- worker --port 7210 --output /tmp/armb/ --slots 2
+#     blender -b scene.blend --python src/cli.py -- supervisor --output //frames/ --worker 10.0.0.2:7210
+#
+# A supervisor that only hands out frames and collects them, and a relay, which forwards frames
+# from a supervisor to workers on its own subnet, also run in plain Python from the repository root:
+#
+#     python -m src.cli supervisor --output frames/ --discover --frames 1 250
+#     python -m src.cli relay --port 7210 --output /tmp/relay/ --slots 16 --discover
+#
+# Options can also be read from a JSON file given with --config, e.g. { "port": 7210, "slots": 2 }.
+# Options on the command line take precedence over the file.
+
+import argparse, json, os, sys, time
+
+if __package__ in (None, ""):
+    # run as a script by Blender, so make the repository importable
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.blender import blender
+from src.shared.render_profiles import profile_names
+from src.supervisor.render_job import RenderJob
+from src.supervisor.scheduling import POLICIES, create_policy
+from src.supervisor.supervisor import Supervisor
+from src.worker.render_slot import create_render_slots
+from src.worker.worker import Worker, parse_supervisor_weights
+from src.relay.relay import Relay
+
+def absolute_path(path):
+    if blender.bpy:
+        return blender.bpy.path.abspath(path)
+    return os.path.expanduser(path)
+
+def megabytes(value):
+    return value * 1e6 if value else None
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+def config_arguments(path, actions):
+    # turns { "slots": 2, "announce": true, "worker": ["a:7210"], "frames": [1, 250] } into
+    # command line options; actions maps each option to its argparse action, which tells an
+    # option given once per item, like --worker, from one taking several values, like --frames
+    with open(path) as f:
+        config = json.load(f)
+
+    arguments = []
+    for key, value in config.items():
+        option = "--" + key.replace("_", "-")
+
+        if value is True:
+            arguments.append(option)
+        elif value is False:
+            arguments.append("--no-" + key.replace("_", "-"))
+        elif isinstance(value, list):
+            action = actions.get(option)
+            if action is not None and action.nargs not in (None, "?"):
+                arguments += [ option ] + [ str(item) for item in value ]
+            else:
+                for item in value:
+                    arguments += [ option, str(item) ]
+        elif value is not None:
+            arguments += [ option, str(value) ]
+    return arguments
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog="armb", description="Run a headless ARMB worker or supervisor")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--config", help="read options from this JSON file")
+    common.add_argument("--output", default="/tmp/", help="output directory, or path prefix, for rendered frames")
+    common.add_argument("--timeout", type=float, default=10)
+    common.add_argument("--interval", type=float, default=0.005, help="seconds to sleep between updates")
+    common.add_argument("--metrics", help="periodically write network metrics to this file")
+    common.add_argument("--metrics-format", choices=["json", "prometheus"], default="json")
+    common.add_argument("--trace", help="write a Chrome trace of the session to this file on exit")
+
+    worker = commands.add_parser("worker", parents=[common], help="render frames for a supervisor")
+    worker.add_argument("--port", type=int, default=7210)
+    worker.add_argument("--slots", type=int, default=1, help="how many frames to render at the same time")
+    worker.add_argument("--local-slot", action=argparse.BooleanOptionalAction, default=True, help="render the first slot inside this Blender process")
+    worker.add_argument("--devices", help="comma-separated devices for background slots, e.g. CPU,CUDA:0")
+    worker.add_argument("--threads", type=int, help="threads per background slot")
+    worker.add_argument("--storage-quota", type=float, help="gigabytes of uploaded frames to keep")
+    worker.add_argument("--announce", action=argparse.BooleanOptionalAction, default=True, help="let supervisors on the local network find this worker")
+    worker.add_argument("--max-supervisors", type=int, default=4, help="how many supervisors may share this worker at once")
+    worker.add_argument("--preview-size", type=int, default=160, help="pixels across the preview sent after each frame, 0 for none")
+    worker.add_argument("--local-socket", action=argparse.BooleanOptionalAction, default=True, help="also listen on a Unix domain socket for a supervisor on this computer")
+    worker.add_argument("--weight", action="append", default=[], metavar="HOST=WEIGHT", help="share of render time for the supervisor on this host, relative to the default of 1 (repeatable)")
+
+    supervisor = commands.add_parser("supervisor", parents=[common], help="render a job on workers")
+    supervisor.add_argument("--worker", action="append", default=[], metavar="HOST:PORT", help="connect to this worker (repeatable)")
+    supervisor.add_argument("--discover", action=argparse.BooleanOptionalAction, default=False, help="connect to workers announcing themselves on the local network")
+    supervisor.add_argument("--frames", type=int, nargs=2, metavar=("START", "END"), help="frame range, instead of the scene's")
+    supervisor.add_argument("--profile", choices=profile_names(), help="render profile, instead of the scene's settings")
+    supervisor.add_argument("--shared-output", metavar="PATH", help="have workers render straight into this directory, or path prefix, on storage they all mount at the same path, instead of uploading frames")
+    supervisor.add_argument("--shard-size", type=int, default=0, metavar="FRAMES", help="put every FRAMES frames in a subdirectory of their own, and keep an index of the frames written, for very long sequences")
+    supervisor.add_argument("--resume", action=argparse.BooleanOptionalAction, default=False, help="skip the frames the index says were already written (needs --shard-size)")
+    supervisor.add_argument("--sync-files", action=argparse.BooleanOptionalAction, default=False, help="send the .blend file and its dependencies to workers")
+    supervisor.add_argument("--local-transport", action=argparse.BooleanOptionalAction, default=True, help="reach workers on this computer over Unix domain sockets, and copy their frames instead of receiving them")
+    supervisor.add_argument("--render", action=argparse.BooleanOptionalAction, default=None, help="also render on the supervisor (default: when run in Blender)")
+    supervisor.add_argument("--wait-for-workers", type=int, default=0, help="wait until this many workers are connected before rendering")
+    supervisor.add_argument("--upload-rate", type=float, help="limit uploads from all workers together to this many MB/s")
+    supervisor.add_argument("--worker-upload-rate", type=float, help="limit uploads from each worker to this many MB/s")
+    supervisor.add_argument("--max-uploads", type=int, help="limit how many workers upload at once")
+    supervisor.add_argument("--policy", choices=list(POLICIES), default="speed", help="how frames are shared out between workers")
+    supervisor.add_argument("--calibrate", type=int, default=0, metavar="PERCENT", help="have each worker render a sample frame at this percentage of the resolution first, to learn how fast it is")
+
+    relay = commands.add_parser("relay", parents=[common], help="act as a worker for a supervisor, passing frames on to other workers")
+    relay.add_argument("--port", type=int, default=7210)
+    relay.add_argument("--slots", type=int, default=8, help="how many frames the supervisor may assign at once")
+    relay.add_argument("--worker", action="append", default=[], metavar="HOST:PORT", help="pass frames on to this worker (repeatable)")
+    relay.add_argument("--discover", action=argparse.BooleanOptionalAction, default=False, help="pass frames on to workers announcing themselves on the local network")
+    relay.add_argument("--storage-quota", type=float, help="gigabytes of uploaded frames to keep")
+    relay.add_argument("--announce", action=argparse.BooleanOptionalAction, default=False, help="let supervisors find this relay")
+    relay.add_argument("--announce-to", default="<broadcast>", metavar="HOST", help="announce to this address, e.g. the supervisor on another subnet")
+
+    parser.commands = commands.choices # command -> its parser, for config_arguments
+    return parser
+
+def parse_arguments(argv):
+    parser = create_parser()
+    args = parser.parse_args(argv)
+
+    if args.config:
+        # options from the file go first, so the command line overrides them
+        actions = { option: action for action in parser.commands[args.command]._actions for option in action.option_strings }
+        args = parser.parse_args(argv[:1] + config_arguments(args.config, actions) + argv[1:])
+    return args
+
+def blender_arguments():
+    # Blender passes everything after -- on to the script
+    if "--" in sys.argv:
+        return sys.argv[sys.argv.index("--")+1:]
+    return [] if blender.bpy else sys.argv[1:]
+
+def run_worker(args):
+    if not blender.bpy:
+        sys.exit("Workers render with Blender, run: blender -b FILE.blend --python src/cli.py -- worker ...")
+
+    devices = [ d.strip() for d in args.devices.split(",") if d.strip() ] if args.devices else None
+    quota = int(args.storage_quota * 1e9) if args.storage_quota else None
+    slots = create_render_slots(args.slots, blender.create_render_settings(), args.local_slot, devices, args.threads)
+    try:
+        weights = parse_supervisor_weights(",".join(args.weight))
+    except ValueError:
+        sys.exit(f"Invalid --weight, expected HOST=WEIGHT: {' '.join(args.weight)}")
+    worker = Worker(absolute_path(args.output), args.port, timeout=args.timeout, slots=slots, storage_quota=quota, announce=args.announce, max_supervisors=args.max_supervisors, supervisor_weights=weights, preview_size=args.preview_size, local_socket=args.local_socket)
+
+    worker.start()
+    if args.metrics:
+        worker.enable_metrics_export(absolute_path(args.metrics), args.metrics_format)
+
+    status = None
+    try:
+        while True:
+            if worker.closed and not worker.error():
+                worker.restart()
+            elif worker.ok():
+                worker.update()
+            else:
+                print(worker.status_message())
+                break
+
+            if worker.status_message() != status:
+                status = worker.status_message()
+                print(status)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.trace:
+            worker.export_trace(absolute_path(args.trace))
+        if not worker.closed:
+            worker.stop()
+
+def run_relay(args):
+    quota = int(args.storage_quota * 1e9) if args.storage_quota else None
+    relay = Relay(absolute_path(args.output), args.port, timeout=args.timeout, slots=args.slots, storage_quota=quota, announce=args.announce, announce_address=args.announce_to)
+
+    relay.start()
+    if args.discover:
+        relay.downstream.enable_discovery()
+    if args.metrics:
+        relay.downstream.enable_metrics_export(absolute_path(args.metrics), args.metrics_format)
+    for address in args.worker:
+        relay.downstream.add_worker(*parse_address(address))
+
+    status = None
+    try:
+        while True:
+            if relay.closed and not relay.error():
+                relay.restart()
+            elif relay.ok():
+                relay.update()
+            else:
+                print(relay.status_message())
+                break
+
+            if relay.status_message() != status:
+                status = relay.status_message()
+                print(status)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.trace:
+            relay.downstream.export_trace(absolute_path(args.trace))
+        relay.shutdown()
+
+def create_job(args):
+    job = blender.create_render_job(profile=args.profile)
+
+    if args.frames:
+        job = RenderJob(args.frames[0], args.frames[1], job.settings, job.original_settings)
+    if args.shared_output:
+        path = absolute_path(args.shared_output)
+        # a trailing separator makes it a directory rather than a prefix, and abspath drops it
+        job.settings.shared_output = os.path.abspath(path) + (os.sep if path.endswith(("/", os.sep)) else "")
+    if args.resume and not args.shard_size:
+        sys.exit("--resume needs --shard-size, since only a sharded output has an index")
+    job.settings.shard_size = args.shard_size
+    job.resume = args.resume
+    job.policy = create_policy(args.policy)
+    return job
+
+def run_supervisor(args):
+    supervisor = Supervisor(absolute_path(args.output), timeout=args.timeout, local_transport=args.local_transport)
+    render = args.render if args.render is not None else blender.bpy is not None
+
+    if not render:
+        supervisor.disable_supervisor_rendering()
+    if args.discover:
+        supervisor.enable_discovery()
+    if args.metrics:
+        supervisor.enable_metrics_export(absolute_path(args.metrics), args.metrics_format)
+    for address in args.worker:
+        supervisor.add_worker(*parse_address(address))
+    supervisor.configure_uploads(megabytes(args.upload_rate), megabytes(args.worker_upload_rate), args.max_uploads)
+    supervisor.configure_calibration(args.calibrate)
+
+    job = create_job(args)
+    if args.sync_files:
+        main_file = blender.current_file()
+        if not main_file:
+            sys.exit("--sync-files needs a saved .blend file")
+        job.manifest = supervisor.build_manifest(main_file, blender.collect_dependencies())
+
+    progress = None
+    try:
+        while not supervisor.job or not supervisor.job.uploading_complete():
+            supervisor.update()
+
+            if not supervisor.job and sum(1 for w in supervisor.workers if w.connected()) >= args.wait_for_workers:
+                supervisor.start_job(job)
+
+            if supervisor.job and supervisor.job_progress() != progress:
+                progress = supervisor.job_progress()
+                print(f"{supervisor.job.frames_rendered}/{supervisor.job.frame_count} frames rendered, {supervisor.job.frames_uploaded}/{supervisor.job.frame_count} uploaded")
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        supervisor.stop_job()
+    finally:
+        for worker in supervisor.workers:
+            if not worker.ok():
+                print(f"{worker.name()}: {worker.error_description()}")
+            if worker.health.failures or worker.health.timeouts:
+                print(f"{worker.name()}: {worker.health.failures} frames failed, {worker.health.timeouts} connections lost while rendering")
+            if worker.speed.frame_time is not None:
+                print(f"{worker.name()}: {worker.speed.frame_time:.1f} s per frame, {supervisor.speeds.factor(worker.speed):.2f}x the typical speed")
+        if args.trace:
+            supervisor.export_trace(absolute_path(args.trace))
+        supervisor.stop()
+
+    if job.frames_irretrievable:
+        print(f"{job.frames_irretrievable} frames could not be rendered, {job.frames_failed} of them kept failing")
+        sys.exit(1)
+
+def main(argv=None):
+    args = parse_arguments(blender_arguments() if argv is None else argv)
+
+    if args.command == "worker":
+        run_worker(args)
+    elif args.command == "relay":
+        run_relay(args)
+    else:
+        run_supervisor(args)
+
+if __name__ == "__main__":
+    main()
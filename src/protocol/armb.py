@@ -7,11 +7,19 @@ def first_match_group(rexp, str):
     if match:
         return match.group(1)
 
-def new_identity_message():
-    return bytes(f"IDENTITY {socket.gethostname()}".encode())
+def new_identity_message(slots=1):
+    return bytes(f"IDENTITY {socket.gethostname()} {slots}".encode())
+
+def new_local_identity_message(slots, directory):
+    # to a supervisor on the same computer, with the directory its frames are handed over from
+    return (new_identity_message(slots), directory.encode())
 
 def parse_identity_message(message):
-    return first_match_group("\AIDENTITY ([\w\-.]+)\Z", message)
+    match = re.match("\AIDENTITY ([\w\-.]+)(?: (\d+))?\Z", message)
+
+    if match:
+        return (match.group(1), int(match.group(2) or 1))
+    return (None, 0)
 
 def new_sync_message(settings):
     return (bytes(f"SYNCHRONIZE {settings.synchronization_id}".encode()), bytes(settings.serialize().encode()))
@@ -25,20 +33,25 @@ def new_confirm_sync_message(id):
 def parse_confirm_sync_message(message):
     return first_match_group("\ACONFIRM SYNCHRONIZE (\d+)\Z", message)
 
-def new_request_render_message(frame, max_frame):
-    return bytes(f"RENDER {frame} {max_frame}".encode())
+def new_request_render_message(frame, max_frame, slot=0):
+    return bytes(f"RENDER {frame} {max_frame} {slot}".encode())
 
 def parse_request_render_message(message):
-    match = re.match("RENDER (-?\d+) (-?\d+)", message)
+    match = re.match("RENDER (-?\d+) (-?\d+)(?: (\d+))?", message)
 
     if match:
-        return match.groups()
+        return (match.group(1), match.group(2), match.group(3) or "0")
 
-def new_reject_render_message(frame):
-    return bytes(f"REJECT RENDER {frame}".encode())
+def new_reject_render_message(frame, failed=False):
+    # FAILED when the worker tried the frame and gave up, rather than being unable to take it
+    return bytes((f"REJECT RENDER {frame} FAILED" if failed else f"REJECT RENDER {frame}").encode())
 
 def parse_reject_render_message(message):
-    return first_match_group("REJECT RENDER (-?\d+)", message)
+    match = re.match("REJECT RENDER (-?\d+)( FAILED)?", message)
+
+    if match:
+        return (match.group(1), match.group(2) is not None)
+    return (None, False)
 
 def new_render_complete_message(frame):
     return bytes(f"COMPLETE RENDER {frame}".encode())
@@ -46,9 +59,55 @@ def new_render_complete_message(frame):
 def parse_render_complete_message(message):
     return first_match_group("COMPLETE RENDER (-?\d+)", message)
 
+def new_render_delivered_message(frame, size, digest, extension):
+    # a frame rendered straight into shared storage, which leaves nothing to upload
+    return bytes(f"COMPLETE RENDER {frame} {size} {digest} {extension}".encode())
+
+def parse_render_delivered_message(message):
+    match = re.match("COMPLETE RENDER (-?\d+) (\d+) ([0-9a-f]+) (\S*)", message)
+
+    if match:
+        return match.groups()
+
+def new_preview_message(frame, extension, data):
+    return (bytes(f"PREVIEW {frame} {extension}".encode()), data)
+
+def parse_preview_message(message):
+    match = re.match("PREVIEW (-?\d+) (\S*)", message)
+
+    if match:
+        return match.groups()
+
+def new_calibrate_message(frame, max_frame, percentage):
+    # render a sample frame at a percentage of the job's resolution, to see how fast the worker is
+    return bytes(f"CALIBRATE {frame} {max_frame} {percentage}".encode())
+
+def parse_calibrate_message(message):
+    match = re.match("CALIBRATE (-?\d+) (-?\d+) (\d+)", message)
+
+    if match:
+        return match.groups()
+
+def new_calibration_complete_message(frame, seconds=None):
+    # None when the sample frame could not be rendered
+    return bytes((f"COMPLETE CALIBRATE {frame} {seconds:.3f}" if seconds is not None else f"COMPLETE CALIBRATE {frame} FAILED").encode())
+
+def parse_calibration_complete_message(message):
+    match = re.match("COMPLETE CALIBRATE (-?\d+) (\d+(?:\.\d+)?|FAILED)", message)
+
+    if match:
+        return (match.group(1), None if match.group(2) == "FAILED" else float(match.group(2)))
+
 def new_cancel_task_message():
     return bytes("CANCEL".encode())
 
+def new_cancel_render_message(frame):
+    # one frame only, which another worker finished first; not confirmed, unlike CANCEL
+    return bytes(f"CANCEL RENDER {frame}".encode())
+
+def parse_cancel_render_message(message):
+    return first_match_group("CANCEL RENDER (-?\d+)", message)
+
 def new_confirm_cancelled_message():
     return bytes("CONFIRM CANCEL".encode())
 
@@ -67,14 +126,53 @@ def new_reject_upload_message(frame):
 def parse_reject_upload_message(message):
     return first_match_group("REJECT UPLOAD (-?\d+)", message)
 
-def new_complete_upload_message(frame, extension):
-    return bytes(f"COMPLETE UPLOAD {frame} {extension}".encode())
+# how the data of COMPLETE UPLOAD holds the frame, see frame_bundle: the frame with its other
+# files, or the paths of the files, from a worker on the same computer
+UPLOAD_BUNDLE = "BUNDLE"
+UPLOAD_LOCAL = "LOCAL"
+
+def new_complete_upload_message(frame, extension, mode=None):
+    return bytes((f"COMPLETE UPLOAD {frame} {extension} {mode}" if mode else f"COMPLETE UPLOAD {frame} {extension}").encode())
 
 def parse_complete_upload_message(message):
-    match = re.match("COMPLETE UPLOAD (-?\d+) (\S*)", message) # generated filenames contain no whitespace
+    match = re.match("COMPLETE UPLOAD (-?\d+) (\S*)(?: (BUNDLE|LOCAL))?", message) # generated filenames contain no whitespace
 
     if match:
         return match.groups()
 
+def new_confirm_upload_message(frame):
+    return bytes(f"CONFIRM UPLOAD {frame}".encode())
+
+def parse_confirm_upload_message(message):
+    return first_match_group("CONFIRM UPLOAD (-?\d+)", message)
+
+def new_manifest_message(manifest):
+    return (bytes(f"MANIFEST {manifest.id}".encode()), bytes(manifest.serialize().encode()))
+
+def parse_manifest_message(message):
+    return first_match_group("\AMANIFEST (\w+)\Z", message)
+
+def new_request_blocks_message(manifest_id, hashes):
+    return (bytes(f"REQUEST BLOCKS {manifest_id}".encode()), bytes("\n".join(hashes).encode()))
+
+def parse_request_blocks_message(message):
+    return first_match_group("\AREQUEST BLOCKS (\w+)\Z", message)
+
+def new_blocks_message(manifest_id, data):
+    return (bytes(f"BLOCKS {manifest_id}".encode()), data)
+
+def parse_blocks_message(message):
+    return first_match_group("\ABLOCKS (\w+)\Z", message)
+
+def new_confirm_manifest_message(manifest_id):
+    return bytes(f"CONFIRM MANIFEST {manifest_id}".encode())
+
+def parse_confirm_manifest_message(message):
+    return first_match_group("\ACONFIRM MANIFEST (\w+)\Z", message)
+
+def new_clear_manifest_message():
+    # the job renders the worker's own copy of the project, not the files synchronized before
+    return bytes("CLEAR MANIFEST".encode())
+
 def new_request_cleanup_message():
     return bytes("CLEANUP".encode())
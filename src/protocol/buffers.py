@@ -0,0 +1,42 @@
+class BufferPool:
+    # Hands out reusable bytearrays, rounded up to a power of two, so that receiving the many small
+    # control messages does not allocate. Buffers above max_size are never kept, so a burst of
+    # large uploads does not pin memory.
+    MIN_SIZE = 64
+
+    def __init__(self, max_size=1<<20, max_free=32):
+        self.max_size = max_size
+        self.max_free = max_free
+        self.free = {} # capacity -> [bytearray]
+        self.allocated = 0
+        self.reused = 0
+
+    @staticmethod
+    def capacity(size):
+        return max(BufferPool.MIN_SIZE, 1 << (size - 1).bit_length())
+
+    def acquire(self, size):
+        if size > self.max_size:
+            self.allocated += 1
+            return bytearray(size)
+
+        free = self.free.get(BufferPool.capacity(size))
+        if free:
+            self.reused += 1
+            return free.pop()
+
+        self.allocated += 1
+        return bytearray(BufferPool.capacity(size))
+
+    def release(self, buffer):
+        capacity = len(buffer)
+
+        if capacity <= self.max_size and capacity == BufferPool.capacity(capacity):
+            free = self.free.setdefault(capacity, [])
+            if len(free) < self.max_free:
+                free.append(buffer)
+
+    def pooled(self):
+        return sum(len(b) for free in self.free.values() for b in free)
+
+DEFAULT_POOL = BufferPool()
@@ -1,22 +1,47 @@
 import socket, re, time
 from collections import deque
 from ..shared import utils
+from .metrics import ConnectionMetrics, message_type
+from .buffers import DEFAULT_POOL
+
+# Every frame on the wire starts with a 16 byte header. ARMB frames hold a whole message, with
+# the lengths of its message and data. A message with more data than CHUNK_SIZE is sent as an
+# ARMS frame, with the same lengths but only the message, and then ARMD frames of up to
+# CHUNK_SIZE of its data each, so that other messages can be sent in between.
+HEADER_LENGTH = 16
+HEADER_FORMAT = re.compile(rb"ARM([BSD]) ([a-f0-9]{2}) ([a-f0-9]{8})")
+CHUNK_SIZE = 1 << 18 # a quarter of a millisecond at 10 Gbit/s, 20 ms at 100 Mbit/s
+RECEIVE_BUFFER_SIZE = 1 << 16
+MAX_SEND_SEGMENTS = 48 # well under IOV_MAX on every platform
+MAX_SEND_BYTES = 1 << 18 # about what a socket's send buffer takes at once
+MAX_JOINED_SEND = 1 << 16
 
 class ARMBMessageData:
+    __slots__ = ("start", "end", "header", "message", "data", "all_data", "progress", "outgoing", "type", "buffer", "pool", "chunk_size")
+
     @staticmethod
-    def from_content(message, data):
+    def from_content(message, data, chunk_size=0):
         data = data or bytes(0)
-        header = bytes("ARMB {:02x} {:08x}".format(len(message), len(data)).encode())
-        return ARMBMessageData(memoryview(header), memoryview(message), memoryview(data), 0, True)
+        header = bytes("{} {:02x} {:08x}".format("ARMS" if chunk_size else "ARMB", len(message), len(data)).encode())
+        outgoing = ARMBMessageData(memoryview(header), memoryview(message), memoryview(data), 0, True)
+        outgoing.chunk_size = chunk_size
+        return outgoing
+
+    @staticmethod
+    def from_header(header, pool=DEFAULT_POOL):
+        match = HEADER_FORMAT.match(header, 0, HEADER_LENGTH)
+        if match and match.group(1) == b"B":
+            return ARMBMessageData.for_receiving(int(match.group(2), 16), int(match.group(3), 16), pool)
 
     @staticmethod
-    def from_header(header):
-        match = re.match("ARMB ([a-f0-9]{2}) ([a-f0-9]{8})", header.tobytes().decode())
-        if match:
-            # For efficiency when loading, the message and data are stored in a single buffer
-            msg_len, data_len = int(match.group(1), 16), int(match.group(2), 16)
-            msg_data_view = memoryview(bytearray(msg_len + data_len))
-            return ARMBMessageData(memoryview(header), msg_data_view[:msg_len], msg_data_view[msg_len:], len(header), False, msg_data_view)
+    def for_receiving(msg_len, data_len, pool=DEFAULT_POOL):
+        # For efficiency when loading, the message and data are stored in a single pooled buffer
+        buffer = pool.acquire(msg_len + data_len)
+        msg_data_view = memoryview(buffer)[:msg_len + data_len]
+        message = ARMBMessageData(None, msg_data_view[:msg_len], msg_data_view[msg_len:], HEADER_LENGTH, False, msg_data_view)
+        message.buffer = buffer
+        message.pool = pool
+        return message
 
     def __init__(self, header=None, message=None, data=None, progress=0, outgoing=True, all_data=None):
         self.start = time.time()
@@ -27,6 +52,10 @@ class ARMBMessageData:
         self.all_data = all_data
         self.progress = progress
         self.outgoing = outgoing
+        self.type = None
+        self.buffer = None
+        self.pool = None
+        self.chunk_size = 0
 
     def elapsed(self):
         return self.end - self.start
@@ -35,13 +64,60 @@ class ARMBMessageData:
         return self.progress == self.hmd_len()
 
     def h_len(self):
-        return len(self.header)
+        return len(self.header) if self.header is not None else HEADER_LENGTH
 
     def hm_len(self):
-        return len(self.header) + len(self.message)
+        return self.h_len() + len(self.message)
 
     def hmd_len(self):
-        return len(self.header) + len(self.message) + len(self.data)
+        # for a chunked message being sent, including the headers of its chunks
+        length = self.h_len() + len(self.message) + len(self.data)
+        if self.chunk_size:
+            length += HEADER_LENGTH * -(-len(self.data) // self.chunk_size)
+        return length
+
+    def frame_end(self):
+        # where the frame being sent ends, since other messages can only go between frames
+        if not self.chunk_size:
+            return self.hmd_len()
+        elif self.progress < self.hm_len():
+            return self.hm_len()
+
+        step = HEADER_LENGTH + self.chunk_size
+        chunk = (self.progress - self.hm_len()) // step
+        return min(self.hm_len() + (chunk + 1) * step, self.hmd_len())
+
+    def between_frames(self):
+        return self.progress == 0 or self.progress == self.hmd_len() or (self.chunk_size and (self.progress - self.hm_len()) % (HEADER_LENGTH + self.chunk_size) == 0)
+
+    def remaining(self, offset=None):
+        # the unsent parts of the header, message and data, as they go on the wire
+        offset = self.progress if offset is None else offset
+        for view in (self.header, self.message) if self.chunk_size else (self.header, self.message, self.data):
+            if offset < len(view):
+                yield view[offset:]
+            offset = max(offset - len(view), 0)
+
+        if self.chunk_size:
+            step = HEADER_LENGTH + self.chunk_size
+            first, within = divmod(offset, step)
+            for chunk in range(first, -(-len(self.data) // self.chunk_size)):
+                start = chunk * self.chunk_size
+                size = min(self.chunk_size, len(self.data) - start)
+                if within < HEADER_LENGTH:
+                    yield memoryview(bytes("ARMD 00 {:08x}".format(size).encode()))[within:]
+                yield self.data[start + max(within - HEADER_LENGTH, 0):start + size]
+                within = 0
+
+    def retain(self):
+        # keeps the data valid after the next message is received, e.g. while another thread writes it
+        self.pool = None
+
+    def release(self):
+        if self.pool and self.buffer is not None:
+            self.pool.release(self.buffer)
+        self.pool = None
+        self.buffer = None
 
 class ARMBMessageTimeoutError(Exception):
     def __init__(self, message_data):
@@ -54,32 +130,65 @@ class ARMBMessageFormatError(Exception):
         self.message_data = message_data
 
 class ARMBConnection:
-    def __init__(self, socket, timeout):
+    def __init__(self, socket, timeout, metrics=None, pool=DEFAULT_POOL):
         self.socket = socket
         self.msg_timeout = timeout
         self.error = None
-        self.outgoing = deque()
-        self.incoming = deque()
+        self.outgoing = deque() # control messages, sent whole and ahead of bulk messages
+        self.bulk = deque() # messages with a lot of data, sent in chunks
+        self.bulk_progressed = time.time()
+        self.incoming = deque() # only complete messages
         self.closed = False
+        self.metrics = metrics or ConnectionMetrics()
+        self.last_update = time.time()
+        self.pool = pool
+
+        # received bytes are parsed from read_buffer[read_start:read_end], except that the rest of
+        # a frame too large for the buffer is received straight into its message's buffer, as
+        # partial, up to partial_end
+        self.read_buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self.read_view = memoryview(self.read_buffer)
+        self.read_start = 0
+        self.read_end = 0
+        self.read_started = None
+        self.partial = None
+        self.partial_end = 0
+        self.bulk_incoming = None # a chunked message waiting for more chunks
+        self.last_received = None
+        self.scatter_gather = hasattr(self.socket, "sendmsg") # not on Windows
 
     def ok(self):
         return self.error is None and not self.closed
 
+    def local(self):
+        # over a Unix domain socket, so the other end is on this computer
+        return self.socket.family == getattr(socket, "AF_UNIX", None)
+
     def sending(self):
-        return self.ok() and self.outgoing
+        return self.ok() and (self.outgoing or self.bulk)
 
     def receiving(self):
-        return self.ok() and self.incoming and not self.incoming[-1].complete()
+        return self.ok() and (self.partial is not None or self.bulk_incoming is not None or self.read_start < self.read_end)
 
     def finished_receiving(self):
-        return self.ok() and self.incoming and self.incoming[0].complete()
+        return self.ok() and self.incoming
 
-    def send(self, message, data=None):
-        self.outgoing.append(ARMBMessageData.from_content(message, data))
+    def send(self, message, data=None, bulk=False):
+        # bulk messages wait behind control messages, as large ones do, e.g. for low priority data
+        if data is not None and (bulk or len(data) > CHUNK_SIZE):
+            if not self.bulk:
+                self.bulk_progressed = time.time()
+            self.bulk.append(ARMBMessageData.from_content(message, data, CHUNK_SIZE))
+        else:
+            self.outgoing.append(ARMBMessageData.from_content(message, data))
 
     def receive(self):
+        # the previous message is recycled, so handlers must retain() data they keep
         if self.finished_receiving():
-            return self.incoming.popleft()
+            if self.last_received:
+                self.last_received.release()
+            self.last_received = self.incoming.popleft()
+            return self.last_received
 
     def close(self):
         self.closed = True
@@ -88,25 +197,26 @@ class ARMBConnection:
     def update(self):
         try:
             readable, writeable = utils.socket_status(self.socket)
+            now = time.time()
+            self.metrics.record_queue_depth(len(self.outgoing) + len(self.bulk))
 
             if self.sending():
-                if time.time() - self.outgoing[0].start > self.msg_timeout:
+                # a bulk message may take as long as it needs, as long as it keeps moving
+                if self.outgoing and now - self.outgoing[0].start > self.msg_timeout:
                     self.error = ARMBMessageTimeoutError(self.outgoing)
+                elif self.bulk and now - self.bulk_progressed > self.msg_timeout:
+                    self.error = ARMBMessageTimeoutError(self.bulk)
                 elif writeable:
                     self.__continue_sending()
-                    if self.outgoing[0].complete():
-                        # print(f"{self.outgoing[0].start}: Sent message \"{self.outgoing[0].message.tobytes().decode()}\" in {self.outgoing[0].elapsed()} seconds")
-                        self.outgoing.popleft()
+                else:
+                    self.metrics.record_stall(now - self.last_update)
 
-            if self.receiving() and time.time() - self.incoming[-1].start > self.msg_timeout:
-                self.error = ARMBMessageTimeoutError(self.incoming[-1])
+            self.last_update = now
+
+            if self.receiving() and time.time() - self.read_started > self.msg_timeout:
+                self.error = ARMBMessageTimeoutError(self.partial)
             elif self.ok() and readable:
-                if self.receiving():
-                    self.__continue_receiving()
-                    # if self.incoming[-1].complete():
-                        # print(f"{self.incoming[-1].start}: Received message \"{self.incoming[-1].message.tobytes().decode()}\" in {self.incoming[-1].elapsed()} seconds")
-                else:
-                    self.incoming.append(ARMBMessageData(memoryview(bytearray(16)), memoryview(bytes(0)), memoryview(bytes(0))))
+                self.__continue_receiving()
         except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
             self.error = e
             self.close()
@@ -114,42 +224,161 @@ class ARMBConnection:
             pass # do nothing and hope for the best
 
     def __continue_sending(self):
-        outgoing = self.outgoing[0]
+        # Sends as many queued messages as the socket takes in one call: the rest of a bulk frame
+        # that was cut off, then every control message, then the next chunks of the bulk message.
+        # A control message queued during a large upload so waits for one chunk at most.
+        views = []
+        plan = [] # (message, bytes) in the order they are sent
+        size = 0
+        bulk = self.bulk[0] if self.bulk else None
+        bulk_progress = bulk.progress if bulk else 0
+        bulk_added = 0
 
-        if outgoing.progress < outgoing.h_len():
-            outgoing.progress += self.socket.send(outgoing.header[outgoing.progress:])
+        if bulk and not bulk.between_frames():
+            bulk_added = size = self.__add_views(views, bulk, bulk.frame_end() - bulk.progress)
+            plan.append((bulk, bulk_added))
+        for outgoing in self.outgoing:
+            if len(views) >= MAX_SEND_SEGMENTS or size >= MAX_SEND_BYTES:
+                break
+            added = self.__add_views(views, outgoing, outgoing.hmd_len() - outgoing.progress)
+            plan.append((outgoing, added))
+            size += added
+        if bulk and size < MAX_SEND_BYTES:
+            plan.append((bulk, self.__add_views(views, bulk, MAX_SEND_BYTES - size, bulk.progress + bulk_added)))
 
-        if outgoing.h_len() <= outgoing.progress < outgoing.hm_len():
-            outgoing.progress += self.socket.send(outgoing.message[(outgoing.progress - outgoing.h_len()):])
+        sent = self.__send(views)
+        now = time.time()
 
-        if outgoing.hm_len() <= outgoing.progress < outgoing.hmd_len():
-            outgoing.progress += self.socket.send(outgoing.data[(outgoing.progress - outgoing.hm_len()):])
+        for outgoing, added in plan:
+            if sent <= 0:
+                break
+            progress = min(sent, added)
+            outgoing.progress += progress
+            sent -= progress
 
-        if outgoing.complete():
-            outgoing.end = time.time()
+        if bulk and bulk.progress > bulk_progress:
+            self.bulk_progressed = now
+
+        while self.outgoing and self.outgoing[0].complete():
+            self.__finish_sending(self.outgoing.popleft(), now)
+        if bulk and bulk.complete():
+            self.__finish_sending(self.bulk.popleft(), now)
+
+    def __add_views(self, views, outgoing, limit, offset=None):
+        # adds the unsent parts of a message, from offset, up to limit bytes and MAX_SEND_SEGMENTS in all
+        added = 0
+        for view in outgoing.remaining(offset):
+            if len(views) >= MAX_SEND_SEGMENTS or added >= limit:
+                break
+            view = view[:limit - added]
+            views.append(view)
+            added += len(view)
+        return added
+
+    def __finish_sending(self, outgoing, now):
+        outgoing.end = now
+        self.metrics.record_message("sent", message_type(outgoing.message), outgoing.hmd_len(), outgoing.elapsed())
+
+    def __send(self, views):
+        if self.scatter_gather:
+            sent = self.socket.sendmsg(views)
+        else:
+            # one copy of the small parts is cheaper than a send call, and a packet, per part
+            joined, size = 0, 0
+            while joined < len(views) and size + len(views[joined]) <= MAX_JOINED_SEND:
+                size += len(views[joined])
+                joined += 1
+            sent = self.socket.send(b"".join(views[:joined]) if joined > 1 else views[0])
+        self.metrics.record_send_call(sent)
+        return sent
+
+    def __recv_into(self, view):
+        received = self.socket.recv_into(view)
+        self.metrics.record_recv_call(received)
+        return received
 
     def __continue_receiving(self):
-        incoming = self.incoming[-1]
-        original_progress = incoming.progress
+        if self.partial:
+            partial = self.partial
+            received = self.__recv_into(partial.all_data[(partial.progress - partial.h_len()):(self.partial_end - partial.h_len())])
 
-        if incoming.progress < incoming.h_len():
-            incoming.progress += self.socket.recv_into(incoming.header[incoming.progress:])
+            if received == 0: # EOF
+                self.close()
+            else:
+                partial.progress += received
+                if partial.progress == self.partial_end:
+                    self.__finish_frame(partial)
+            return
 
-            if incoming.progress == incoming.h_len():
-                msg = ARMBMessageData.from_header(incoming.header)
+        # move leftover bytes of an incomplete header to the front, then fill the rest
+        if self.read_start > 0:
+            leftover = self.read_end - self.read_start
+            self.read_view[:leftover] = self.read_view[self.read_start:self.read_end]
+            self.read_start, self.read_end = 0, leftover
 
-                if msg:
-                    # replace the top message
-                    self.incoming.pop()
-                    self.incoming.append(msg)
-                    incoming = msg
-                else:
-                    self.error = ARMBMessageFormatError(incoming)
+        received = self.__recv_into(self.read_view[self.read_end:])
+        if received == 0: # EOF
+            self.close()
+            return
+
+        if self.read_start == self.read_end:
+            self.read_started = time.time()
+        self.read_end += received
+
+        # parse every frame already in the buffer
+        while self.read_end - self.read_start >= HEADER_LENGTH:
+            match = HEADER_FORMAT.match(self.read_buffer, self.read_start, self.read_start + HEADER_LENGTH)
+            header = self.read_view[self.read_start:self.read_start + HEADER_LENGTH]
+            kind = match.group(1) if match else None
+
+            if kind == b"D":
+                # the next chunk of the bulk message's data
+                incoming = self.bulk_incoming
+                frame_end = incoming.progress + int(match.group(3), 16) if incoming else 0
+                if not incoming or frame_end > incoming.hmd_len():
+                    self.error = ARMBMessageFormatError(header.tobytes())
                     return
-        elif incoming.h_len() <= incoming.progress < incoming.hmd_len():
-            incoming.progress += self.socket.recv_into(incoming.all_data[(incoming.progress - incoming.h_len()):])
+            elif kind == b"S" and self.bulk_incoming is None:
+                # a bulk message's header and message, its data follows in chunks
+                incoming = self.bulk_incoming = ARMBMessageData.for_receiving(int(match.group(2), 16), int(match.group(3), 16), self.pool)
+                incoming.start = self.read_started
+                frame_end = incoming.hm_len()
+            elif kind == b"B":
+                incoming = ARMBMessageData.for_receiving(int(match.group(2), 16), int(match.group(3), 16), self.pool)
+                incoming.start = self.read_started
+                frame_end = incoming.hmd_len()
+            else:
+                self.error = ARMBMessageFormatError(header.tobytes())
+                return
+
+            payload_start = self.read_start + HEADER_LENGTH
+            available = min(frame_end - incoming.progress, self.read_end - payload_start)
+            offset = incoming.progress - incoming.h_len()
+            incoming.all_data[offset:offset + available] = self.read_view[payload_start:payload_start + available]
+            incoming.progress += available
+            self.read_start = payload_start + available
+            self.read_started = time.time()
+
+            if incoming.progress == frame_end:
+                self.__finish_frame(incoming)
+            else:
+                self.partial = incoming
+                self.partial_end = frame_end
+                return
 
+        if self.read_start == self.read_end:
+            self.read_start = self.read_end = 0
+
+    def __finish_frame(self, incoming):
+        self.partial = None
         if incoming.complete():
-            incoming.end = time.time()
-        elif incoming.progress == original_progress: # read 0 bytes, EOF
-            self.close()
+            if incoming is self.bulk_incoming:
+                self.bulk_incoming = None
+            self.__finish_receiving(incoming)
+
+    def __finish_receiving(self, incoming):
+        incoming.end = time.time()
+        incoming.type = message_type(incoming.message)
+        self.metrics.record_message("received", incoming.type, incoming.hmd_len(), incoming.elapsed())
+        self.incoming.append(incoming)
+        self.read_started = time.time()
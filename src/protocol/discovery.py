@@ -0,0 +1,59 @@
+import socket, re, time
+
+DISCOVERY_PORT = 7209
+
+def new_announcement(identity, port):
+    return bytes(f"ARMB ANNOUNCE {identity} {port}".encode())
+
+def parse_announcement(message):
+    match = re.match("\AARMB ANNOUNCE ([\w\-.]+) (\d+)\Z", message)
+
+    if match:
+        return (match.group(1), int(match.group(2)))
+
+class Announcer:
+    # Periodically tells supervisors on the local network where this worker is listening
+    def __init__(self, port, address='<broadcast>', discovery_port=DISCOVERY_PORT, interval=2):
+        self.message = new_announcement(socket.gethostname(), port)
+        self.destination = (address, discovery_port)
+        self.interval = interval
+        self.last_announcement = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.socket.setblocking(False)
+
+    def update(self):
+        if time.time() - self.last_announcement > self.interval:
+            self.last_announcement = time.time()
+            try:
+                self.socket.sendto(self.message, self.destination)
+            except OSError as e:
+                pass # no network, try again later
+
+    def close(self):
+        self.socket.close()
+
+class DiscoveryListener:
+    def __init__(self, discovery_port=DISCOVERY_PORT):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setblocking(False)
+        self.socket.bind(("", discovery_port))
+
+    def poll(self):
+        announcements = []
+
+        while True:
+            try:
+                data, (host, _) = self.socket.recvfrom(256)
+            except (BlockingIOError, InterruptedError):
+                return announcements
+            except OSError as e:
+                return announcements
+
+            parsed = parse_announcement(data.decode(errors='replace'))
+            if parsed:
+                announcements.append((parsed[0], host, parsed[1]))
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,110 @@
+import os, socket, stat, struct, tempfile
+from ..shared import utils
+
+# Workers on the same computer as their supervisor, e.g. one for the CPU and one for the GPU,
+# also listen on a Unix domain socket, which the supervisor uses instead of TCP when it finds
+# one for the worker's port. Frames are then handed over by path rather than sent, so both
+# ends must belong to the same user: the sockets are kept in a directory only that user can
+# reach, and the supervisor checks who owns a socket and who is listening on it.
+
+def local_transport_available():
+    return hasattr(socket, "AF_UNIX") and hasattr(os, "getuid")
+
+def private_directory(path):
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 0o077
+
+def local_socket_directory():
+    # the login session's runtime directory, or one of this user's own in the temporary
+    # directory, or None if neither is private
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime and private_directory(runtime):
+        return runtime
+
+    path = os.path.join(tempfile.gettempdir(), f"armb-{os.getuid()}")
+    try:
+        os.mkdir(path, 0o700)
+    except OSError:
+        pass # already there, which private_directory checks
+    return path if private_directory(path) else None
+
+def local_socket_path(port):
+    directory = local_socket_directory()
+    return os.path.join(directory, f"armb-{port}.sock") if directory else None
+
+def owned_socket(path):
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid()
+
+def peer_uid(sock):
+    # the user on the other end of a Unix domain socket, where the platform tells
+    if hasattr(socket, "SO_PEERCRED"):
+        pid, uid, gid = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+        return uid
+
+def is_local_host(host):
+    if host in ("localhost", "127.0.0.1", "::1", socket.gethostname()):
+        return True
+    try:
+        return host == utils.get_local_ip()
+    except OSError:
+        return False
+
+def host_address(host):
+    # the same for every name of a host, e.g. its name and its IP address
+    if is_local_host(host):
+        return "localhost"
+    try:
+        return socket.gethostbyname(host)
+    except OSError:
+        return host
+
+def listen_locally(port):
+    # returns the listening socket, or None when there can't be one
+    path = local_socket_path(port) if local_transport_available() else None
+    if not path:
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        if os.path.exists(path):
+            os.remove(path) # left behind by a worker that didn't shut down
+        sock.bind(path)
+        os.chmod(path, 0o600) # other users' supervisors use TCP
+        sock.setblocking(False)
+        sock.listen()
+        return sock
+    except OSError as e:
+        print("Unable to listen on", path, e)
+        sock.close()
+
+def stop_listening_locally(sock):
+    if sock:
+        path = sock.getsockname()
+        sock.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def connect_locally(port, timeout):
+    # returns a connected socket, or None if no worker of this user is listening locally
+    path = local_socket_path(port) if local_transport_available() else None
+
+    if path and owned_socket(path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(path) # completes at once, unlike TCP
+            if peer_uid(sock) in (None, os.getuid()):
+                return sock
+        except OSError:
+            pass
+        sock.close()
@@ -0,0 +1,213 @@
+import os, re, json, time
+
+TWO_WORD_TYPES = { "CONFIRM", "REJECT", "COMPLETE", "REQUEST" }
+
+def message_type(message):
+    words = bytes(message[:32]).split(b" ", 2)
+
+    if len(words) > 1 and words[0].decode(errors='replace') in TWO_WORD_TYPES:
+        return f"{words[0].decode(errors='replace')} {words[1].decode(errors='replace')}"
+    return words[0].decode(errors='replace')
+
+def metric_name(text):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", text)
+
+class Histogram:
+    # exponential buckets, each twice as wide as the last, starting at 0.1 ms
+    BOUNDS = [ 0.0001 * 2**i for i in range(20) ]
+
+    def __init__(self):
+        self.buckets = [0] * (len(Histogram.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        index = 0
+        while index < len(Histogram.BOUNDS) and value > Histogram.BOUNDS[index]:
+            index += 1
+
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def snapshot(self):
+        return { "count": self.count, "sum": self.total, "max": self.max, "buckets": list(self.buckets) }
+
+class MessageTypeMetrics:
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+    def record(self, size, elapsed):
+        self.messages += 1
+        self.bytes += size
+        self.latency.record(elapsed)
+
+    def merge(self, other):
+        self.messages += other.messages
+        self.bytes += other.bytes
+        self.latency.merge(other.latency)
+
+    def bandwidth(self):
+        return self.bytes / self.latency.total if self.latency.total > 0 else 0.0
+
+    def snapshot(self):
+        return { "messages": self.messages, "bytes": self.bytes, "bandwidth": self.bandwidth(), "latency": self.latency.snapshot() }
+
+class ConnectionMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.send_calls = 0
+        self.recv_calls = 0
+        self.stall_time = 0.0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.types = {} # (direction, type) -> MessageTypeMetrics
+
+    def record_send_call(self, size):
+        self.send_calls += 1
+        self.bytes_sent += size
+
+    def record_recv_call(self, size):
+        self.recv_calls += 1
+        self.bytes_received += size
+
+    def record_queue_depth(self, depth):
+        self.queue_depth = depth
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def record_stall(self, duration):
+        self.stall_time += duration
+
+    def record_message(self, direction, type, size, elapsed):
+        key = (direction, type)
+        if key not in self.types:
+            self.types[key] = MessageTypeMetrics()
+        self.types[key].record(size, elapsed)
+
+    def merge(self, other):
+        self.started = min(self.started, other.started)
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+        self.send_calls += other.send_calls
+        self.recv_calls += other.recv_calls
+        self.stall_time += other.stall_time
+        self.queue_depth += other.queue_depth
+        self.max_queue_depth = max(self.max_queue_depth, other.max_queue_depth)
+
+        for key, metrics in other.types.items():
+            if key not in self.types:
+                self.types[key] = MessageTypeMetrics()
+            self.types[key].merge(metrics)
+
+    def messages(self, direction):
+        return sum(m.messages for (d, _), m in self.types.items() if d == direction)
+
+    def mean_latency(self):
+        latency = Histogram()
+        for m in self.types.values():
+            latency.merge(m.latency)
+        return latency.mean()
+
+    def bandwidth(self):
+        elapsed = time.time() - self.started
+        return (self.bytes_sent + self.bytes_received) / elapsed if elapsed > 0 else 0.0
+
+    def snapshot(self):
+        return {
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "send_calls": self.send_calls,
+            "recv_calls": self.recv_calls,
+            "stall_time": self.stall_time,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "bandwidth": self.bandwidth(),
+            "types": { f"{d} {t}": m.snapshot() for (d, t), m in sorted(self.types.items()) }
+        }
+
+def merge_metrics(metrics):
+    total = ConnectionMetrics()
+    for m in metrics:
+        total.merge(m)
+    return total
+
+def prometheus_labels(**labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+def format_prometheus(connections, extra=None):
+    lines = []
+
+    def metric(name, kind, samples):
+        lines.append(f"# TYPE armb_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"armb_{name}{prometheus_labels(**labels)} {value}")
+
+    metric("bytes_total", "counter", [ ({"connection": c, "direction": d}, getattr(m, f"bytes_{d}")) for c, m in connections.items() for d in ("sent", "received") ])
+    metric("syscalls_total", "counter", [ ({"connection": c, "call": "send"}, m.send_calls) for c, m in connections.items() ] + [ ({"connection": c, "call": "recv"}, m.recv_calls) for c, m in connections.items() ])
+    metric("stall_seconds_total", "counter", [ ({"connection": c}, m.stall_time) for c, m in connections.items() ])
+    metric("queue_depth", "gauge", [ ({"connection": c}, m.queue_depth) for c, m in connections.items() ])
+    metric("messages_total", "counter", [ ({"connection": c, "direction": d, "type": t}, tm.messages) for c, m in connections.items() for (d, t), tm in m.types.items() ])
+    metric("message_bytes_total", "counter", [ ({"connection": c, "direction": d, "type": t}, tm.bytes) for c, m in connections.items() for (d, t), tm in m.types.items() ])
+
+    lines.append("# TYPE armb_message_latency_seconds histogram")
+    for c, m in connections.items():
+        for (d, t), tm in m.types.items():
+            cumulative = 0
+            for bound, n in zip(Histogram.BOUNDS + [ "+Inf" ], tm.latency.buckets):
+                cumulative += n
+                lines.append(f"armb_message_latency_seconds_bucket{prometheus_labels(connection=c, direction=d, type=t, le=bound)} {cumulative}")
+            lines.append(f"armb_message_latency_seconds_sum{prometheus_labels(connection=c, direction=d, type=t)} {tm.latency.total}")
+            lines.append(f"armb_message_latency_seconds_count{prometheus_labels(connection=c, direction=d, type=t)} {tm.latency.count}")
+
+    for name, value in (extra or {}).items():
+        lines.append(f"# TYPE armb_{name} gauge")
+        lines.append(f"armb_{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+def format_json(connections, extra=None):
+    return json.dumps({
+        "timestamp": time.time(),
+        "connections": { c: m.snapshot() for c, m in connections.items() },
+        "total": merge_metrics(connections.values()).snapshot(),
+        "extra": extra or {}
+    }, indent=1)
+
+class MetricsExporter:
+    # Periodically writes metrics to a file, as JSON or in the Prometheus text format
+    def __init__(self, path, format='json', interval=10):
+        self.path = path
+        self.format = format
+        self.interval = interval
+        self.last_export = 0
+
+    def update(self, connections, extra=None):
+        if time.time() - self.last_export > self.interval:
+            self.export(connections, extra)
+
+    def export(self, connections, extra=None):
+        self.last_export = time.time()
+        text = format_prometheus(connections, extra) if self.format == 'prometheus' else format_json(connections, extra)
+
+        try:
+            with open(self.path + ".tmp", "w") as f:
+                f.write(text)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            print("Unable to export metrics:", e)
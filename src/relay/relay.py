@@ -0,0 +1,163 @@
+import os, socket
+from ..worker.worker import Worker
+from ..worker.render_slot import RenderSlot
+from ..supervisor.supervisor import Supervisor
+from ..supervisor.render_job import RenderJob, FrameAssignment
+from ..protocol.discovery import DISCOVERY_PORT
+from ..protocol import armb
+from ..shared import utils
+
+class RelayJob(RenderJob):
+    # A job whose frames arrive one at a time, as the upstream supervisor assigns them
+    def __init__(self, job_id, max_frame, settings):
+        super().__init__(0, max_frame, settings, settings)
+        self.job_id = job_id
+        self.frame_count = 0
+        self.requested = set()
+
+    def add_frame(self, fnum):
+        if fnum < self.frame_start:
+            self.frame_assignments[:0] = [ FrameAssignment(n) for n in range(fnum, self.frame_start) ]
+            self.frame_start = fnum
+        elif fnum > self.frame_end:
+            self.frame_assignments.extend(FrameAssignment(n) for n in range(self.frame_end+1, fnum+1))
+            self.frame_end = fnum
+
+        frame = self.assignment(fnum)
+        if fnum not in self.requested:
+            self.requested.add(fnum)
+            self.frame_count += 1
+        elif frame.irretrievable:
+            # the upstream supervisor is trying again
+            self.reset_frame(frame)
+
+    def withdraw_frame(self, fnum):
+        frame = self.assignment(fnum)
+
+        if fnum in self.requested and not frame.rendered:
+            self.requested.discard(fnum)
+            self.frame_count -= 1
+            self.reset_frame(frame)
+
+    def reset_frame(self, frame):
+        if frame.irretrievable:
+            self.frames_irretrievable -= 1
+            frame.irretrievable = False
+        if frame.failed:
+            self.frames_failed -= 1
+            frame.failed = False
+        frame.failures = 0
+        frame.failed_on.clear()
+        frame.unassign()
+
+    def available(self, frame, worker=None):
+        return frame.frame_number in self.requested and not frame.irretrievable and super().available(frame, worker)
+
+    def progress(self):
+        return super().progress() if self.frame_count else 1
+
+class RelaySlot(RenderSlot):
+    def __init__(self, index, relay):
+        super().__init__(index)
+        self.relay = relay
+        self.frame = None
+
+    def start(self, settings, path, blend_file=None):
+        return self.relay.forward(self, settings)
+
+    def finish(self, result, path=None):
+        self.frame = None
+        self.output_file = path
+        self.result = result
+
+    def cancel(self):
+        if self.frame is not None:
+            self.relay.withdraw(self)
+            self.finish(RenderSlot.RESULT_CANCELLED)
+
+    def description(self):
+        return f"Slot {self.index} (relayed)"
+
+class Relay(Worker):
+    # Looks like a worker with many slots to its supervisor, and like a supervisor to its own
+    # workers, so a farm can grow as a tree: frames are passed down, rendered frames are
+    # collected here and then uploaded up, and synchronized files are passed on.
+    def __init__(self, output_dir, port, timeout=10, slots=8, storage_quota=None, announce=False, announce_address='<broadcast>', discovery_port=DISCOVERY_PORT):
+        # one supervisor at a time, since the downstream supervisor renders one job at a time
+        super().__init__(output_dir, port, timeout, [ RelaySlot(i, self) for i in range(slots) ], storage_quota, announce, announce_address, discovery_port, max_supervisors=1)
+        self.downstream = Supervisor(output_dir, timeout)
+        self.downstream.disable_supervisor_rendering()
+        self.downstream.ignore_announcements(socket.gethostname(), port)
+        self.job = None
+
+    def forward(self, slot, settings):
+        upstream = slot.task.owner
+        if not self.job or self.job.job_id != upstream.job_id:
+            self.start_job(upstream, slot.task.max_frame, settings)
+
+        slot.frame = slot.task.frame
+        self.job.add_frame(slot.frame)
+        return True
+
+    def withdraw(self, slot):
+        if self.job:
+            self.job.withdraw_frame(slot.frame)
+        slot.frame = None
+
+        if not any(s.frame is not None for s in self.slots):
+            self.downstream.stop_job()
+            self.job = None
+
+    def start_job(self, upstream, max_frame, settings):
+        self.downstream.stop_job()
+        self.job = RelayJob(upstream.job_id, max_frame, settings)
+
+        if upstream.project_file and upstream.project_manifest:
+            root = os.path.dirname(upstream.project_file)
+            files = [ os.path.join(root, *entry.path.split("/")) for entry in upstream.project_manifest.files ]
+            self.job.manifest = self.downstream.build_manifest(upstream.project_file, files)
+        self.downstream.start_job(self.job)
+
+    def update(self):
+        super().update()
+        self.downstream.update()
+
+        for slot in self.slots:
+            if slot.frame is not None and self.job:
+                frame = self.job.assignment(slot.frame)
+
+                if frame.uploaded:
+                    slot.finish(RenderSlot.RESULT_FINISHED, frame.path)
+                    slot.output_digest = frame.digest # no need to read a shared frame again
+                elif frame.irretrievable:
+                    slot.finish(RenderSlot.RESULT_CANCELLED)
+
+    def frame_outputs(self, supervisor, frame, path):
+        # the other files the worker uploaded with the frame, passed on in turn
+        assignment = self.job.assignment(frame) if self.job else None
+        return assignment.outputs if assignment else []
+
+    def frame_preview(self, frame, path):
+        # passed on from the worker that rendered it, if it has arrived yet
+        return self.downstream.previews.get(frame)
+
+    def handle_calibrate_message(self, supervisor, message, msg_str):
+        # a relay is as fast as the workers behind it, which only the frames it passes on show
+        try:
+            frame_str, max_frame_str, percentage_str = armb.parse_calibrate_message(msg_str)
+            supervisor.connection.send(armb.new_calibration_complete_message(int(frame_str)))
+        except (ValueError, TypeError) as e:
+            supervisor.err = utils.BadMessageError("Unable to parse CALIBRATE message", message)
+
+    def handle_cleanup_message(self, supervisor):
+        super().handle_cleanup_message(supervisor)
+        self.downstream.clean_workers()
+
+    def shutdown(self):
+        if not self.closed:
+            self.stop()
+        self.downstream.stop()
+
+    def status_message(self):
+        connected = sum(1 for worker in self.downstream.workers if worker.connected())
+        return f"{super().status_message()} ({connected} of {len(self.downstream.workers)} workers connected)"
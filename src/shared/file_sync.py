@@ -0,0 +1,198 @@
+import os, json, hashlib, struct
+
+BLOCK_SIZE = 1 << 16
+
+def block_hash(data):
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+class FileEntry:
+    def __init__(self, path, size, mtime, blocks):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.blocks = blocks
+
+    def serialize(self):
+        return { "path": self.path, "size": self.size, "mtime": self.mtime, "blocks": self.blocks }
+
+class FileManifest:
+    # Describes the .blend file and its dependencies as lists of block hashes. Paths are
+    # relative to the directory of the .blend file and always use forward slashes.
+    @staticmethod
+    def deserialize(serialized):
+        data = json.loads(serialized)
+        files = [ FileEntry(f["path"], f["size"], f["mtime"], f["blocks"]) for f in data["files"] ]
+        return FileManifest(data["main"], files)
+
+    def __init__(self, main_file, files):
+        self.main_file = main_file
+        self.files = files
+        self.serialized = json.dumps({ "main": main_file, "files": [ f.serialize() for f in files ] }, sort_keys=True)
+        self.id = block_hash(self.serialized.encode())[:16]
+        self.locations = {}
+
+    def serialize(self):
+        return self.serialized
+
+    def block_sizes(self):
+        sizes = {}
+
+        for entry in self.files:
+            for i, h in enumerate(entry.blocks):
+                sizes[h] = min(BLOCK_SIZE, entry.size - i*BLOCK_SIZE)
+        return sizes
+
+    def total_size(self):
+        return sum(entry.size for entry in self.files)
+
+    def read_block(self, h):
+        path, offset, length = self.locations[h]
+
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+class ManifestBuilder:
+    # Hashing large caches is slow, so unchanged files reuse the hashes from the previous job
+    def __init__(self):
+        self.hash_cache = {}
+
+    def file_blocks(self, path, size, mtime):
+        cached = self.hash_cache.get(path)
+        if cached and cached[0] == (size, mtime):
+            return cached[1]
+
+        blocks = []
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(BLOCK_SIZE)
+                if not data:
+                    break
+                blocks.append(block_hash(data))
+
+        self.hash_cache[path] = ((size, mtime), blocks)
+        return blocks
+
+    def build(self, main_file, dependencies):
+        root = os.path.dirname(os.path.abspath(main_file))
+        paths = []
+
+        for path in [ main_file ] + list(dependencies):
+            path = os.path.abspath(path)
+            if os.path.isdir(path):
+                for directory, subdirs, names in os.walk(path):
+                    paths.extend(os.path.join(directory, name) for name in sorted(names))
+            elif os.path.isfile(path):
+                paths.append(path)
+
+        files = []
+        locations = {}
+        seen = set()
+
+        for path in paths:
+            relative = os.path.relpath(path, root)
+            if relative.startswith(os.pardir) or os.path.isabs(relative):
+                print("Not synchronizing file outside of the project directory:", path)
+                continue
+            elif relative in seen:
+                continue
+
+            seen.add(relative)
+            stat = os.stat(path)
+            blocks = self.file_blocks(path, stat.st_size, stat.st_mtime)
+            files.append(FileEntry(relative.replace(os.sep, "/"), stat.st_size, stat.st_mtime, blocks))
+
+            for i, h in enumerate(blocks):
+                locations[h] = (path, i*BLOCK_SIZE, min(BLOCK_SIZE, stat.st_size - i*BLOCK_SIZE))
+
+        manifest = FileManifest(os.path.relpath(os.path.abspath(main_file), root).replace(os.sep, "/"), files)
+        manifest.locations = locations
+        return manifest
+
+def pack_blocks(blocks):
+    return b"".join(struct.pack("!I", len(data)) + data for data in blocks)
+
+def unpack_blocks(data):
+    blocks = []
+    offset = 0
+
+    while offset + 4 <= len(data):
+        length, = struct.unpack_from("!I", data, offset)
+        blocks.append(bytes(data[offset+4:offset+4+length]))
+        offset += 4 + length
+    return blocks
+
+class BlockStore:
+    # Content-addressed cache of blocks on the worker, shared between every synchronized project
+    STATE_NAME = ".armb_sync_state.json"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.block_dir = os.path.join(directory, "blocks")
+        self.project_dir = os.path.join(directory, "project")
+
+    def block_path(self, h):
+        return os.path.join(self.block_dir, h[:2], h)
+
+    def has(self, h):
+        return os.path.exists(self.block_path(h))
+
+    def put(self, h, data):
+        if block_hash(data) != h:
+            return False
+
+        path = self.block_path(h)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".part", "wb") as f:
+            f.write(data)
+        os.replace(path + ".part", path)
+        return True
+
+    def missing(self, manifest):
+        missing = []
+        seen = set()
+
+        for entry in manifest.files:
+            for h in entry.blocks:
+                if h not in seen:
+                    seen.add(h)
+                    if not self.has(h):
+                        missing.append(h)
+        return missing
+
+    def load_state(self, project_dir):
+        try:
+            with open(os.path.join(project_dir, BlockStore.STATE_NAME), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def materialize(self, manifest, project_dir=None):
+        project_dir = project_dir or self.project_dir
+        os.makedirs(project_dir, exist_ok=True)
+        state = self.load_state(project_dir)
+        new_state = {}
+
+        for entry in manifest.files:
+            parts = entry.path.split("/")
+            if os.pardir in parts or os.path.isabs(entry.path):
+                continue
+
+            target = os.path.join(project_dir, *parts)
+            new_state[entry.path] = entry.blocks
+
+            if state.get(entry.path) == entry.blocks and os.path.exists(target) and os.path.getsize(target) == entry.size:
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target + ".part", "wb") as out:
+                for h in entry.blocks:
+                    with open(self.block_path(h), "rb") as block:
+                        out.write(block.read())
+            os.replace(target + ".part", target)
+            os.utime(target, (entry.mtime, entry.mtime))
+
+        with open(os.path.join(project_dir, BlockStore.STATE_NAME), "w") as f:
+            json.dump(new_state, f)
+
+        return os.path.join(project_dir, *manifest.main_file.split("/"))
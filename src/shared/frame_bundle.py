@@ -0,0 +1,83 @@
+import os, json, struct
+
+# A rendered frame as a set of files: the main image, named "", and whatever else the render
+# wrote for that frame, such as the passes of compositor File Output nodes, named by relative
+# paths. All of them travel in one message, laid out as
+#
+#     header length (4 bytes) | header: JSON [[name, size], ...] | the files, one after another
+#
+# and the supervisor stores the other files under their names beside the frame. A worker on the
+# same computer sends only JSON [[name, path], ...] instead, and the supervisor copies the files.
+
+def safe_name(name):
+    # names come from workers, so they must not reach outside the output directory
+    parts = name.split("/")
+    return bool(name) and "\\" not in name and ":" not in name and all(part not in ("", ".", "..") for part in parts)
+
+def pack_bundle(files):
+    # files are (name, path) pairs, the main image first; read straight into one buffer, since
+    # frames with many passes can be large
+    sizes = [ os.path.getsize(path) for name, path in files ]
+    header = json.dumps([ [name, size] for (name, path), size in zip(files, sizes) ]).encode()
+    data = bytearray(4 + len(header) + sum(sizes))
+    view = memoryview(data)
+
+    struct.pack_into("!I", data, 0, len(header))
+    view[4:4+len(header)] = header
+    offset = 4 + len(header)
+
+    for (name, path), size in zip(files, sizes):
+        with open(path, "rb") as f:
+            if f.readinto(view[offset:offset+size]) != size:
+                raise OSError(f"{path} changed while it was read")
+        offset += size
+    return data
+
+def check_names(names):
+    for i, name in enumerate(names):
+        if not isinstance(name, str) or (i == 0) != (name == "") or (i > 0 and not safe_name(name)):
+            raise ValueError(f"Bad bundle entry {name!r}")
+
+def pack_paths(files):
+    return json.dumps([ [name, os.path.abspath(path)] for name, path in files ]).encode()
+
+def inside(path, directory):
+    return os.path.commonpath([ path, directory ]) == directory
+
+def unpack_paths(data, directory):
+    # returns (name, path) pairs, the main image first, or raises ValueError. Only regular files
+    # inside directory, the worker's output directory, are accepted, so a worker can't have the
+    # supervisor copy any other file it can read.
+    files = [ (name, path) for name, path in json.loads(bytes(data).decode()) ]
+    check_names([ name for name, path in files ])
+
+    if not files or not all(isinstance(path, str) and os.path.isabs(path) for name, path in files):
+        raise ValueError("Bundle paths must be absolute")
+
+    directory = os.path.realpath(directory)
+    files = [ (name, os.path.realpath(path)) for name, path in files ]
+    for name, path in files:
+        if not inside(path, directory) or not os.path.isfile(path):
+            raise ValueError(f"{path} is not a file in the worker's output directory")
+    return files
+
+def unpack_bundle(data):
+    # returns (name, data) pairs, the main image first, or raises ValueError
+    if len(data) < 4:
+        raise ValueError("Bundle too short")
+
+    header_length, = struct.unpack_from("!I", data, 0)
+    entries = json.loads(bytes(data[4:4+header_length]).decode())
+    offset = 4 + header_length
+    files = []
+
+    check_names([ name for name, size in entries ])
+    for name, size in entries:
+        if size < 0:
+            raise ValueError(f"Bad bundle entry {name!r}")
+        files.append((name, data[offset:offset+size]))
+        offset += size
+
+    if not files or offset != len(data):
+        raise ValueError("Bundle size does not match its header")
+    return files
@@ -0,0 +1,43 @@
+# Named quality presets that the supervisor pushes to every worker. Options that a
+# profile leaves out keep the value saved in each worker's .blend file.
+RENDER_PROFILES = {
+    'DRAFT': {
+        "percentage": 50,
+        "samples": 32,
+        "adaptive_threshold": 0.1,
+        "use_denoising": True,
+        "denoiser": 'OPENIMAGEDENOISE',
+        "max_bounces": 4,
+        "use_motion_blur": False,
+        "use_simplify": True,
+        "simplify_subdivision": 1
+    },
+    'REVIEW': {
+        "percentage": 100,
+        "samples": 128,
+        "adaptive_threshold": 0.05,
+        "use_denoising": True,
+        "denoiser": 'OPENIMAGEDENOISE',
+        "max_bounces": 8,
+        "use_simplify": True,
+        "simplify_subdivision": 3
+    },
+    'FINAL': {
+        "percentage": 100,
+        "use_simplify": False
+    }
+}
+
+PROFILE_OPTIONS = (
+    "samples",
+    "adaptive_threshold",
+    "use_denoising",
+    "denoiser",
+    "max_bounces",
+    "use_motion_blur",
+    "use_simplify",
+    "simplify_subdivision"
+)
+
+def profile_names():
+    return list(RENDER_PROFILES.keys())
@@ -1,4 +1,15 @@
 import random, re
+from urllib.parse import quote, unquote
+from .render_profiles import RENDER_PROFILES, PROFILE_OPTIONS
+
+def parse_value(val):
+    if re.match("\A-?\d+\Z", val):
+        return int(val)
+    elif re.match("\A-?\d*\.?\d+(e-?\d+)?\Z", val):
+        return float(val)
+    elif val in { "True", "False" }:
+        return val == "True"
+    return val
 
 class RenderSettings:
     @staticmethod
@@ -7,26 +18,48 @@ class RenderSettings:
             "resolution_x": 1000,
             "resolution_y": 1000,
             "percentage": 100,
-            "display_mode": 'AREA'
+            "display_mode": 'AREA',
+            "profile": None,
+            "shared_output": None,
+            "shard_size": 0
         }
+        options = {}
 
         for prop in serialized.split(","):
-            m = re.match("(\w+)=(\w+)", prop)
+            m = re.match("(\w+)=([\w.\-%]+)", prop)
             if m:
                 name, val = m.groups()
-                if val.isnumeric():
-                    val = int(val)
-                props[name] = val
+                if name == "shared_output":
+                    props[name] = unquote(val)
+                elif name in PROFILE_OPTIONS:
+                    options[name] = parse_value(val)
+                else:
+                    props[name] = parse_value(val)
 
-        return RenderSettings(props["resolution_x"], props["resolution_y"], props["percentage"], props["display_mode"])
+        settings = RenderSettings(props["resolution_x"], props["resolution_y"], props["percentage"], props["display_mode"], props["profile"], options)
+        settings.shared_output = props["shared_output"]
+        settings.shard_size = props["shard_size"]
+        return settings
 
-    def __init__(self, res_x, res_y, percent, display_mode):
+    def __init__(self, res_x, res_y, percent, display_mode, profile=None, options=None):
         self.resolution_x = res_x
         self.resolution_y = res_y
         self.percentage = percent
         self.display_mode = display_mode
+        self.profile = profile
+        self.options = options or {}
+        self.shared_output = None # a directory, or path prefix, that every worker writes frames to
+        self.shard_size = 0 # frames per subdirectory of the output, 0 for all in one
         self.synchronization_id = random.getrandbits(32)
 
+    def apply_profile(self, name):
+        profile = RENDER_PROFILES.get(name)
+
+        if profile:
+            self.profile = name
+            self.percentage = profile.get("percentage", self.percentage)
+            self.options.update({ k: v for k, v in profile.items() if k in PROFILE_OPTIONS })
+
     def serialize(self):
         data = [
             ("resolution_x", self.resolution_x),
@@ -35,4 +68,13 @@ class RenderSettings:
             ("display_mode", self.display_mode)
         ]
 
+        if self.profile:
+            data.append(("profile", self.profile))
+        if self.shared_output:
+            # quoted so that separators and spaces survive
+            data.append(("shared_output", quote(self.shared_output, safe="")))
+        if self.shard_size:
+            data.append(("shard_size", self.shard_size))
+        data.extend(sorted(self.options.items()))
+
         return ",".join(map(lambda x: "{}={}".format(*x), data))
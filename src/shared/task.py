@@ -1,10 +1,12 @@
 class RenderTask:
-    def __init__(self, frame, max_frame):
+    def __init__(self, frame, max_frame, owner=None):
         self.frame = frame
         self.max_frame = max_frame
+        self.owner = owner
         self.started = False
         self.remote_cancelled = False
         self.attempts = 0
+        self.calibration = 0 # a percentage of the job's resolution, for a sample frame that only measures speed
 
     def record_failed_attempt(self):
         self.attempts += 1
@@ -0,0 +1,119 @@
+import time, json
+from collections import deque
+
+class TraceEvent:
+    def __init__(self, track, name, category, start, end=None, args=None):
+        self.track = track
+        self.name = name
+        self.category = category
+        self.start = start
+        self.end = end
+        self.args = args or {}
+
+    def instant(self):
+        return self.end is None
+
+class Tracer:
+    # Records spans and instants on named tracks, grouped by node, and exports them in the
+    # Chrome trace format, which chrome://tracing and ui.perfetto.dev both read
+    BUSY_CATEGORIES = { "render", "upload", "sync" }
+
+    def __init__(self, process_name="ARMB", max_events=200000):
+        self.process_name = process_name
+        self.started = time.time()
+        self.events = deque(maxlen=max_events)
+        self.open_spans = {}
+        self.tracks = {} # track -> (tid, group)
+
+    def track(self, track, group=None):
+        if track not in self.tracks:
+            self.tracks[track] = (len(self.tracks) + 1, group or track)
+        return track
+
+    def begin(self, track, name, category, group=None, **args):
+        self.track(track, group)
+        self.open_spans[(track, name)] = TraceEvent(track, name, category, time.time(), args=args)
+
+    def end(self, track, name, **args):
+        span = self.open_spans.pop((track, name), None)
+
+        if span:
+            span.end = time.time()
+            span.args.update(args)
+            self.events.append(span)
+
+    def end_all(self, track):
+        for key in [ k for k in self.open_spans if k[0] == track ]:
+            self.end(*key)
+
+    def instant(self, track, name, category, group=None, **args):
+        self.track(track, group)
+        self.events.append(TraceEvent(track, name, category, time.time(), args=args))
+
+    def all_events(self):
+        # spans still in progress are reported up to now
+        now = time.time()
+        pending = [ TraceEvent(e.track, e.name, e.category, e.start, now, dict(e.args, unfinished=True)) for e in self.open_spans.values() ]
+        return list(self.events) + pending
+
+    def chrome_trace(self):
+        events = [ { "ph": "M", "name": "process_name", "pid": 1, "tid": 0, "args": { "name": self.process_name } } ]
+
+        for track, (tid, group) in self.tracks.items():
+            events.append({ "ph": "M", "name": "thread_name", "pid": 1, "tid": tid, "args": { "name": track } })
+
+        for e in self.all_events():
+            event = { "name": e.name, "cat": e.category, "pid": 1, "tid": self.tracks[e.track][0], "ts": (e.start - self.started) * 1e6, "args": e.args }
+
+            if e.instant():
+                event.update({ "ph": "i", "s": "t" })
+            else:
+                event.update({ "ph": "X", "dur": (e.end - e.start) * 1e6 })
+            events.append(event)
+
+        return { "traceEvents": events, "displayTimeUnit": "ms" }
+
+    def export_chrome(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def utilization(self):
+        # busy time is the union of render, upload and sync spans over every track of a group
+        now = time.time()
+        intervals = {}
+        first_seen = {}
+
+        for e in self.all_events():
+            if e.instant():
+                continue
+
+            group = self.tracks[e.track][1]
+            intervals.setdefault(group, [])
+            first_seen[group] = min(first_seen.get(group, now), e.start)
+
+            if e.category in Tracer.BUSY_CATEGORIES:
+                intervals[group].append((e.start, e.end, e.category))
+
+        summary = {}
+        for group, spans in intervals.items():
+            total = now - first_seen[group]
+            busy = 0.0
+            current_start, current_end = None, None
+
+            for start, end, category in sorted(spans):
+                if current_end is None or start > current_end:
+                    if current_end is not None:
+                        busy += current_end - current_start
+                    current_start, current_end = start, end
+                else:
+                    current_end = max(current_end, end)
+            if current_end is not None:
+                busy += current_end - current_start
+
+            by_category = {}
+            for start, end, category in spans:
+                by_category[category] = by_category.get(category, 0.0) + end - start
+
+            summary[group] = dict(by_category, busy=busy, idle=max(total - busy, 0.0), utilization=busy / total if total > 0 else 0.0)
+
+        return summary
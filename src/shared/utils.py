@@ -1,4 +1,4 @@
-import socket, select, glob, os, math
+import os, socket, select, math, hashlib
 
 def socket_status(socket):
     read, write, err = select.select([socket], [socket], [], 0)
@@ -9,15 +9,6 @@ class BadMessageError(Exception):
         self.message = description
         self.message_data = message
 
-def delete_rendered_images(path, extension):
-    # removes all files starting with a number, ending with the extension
-    for file in glob.glob(f"{path}[0-9]*{extension}"):
-        os.remove(file)
-
-    directory, prefix = os.path.split(path)
-    if not os.listdir(directory):
-        os.rmdir(directory)
-
 def get_local_ip():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     ip = None
@@ -30,6 +21,20 @@ def get_local_ip():
 
     return ip
 
-def filename_for_frame(frame, max_frame, extension, directory):
+def filename_for_frame(frame, max_frame, extension, directory, shard_size=0):
     digits_necessary = int(math.log10(abs(max_frame)))+1
+
+    if shard_size:
+        # every shard_size frames in a directory of their own, named after the first of them
+        head, tail = os.path.split(directory)
+        shard = str(frame - frame % shard_size).rjust(digits_necessary, '0')
+        directory = os.path.join(head, shard, tail)
     return f"{directory}{str(frame).rjust(digits_necessary, '0')}{extension}"
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
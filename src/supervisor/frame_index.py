@@ -0,0 +1,84 @@
+import os
+
+class FrameIndex:
+    # The frames of a sequence written so far, with their paths, sizes and hashes, so that a huge
+    # sequence needs no directory listings to tell which frames exist. Kept beside the frames as
+    # one line per frame written,
+    #
+    #     frame <tab> size <tab> sha256, or - if unknown <tab> path relative to the index
+    #
+    # appended as frames arrive; a later line for a frame replaces an earlier one, and the index
+    # is rewritten without the replaced lines when it is opened.
+    NAME = ".armb_index"
+
+    def __init__(self, prefix):
+        # e.g. /renders/.armb_index, or /renders/shot_.armb_index for a path prefix
+        self.path = prefix + FrameIndex.NAME
+        self.directory = os.path.dirname(self.path)
+        self.entries = {} # frame -> (path relative to the index, size, digest or "-"), as stored
+        self.load()
+
+    def load(self):
+        lines = 0
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                # kept as read until asked for, since there may be hundreds of thousands
+                for line in f:
+                    lines += 1
+                    try:
+                        frame, size, digest, path = line[:-1].split("\t")
+                        if line.endswith("\n"):
+                            self.entries[int(frame)] = (path, int(size), digest)
+                    except ValueError:
+                        pass
+        except OSError:
+            return
+
+        # a line cut short when the supervisor stopped is dropped here too
+        if lines > len(self.entries):
+            self.compact()
+
+    def relative_path(self, path):
+        try:
+            return os.path.relpath(path, self.directory)
+        except ValueError:
+            return path # on another drive
+
+    def record(self, frame, path, size=None, digest=None):
+        try:
+            size = os.path.getsize(path) if size is None else size
+            if self.directory:
+                os.makedirs(self.directory, exist_ok=True)
+            entry = (self.relative_path(path), size, digest or "-")
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(self.line(frame, entry))
+            self.entries[frame] = entry
+        except OSError as e:
+            print("Unable to add frame", frame, "to", self.path, e)
+
+    def compact(self):
+        try:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.writelines(self.line(frame, entry) for frame, entry in sorted(self.entries.items()))
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print("Unable to rewrite", self.path, e)
+
+    def line(self, frame, entry):
+        path, size, digest = entry
+        return f"{frame}\t{size}\t{digest}\t{path}\n"
+
+    def find(self, frame):
+        # the frame's (path, size, digest), digest None if unknown, or None if it wasn't written
+        entry = self.entries.get(frame)
+        if entry:
+            path, size, digest = entry
+            return (os.path.join(self.directory, path), size, None if digest == "-" else digest)
+
+    def __contains__(self, frame):
+        return frame in self.entries
+
+    def __len__(self):
+        return len(self.entries)
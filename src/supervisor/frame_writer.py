@@ -0,0 +1,113 @@
+import os, time, shutil, threading, queue, hashlib
+from collections import deque
+from ..shared import utils
+
+class FrameWrite:
+    def __init__(self, worker, job, frame, path, data, outputs=None):
+        self.worker = worker
+        self.job = job
+        self.frame = frame
+        self.path = path
+        self.data = data
+        self.outputs = outputs or [] # the frame's other files, as (name, path, data)
+        # data may also be the path of a file to copy, from a worker on this computer
+        self.submitted = time.time()
+        self.completed = None
+        self.error = None
+        self.digest = None # the frame's size and hash, for a job that keeps an index
+
+    def latency(self):
+        return self.completed - self.submitted
+
+    def perform(self):
+        try:
+            # the main image last, so that once it exists the whole frame does
+            for name, path, data in self.outputs:
+                self.write_file(path, data)
+            self.write_file(self.path, self.data)
+
+            if self.job.index is not None:
+                # here rather than in the supervisor's own thread, while the data is at hand
+                copied = isinstance(self.data, str)
+                self.digest = (os.path.getsize(self.path), utils.file_digest(self.path) if copied else hashlib.sha256(self.data).hexdigest())
+        except OSError as e:
+            self.error = e
+        finally:
+            self.data = None
+            self.outputs = [ (name, path, None) for name, path, data in self.outputs ]
+            self.completed = time.time()
+
+    def write_file(self, path, data):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        # write beside the final path and rename, so a frame is never half-written
+        temp_path = path + ".part"
+        if isinstance(data, str):
+            shutil.copyfile(data, temp_path) # within the kernel, where the platform allows
+            with open(temp_path, 'rb+') as f:
+                os.fsync(f.fileno())
+        else:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+class FrameWriterPool:
+    def __init__(self, thread_count=2, max_pending=8):
+        self.max_pending = max_pending
+        self.pending = 0
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.latencies = deque(maxlen=100)
+        self.threads = [ threading.Thread(target=self.run, daemon=True) for _ in range(thread_count) ]
+
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while True:
+            write = self.requests.get()
+            if write is None:
+                break
+            write.perform()
+            self.results.put(write)
+
+    def full(self):
+        return self.pending >= self.max_pending
+
+    def queue_depth(self):
+        return self.pending
+
+    def submit(self, write):
+        self.pending += 1
+        self.requests.put(write)
+
+    def completed(self):
+        finished = []
+
+        while True:
+            try:
+                write = self.results.get_nowait()
+            except queue.Empty:
+                return finished
+
+            self.pending -= 1
+            self.latencies.append(write.latency())
+            finished.append(write)
+
+    def average_latency(self):
+        if self.latencies:
+            return sum(self.latencies) / len(self.latencies)
+        return 0.0
+
+    def max_latency(self):
+        return max(self.latencies, default=0.0)
+
+    def stop(self):
+        for thread in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
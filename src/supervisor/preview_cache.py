@@ -0,0 +1,52 @@
+import os, shutil, tempfile
+
+class PreviewCache:
+    # Small previews of the frames of the current job, which workers send as soon as a frame is
+    # rendered, long before it is uploaded, so that a broken shot shows up in the first minutes.
+    # They are kept in memory, and written to a temporary directory when something, such as the
+    # UI, needs them as files.
+    def __init__(self):
+        self.previews = {} # frame -> (data, extension)
+        self.generation = 0 # changes whenever the cache is cleared, so stale files are not reused
+        self.directory = None
+        self.received_bytes = 0
+
+    def add(self, frame, data, extension=".jpg"):
+        self.previews[frame] = (bytes(data), extension)
+        self.received_bytes += len(data)
+
+    def get(self, frame):
+        preview = self.previews.get(frame)
+        return preview[0] if preview else None
+
+    def frames(self):
+        return sorted(self.previews)
+
+    def key(self, frame):
+        return f"{self.generation}_{frame}"
+
+    def path(self, frame):
+        if frame in self.previews:
+            data, extension = self.previews[frame]
+            if not self.directory:
+                self.directory = tempfile.mkdtemp(prefix="armb-previews-")
+
+            path = os.path.join(self.directory, self.key(frame) + extension)
+            if not os.path.exists(path):
+                with open(path, "wb") as f:
+                    f.write(data)
+            return path
+
+    def clear(self):
+        self.previews.clear()
+        self.generation += 1
+        self.received_bytes = 0
+
+    def close(self):
+        self.clear()
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def statistics(self):
+        return { "previews": len(self.previews), "preview_bytes": self.received_bytes }
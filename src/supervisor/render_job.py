@@ -1,32 +1,77 @@
-import os, math, time
+import math, time
 from ..shared import utils
+from .scheduling import SpeedAwarePolicy
 
 class FrameAssignment:
     def __init__(self, frame_num):
         self.frame_number = frame_num
         self.assignee = None
+        self.slot = 0
         self.rendered = False
         self.uploaded = False
+        self.writing = False
         self.irretrievable = False
+        self.failed = False
+        self.failures = 0
+        self.failed_on = set() # workers that could not render this frame
+        self.started = None
         self.elapsed = None
+        self.backup = None # a faster worker rendering a second copy of a straggling frame
+        self.backup_slot = 0
+        self.backup_started = None
+        self.path = None
+        self.digest = None # size and hash reported for a frame in shared storage
+        self.outputs = [] # the frame's other files, as (name, path), e.g. render passes
 
-    def assign(self, worker):
+    def assign(self, worker, slot=0, now=None):
         self.assignee = worker
+        self.slot = slot
         self.rendered = False
         self.uploaded = False
-        self.elapsed = time.time()
+        self.started = time.time() if now is None else now
+        self.backup = None
+
+    def assign_backup(self, worker, slot=0, now=None):
+        self.backup = worker
+        self.backup_slot = slot
+        self.backup_started = time.time() if now is None else now
 
     def unassign(self):
         self.assignee = None
+        self.backup = None
+
+    def release(self, worker):
+        # the worker no longer renders this frame, but a second copy may carry on
+        if self.backup is not None and worker is self.backup:
+            self.backup = None
+        elif self.backup is not None and worker is self.assignee:
+            self.promote_backup()
+        else:
+            self.unassign()
+
+    def promote_backup(self):
+        self.assignee, self.slot, self.started = self.backup, self.backup_slot, self.backup_started
+        self.backup = None
 
     def assigned(self):
         return self.assignee is not None
 
-    def mark_rendered(self):
+    def mark_rendered(self, worker=None, now=None):
+        # whichever copy finishes first is the one uploaded; returns the worker with the other one
+        loser = None
+        if self.backup is not None and worker is self.backup:
+            loser = self.assignee
+            self.promote_backup()
+        elif self.backup is not None and worker is self.assignee:
+            loser = self.backup
+        self.backup = None
         self.rendered = True
-        self.elapsed = time.time() - self.elapsed
+        self.elapsed = (time.time() if now is None else now) - self.started
+        return loser
 
 class RenderJob:
+    MAX_FRAME_FAILURES = 3 # workers that may fail a frame before it is given up on
+
     def __init__(self, frame_start, frame_end, settings, original_settings):
         self.frame_start = frame_start
         self.frame_end = frame_end
@@ -34,13 +79,27 @@ class RenderJob:
         self.frames_rendered = 0
         self.frames_uploaded = 0
         self.frames_irretrievable = 0
+        self.frames_failed = 0
+        self.backup_copies = 0 # second copies of straggling frames
+        self.stopped_copies = [] # (worker, frame number) of copies to stop, the other having finished first
+        self.check_failures = False
         self.frame_assignments = [ FrameAssignment(n) for n in range(frame_start, frame_end+1) ]
         self.settings = settings
         self.original_settings = original_settings
+        self.manifest = None
+        self.tracer = None
+        self.index = None # a FrameIndex of the frames written, with a sharded output layout
+        self.resume = False # skip the frames the index already has
+        self.policy = SpeedAwarePolicy() # which frames go to which worker, see scheduling
+        self.clock = time.time # simulated time when the job is simulated
+
+    def trace(self, name, **args):
+        if self.tracer:
+            self.tracer.instant("job", name, "job", **args)
 
     def progress(self):
         if not self.rendering_complete():
-            return self.frames_rendered / self.frame_count
+            return (self.frames_rendered + self.frames_failed) / self.frame_count
         return self.frames_uploaded / self.frame_count
 
     def worker_statistics(self):
@@ -58,60 +117,186 @@ class RenderJob:
 
         return stats
 
+    def slot_statistics(self, worker):
+        stats = {}
+
+        for frame in self.frame_assignments:
+            if frame.assignee is worker and frame.rendered:
+                slot_stats = stats.get(frame.slot, [0, 0.0])
+                slot_stats[0] += 1
+                slot_stats[1] += frame.elapsed
+                stats[frame.slot] = slot_stats
+
+        for slot in stats:
+            stats[slot][1] /= stats[slot][0]
+
+        return stats
+
     def rendering_complete(self):
-        return self.frames_rendered == self.frame_count
+        return (self.frames_rendered + self.frames_failed) == self.frame_count
 
     def uploading_complete(self):
         return (self.frames_uploaded + self.frames_irretrievable) == self.frame_count
 
-    def assign_next_frame(self, worker):
+    def assign_next_frame(self, worker, slot=0, farm=None):
+        # farm tells the policy about the other workers, see scheduling
+        frame = self.policy.next_frame(self, worker, farm)
+        if frame is not None:
+            self.trace("assign", frame=frame.frame_number, worker=worker.identity, slot=slot)
+            frame.assign(worker, slot, self.clock())
+            return frame.frame_number
+
+        frame = self.policy.backup_frame(self, worker, farm)
+        if frame is not None:
+            return self.assign_backup(frame, worker, slot)
+
+    def first_available(self, worker):
+        for frame in self.frame_assignments:
+            if self.available(frame, worker):
+                return frame
+
+    def assign_backup(self, frame, worker, slot=0):
+        self.trace("backup", frame=frame.frame_number, worker=worker.identity, slot=slot, straggler=frame.assignee.identity)
+        frame.assign_backup(worker, slot, self.clock())
+        self.backup_copies += 1
+        return frame.frame_number
+
+    def frames_waiting(self, worker, limit):
+        # frames the worker could be given, counting no further than limit
+        count = 0
         for frame in self.frame_assignments:
-            if self.available(frame):
-                frame.assign(worker)
-                return frame.frame_number
+            if count >= limit:
+                break
+            if not (frame.rendered or frame.failed) and self.available(frame, worker):
+                count += 1
+        return count
 
-    def unassign_frame(self, fnum):
+    def backup_candidates(self, worker):
+        # frames being rendered elsewhere, of which the worker could render a second copy
+        for frame in self.frame_assignments:
+            if frame.assigned() and frame.assignee is not worker and frame.backup is None and worker not in frame.failed_on and not (frame.rendered or frame.failed or frame.irretrievable):
+                yield frame
+
+    def assignment(self, fnum):
+        if self.frame_start <= fnum <= self.frame_end:
+            return self.frame_assignments[fnum - self.frame_start]
+
+    def unassign_frame(self, fnum, worker=None):
         if self.frame_start <= fnum <= self.frame_end:
             frame = self.frame_assignments[fnum - self.frame_start]
 
             if not frame.rendered:
-                frame.unassign()
+                self.trace("unassign", frame=fnum)
+                frame.release(worker)
+
+    def record_failure(self, fnum, worker):
+        if self.frame_start <= fnum <= self.frame_end:
+            frame = self.frame_assignments[fnum - self.frame_start]
+
+            if not frame.rendered and not frame.failed:
+                self.trace("failure", frame=fnum, worker=worker.identity)
+                frame.release(worker)
+                frame.failed_on.add(worker)
+                frame.failures += 1
+                self.check_failures = True
+
+                if frame.failures >= RenderJob.MAX_FRAME_FAILURES:
+                    self.mark_failed(frame)
+
+    def mark_failed(self, frame):
+        self.trace("failed", frame=frame.frame_number, failures=frame.failures)
+        frame.failed = True
+        self.frames_failed += 1
+        self.mark_irretrievable(frame.frame_number)
+
+    def abandon_frames(self, workers):
+        # frames that every remaining worker has failed would otherwise wait forever
+        self.check_failures = False
+
+        if workers:
+            for frame in self.frame_assignments:
+                if frame.failed_on and not (frame.rendered or frame.failed) and (not frame.assigned() or not frame.assignee.ok()):
+                    if all(worker in frame.failed_on for worker in workers):
+                        self.mark_failed(frame)
 
     def next_for_uploading(self, worker):
-        for frame in self.frame_assignments:
-            if frame.assignee is worker and not (frame.uploaded or frame.irretrievable):
-                return frame.frame_number
+        frame = self.policy.next_upload(self, worker)
+        if frame is not None:
+            return frame.frame_number
 
-    def mark_rendered(self, fnum):
+    def mark_rendered(self, fnum, worker=None):
         if self.frame_start <= fnum <= self.frame_end:
             frame = self.frame_assignments[fnum - self.frame_start]
 
             if not frame.rendered:
                 self.frames_rendered += 1
-                frame.mark_rendered()
+                loser = frame.mark_rendered(worker, self.clock())
+
+                if loser is not None:
+                    self.trace("stop copy", frame=fnum, worker=loser.identity)
+                    self.stopped_copies.append((loser, fnum))
+
+    def take_stopped_copies(self):
+        stopped, self.stopped_copies = self.stopped_copies, []
+        return stopped
 
     def mark_irretrievable(self, fnum):
         if self.frame_start <= fnum <= self.frame_end:
             frame = self.frame_assignments[fnum - self.frame_start]
 
             if not frame.irretrievable:
+                self.trace("irretrievable", frame=fnum)
                 self.frames_irretrievable += 1
                 frame.irretrievable = True
 
-    def mark_uploaded(self, fnum):
+    def mark_writing(self, fnum, writing=True):
+        if self.frame_start <= fnum <= self.frame_end:
+            self.frame_assignments[fnum - self.frame_start].writing = writing
+
+    def mark_uploaded(self, fnum, path=None, outputs=None, digest=None):
+        # digest is the frame's size and hash, if known
         if self.frame_start <= fnum <= self.frame_end:
             frame = self.frame_assignments[fnum - self.frame_start]
+            frame.writing = False
+            frame.path = path
+            frame.outputs = outputs or []
 
             if not frame.uploaded:
                 self.frames_uploaded += 1
                 frame.uploaded = True
 
-    def available(self, frame):
-        return not frame.assigned() or not frame.assignee.ok()
+                if self.index is not None and path:
+                    self.index.record(fnum, path, *(digest or (None, None)))
+
+    def mark_delivered(self, fnum, path, digest, worker=None):
+        # rendered straight into shared storage, so there is nothing to upload
+        if self.frame_start <= fnum <= self.frame_end:
+            self.mark_rendered(fnum, worker)
+            self.mark_uploaded(fnum, path, digest=digest)
+            self.frame_assignments[fnum - self.frame_start].digest = digest
+
+    def resume_from_index(self):
+        # frames a stopped job already wrote count as done, without looking in any directory
+        resumed = 0
 
-    def write_frame(self, frame, extension, directory, data):
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+        for frame in self.frame_assignments:
+            entry = self.index.find(frame.frame_number)
+            if entry and not frame.uploaded:
+                frame.rendered = frame.uploaded = True
+                frame.path, size, digest = entry
+                frame.digest = (size, digest) if digest else None
+                self.frames_rendered += 1
+                self.frames_uploaded += 1
+                resumed += 1
+
+        self.trace("resume", frames=resumed)
+        return resumed
+
+    def available(self, frame, worker=None):
+        # uploaded frames are done, even when their worker has since gone, or was never needed
+        if frame.uploaded or worker in frame.failed_on:
+            return False
+        return not frame.assigned() or not frame.assignee.ok()
 
-        with open(utils.filename_for_frame(frame, self.frame_end, extension, directory), 'wb') as f:
-            f.write(data)
+    def frame_path(self, frame, extension, directory):
+        return utils.filename_for_frame(frame, self.frame_end, extension, directory, self.settings.shard_size)
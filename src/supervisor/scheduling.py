@@ -0,0 +1,92 @@
+from .worker_speed import WorkerSpeed, finished_sooner_elsewhere
+
+class InOrderPolicy:
+    # Decides which frame a worker renders next, which of its frames it uploads next, and which
+    # frame being rendered elsewhere it renders a second copy of. farm, when there is one, is what
+    # a policy may know about the rest of the farm:
+    #
+    #     farm.render_candidates()         the workers that may render, each with .speed and .render_ages(now)
+    #     farm.speeds                      a SpeedTable
+    #     farm.rounds                      counts the rounds of assignments, e.g. the supervisor's updates
+    #     farm.may_back_up(frame, worker)  whether the worker may render a second copy of the frame
+    #
+    # The supervisor provides it for a real farm, and bench/simulate.py in simulated time.
+    #
+    # This policy gives out frames in order, uploads them in order and never renders one twice.
+    name = "in-order"
+
+    def next_frame(self, job, worker, farm=None):
+        # the FrameAssignment for the worker to render, or None to give it nothing for now
+        return job.first_available(worker)
+
+    def backup_frame(self, job, worker, farm=None):
+        # a frame being rendered elsewhere, for the worker to render as well, or None
+        return None
+
+    def next_upload(self, job, worker):
+        for frame in job.frame_assignments:
+            if frame.assignee is worker and not (frame.uploaded or frame.writing or frame.irretrievable):
+                return frame
+
+class SpeedAwarePolicy(InOrderPolicy):
+    # In order, except that near the end of a job a worker gets no more frames when faster ones
+    # would get through all that are left before it finished one, and once no frames are waiting,
+    # a frame taking far longer than its worker usually needs is rendered a second time by a
+    # faster worker, and whichever copy finishes first is kept.
+    name = "speed"
+
+    def __init__(self):
+        self.overdue = [] # frames taking far longer than expected, found once per round
+        self.overdue_round = None
+
+    def next_frame(self, job, worker, farm=None):
+        frame = job.first_available(worker)
+        # a frame faster workers failed is best left to whoever is still asking
+        if frame is None or farm is None or frame.failed_on:
+            return frame
+
+        own = farm.speeds.frame_time(worker.speed)
+        if own is None:
+            return frame
+
+        now = job.clock()
+        faster = []
+        for other in farm.render_candidates():
+            per_frame = farm.speeds.frame_time(other.speed)
+            if other is not worker and per_frame is not None and per_frame * WorkerSpeed.MARGIN < own:
+                faster += [ (max(0.0, per_frame - age), per_frame) for age in other.render_ages(now) ]
+
+        # more waiting than the faster slots can render in the time this one takes can't all be left to them
+        limit = sum(int(own // per_frame) + 1 for free, per_frame in faster) + 1
+        if finished_sooner_elsewhere(own, job.frames_waiting(worker, limit), faster):
+            return None
+        return frame
+
+    def backup_frame(self, job, worker, farm=None):
+        if farm is None or job.frames_waiting(worker, 1):
+            return None
+
+        own = farm.speeds.frame_time(worker.speed)
+        if own is None:
+            return None
+
+        now = job.clock()
+        if self.overdue_round != farm.rounds:
+            self.overdue_round = farm.rounds
+            self.overdue = []
+            for frame in job.backup_candidates(None):
+                expected = farm.speeds.frame_time(frame.assignee.speed)
+                if expected is not None and now - frame.started > WorkerSpeed.STRAGGLER_FACTOR * expected:
+                    self.overdue.append(frame)
+
+        for frame in self.overdue:
+            # some may have finished or been released since the list was made
+            if frame.assigned() and not frame.rendered and frame.assignee is not worker and frame.backup is None and worker not in frame.failed_on and own < now - frame.started and farm.may_back_up(frame, worker):
+                return frame
+
+POLICIES = { policy.name: policy for policy in (InOrderPolicy, SpeedAwarePolicy) }
+
+def create_policy(name):
+    if name not in POLICIES:
+        raise ValueError(f"Unknown scheduling policy {name!r}, expected one of {', '.join(POLICIES)}")
+    return POLICIES[name]()
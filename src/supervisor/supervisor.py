@@ -3,31 +3,107 @@ from ..protocol.connection import ARMBConnection, ARMBMessageTimeoutError, ARMBM
 from ..protocol import armb
 from .worker_view import WorkerView
 from .supervisor_worker import SupervisorWorker
+from .worker_health import WorkerHealth
+from .worker_speed import SpeedTable
+from .upload_shaper import UploadShaper
+from .preview_cache import PreviewCache
+from .frame_writer import FrameWriterPool
+from .frame_index import FrameIndex
+from ..shared.file_sync import ManifestBuilder
+from ..protocol.discovery import DiscoveryListener, DISCOVERY_PORT
+from ..protocol.local import host_address
+from ..protocol.metrics import MetricsExporter, merge_metrics
+from ..shared.trace import Tracer
 from ..shared import utils
 
 class Supervisor:
-    def __init__(self, output_dir, timeout=10):
+    def __init__(self, output_dir, timeout=10, writer_threads=2, max_pending_writes=8, local_transport=True):
         self.output_dir = output_dir
         self.timeout = timeout
+        self.local_transport = local_transport
+        self.writer = FrameWriterPool(writer_threads, max_pending_writes)
+        self.shaper = UploadShaper()
+        self.uploading = 0 # uploads in progress, counted at the start of each update
+        self.previews = PreviewCache()
+        self.manifest_builder = ManifestBuilder()
+        self.discovery = None
+        self.ignored_announcements = set()
+        self.metrics_exporter = None
+        self.tracer = Tracer("ARMB Supervisor")
         self.workers = []
-        self.supervisor_worker = SupervisorWorker()
+        self.health = {} # address -> WorkerHealth, kept when a worker reconnects
+        self.speeds = SpeedTable() # likewise, but reset for each job
+        self.calibration = 0 # percentage of the job's resolution for each worker's sample frame, 0 for none
+        self.rounds = 0 # updates so far, for a policy to do some work at most once per update
+        self.supervisor_worker = SupervisorWorker(self.tracer, self.previews, self.speeds.speed("supervisor"), self.assign_frame)
         self.job = None
 
         self.enable_supervisor_rendering()
 
+    def worker_health(self, host, port):
+        return self.health.setdefault((host, port), WorkerHealth())
+
     def add_worker(self, host, port):
-        worker = WorkerView(host, port, self.timeout)
+        worker = WorkerView(host, port, self.timeout, self.tracer, self.worker_health(host, port), self.local_transport, self.speeds.speed((host, port)))
         worker.start()
         self.workers.append(worker)
 
+    def find_worker(self, host, port, identity=None):
+        # by any name of its host, e.g. one added by name and announced by IP, or by the identity it announced
+        address = host_address(host)
+
+        for i, worker in enumerate(self.workers):
+            if worker.address[1] == port and (worker.address[0] == host or worker.host_address == address or (identity and worker.identity == identity)):
+                return i
+
+    def enable_discovery(self, discovery_port=DISCOVERY_PORT):
+        if not self.discovery:
+            self.discovery = DiscoveryListener(discovery_port)
+
+    def ignore_announcements(self, identity, port):
+        # e.g. a relay's own announcements to its supervisor
+        self.ignored_announcements.add((identity, port))
+
+    def disable_discovery(self):
+        if self.discovery:
+            self.discovery.close()
+            self.discovery = None
+
+    def discover_workers(self):
+        for identity, host, port in self.discovery.poll():
+            if (identity, port) in self.ignored_announcements:
+                continue
+
+            index = self.find_worker(host, port, identity)
+
+            if index is None:
+                self.add_worker(host, port)
+            elif not self.workers[index].ok() or self.workers[index].connection and not self.workers[index].connected():
+                # the worker restarted or lost its connection, so reconnect in place, by the name it was added with
+                host = self.workers[index].address[0]
+                self.workers[index].stop()
+                self.workers[index] = WorkerView(host, port, self.timeout, self.tracer, self.worker_health(host, port), self.local_transport, self.speeds.speed((host, port)))
+                self.workers[index].health.record_reconnect()
+                self.workers[index].trace_instant("reconnect", identity=identity)
+                self.workers[index].start()
+
     def remove_worker(self, index):
         self.workers.pop(index).stop()
+        if self.job:
+            self.job.check_failures = True
 
     def remove_all_workers(self):
         for worker in self.workers:
             worker.stop()
         self.workers.clear()
 
+    def stop(self):
+        self.supervisor_worker.cancel() # or its background render carries on after disconnecting
+        self.disable_discovery()
+        self.remove_all_workers()
+        self.writer.stop()
+        self.previews.close()
+
     def enable_supervisor_rendering(self):
         self.supervisor_worker.enable()
 
@@ -37,15 +113,34 @@ class Supervisor:
     def start_job(self, job):
         if not self.job or self.job.uploading_complete():
             self.job = job
-            self.supervisor_worker.synchronize(self.output_dir, self.job)
+            self.job.tracer = self.tracer
+            self.previews.clear()
+            self.speeds.reset()
+            self.tracer.instant("job", "start job", "job", frames=job.frame_count)
+
+            if job.settings.shard_size:
+                job.index = FrameIndex(job.settings.shared_output or self.output_dir)
+                if job.resume:
+                    job.resume_from_index()
+            self.supervisor_worker.synchronize(job.settings.shared_output or self.output_dir, self.job)
+
+    def build_manifest(self, main_file, dependencies):
+        return self.manifest_builder.build(main_file, dependencies)
+
+    def export_trace(self, path):
+        self.tracer.export_chrome(path)
+
+    def utilization(self):
+        return self.tracer.utilization()
 
     def stop_job(self):
         if self.job:
+            self.tracer.instant("job", "stop job", "job", complete=self.job.uploading_complete())
             self.supervisor_worker.cancel()
 
             if not self.job.uploading_complete():
                 for worker in self.workers:
-                    if worker.ok() and worker.status in { WorkerView.STATUS_RENDERING, WorkerView.STATUS_UPLOADING }:
+                    if worker.ok() and (worker.rendering() or worker.status == WorkerView.STATUS_UPLOADING):
                         worker.cancel_task()
             self.job = None
 
@@ -58,11 +153,63 @@ class Supervisor:
             if worker.ok() and worker.connected():
                 worker.request_clean_frames()
 
+    def configure_calibration(self, percentage=0):
+        # before its first frame of a job, each worker renders a sample frame at this percentage
+        # of the job's resolution, so it is known how fast it is from the start
+        self.calibration = percentage or 0
+
+    def configure_uploads(self, rate=None, worker_rate=None, max_uploads=None):
+        # rates in bytes per second, None for no limit
+        self.shaper.configure(rate, worker_rate, max_uploads)
+
+    def uploads_in_progress(self):
+        return sum(1 for worker in self.workers if worker.upload_frame is not None and worker.ok())
+
+    def write_statistics(self):
+        return (self.writer.queue_depth(), self.writer.average_latency(), self.writer.max_latency())
+
+    def connection_metrics(self):
+        # keyed by address, since several workers on one computer share an identity
+        return { f"{worker.address[0]}:{worker.address[1]}": worker.connection.metrics for worker in self.workers if worker.connection }
+
+    def metrics(self):
+        return merge_metrics(self.connection_metrics().values())
+
+    def metrics_extra(self):
+        queue_depth, average_latency, max_latency = self.write_statistics()
+        extra = { "write_queue_depth": queue_depth, "write_latency_seconds_avg": average_latency, "write_latency_seconds_max": max_latency, "workers_connected": sum(1 for w in self.workers if w.connected()), "uploads_in_progress": self.uploads_in_progress() }
+        extra.update(self.shaper.statistics())
+        extra.update(self.previews.statistics())
+
+        if self.job:
+            extra.update({ "frames_total": self.job.frame_count, "frames_rendered": self.job.frames_rendered, "frames_uploaded": self.job.frames_uploaded, "frames_failed": self.job.frames_failed })
+        return extra
+
+    def enable_metrics_export(self, path, format='json', interval=10):
+        self.metrics_exporter = MetricsExporter(path, format, interval)
+
+    def disable_metrics_export(self):
+        self.metrics_exporter = None
+
     def update(self):
         self.supervisor_worker.update()
 
+        if self.metrics_exporter:
+            self.metrics_exporter.update(self.connection_metrics(), self.metrics_extra())
+
+        for write in self.writer.completed():
+            self.handle_completed_write(write)
+
+        if self.discovery:
+            self.discover_workers()
+
+        self.uploading = self.uploads_in_progress()
+        self.rounds += 1
+
         for worker in self.workers:
-            if worker.ok() and worker.connected():
+            if worker.connecting():
+                worker.update_connection()
+            elif worker.ok() and worker.connected():
                 worker.update_connection()
 
                 if worker.connection.finished_receiving():
@@ -70,6 +217,37 @@ class Supervisor:
 
                 if not worker.connection.sending():
                     self.send_message(worker)
+            elif not worker.ok() and worker.rendering():
+                worker.handle_lost_connection(self.job)
+
+        if self.job:
+            for worker, frame in self.job.take_stopped_copies():
+                worker.cancel_frame(frame)
+
+        if self.job and self.job.check_failures:
+            self.job.abandon_frames(self.render_candidates())
+
+    def render_candidates(self):
+        workers = [ worker for worker in self.workers if worker.ok() ]
+        if self.supervisor_worker.enabled:
+            workers.append(self.supervisor_worker)
+        return workers
+
+    def worker_health_statistics(self):
+        return { f"{worker.address[0]}:{worker.address[1]}": worker.health.statistics() for worker in self.workers }
+
+    def worker_speed_statistics(self):
+        return { f"{worker.address[0]}:{worker.address[1]}": dict(worker.speed.statistics(), speed_factor=self.speeds.factor(worker.speed)) for worker in self.workers }
+
+    def assign_frame(self, worker, slot):
+        return self.job.assign_next_frame(worker, slot, self)
+
+    def may_back_up(self, frame, worker):
+        # Not with shared storage, where both copies would write the same file, nor for the
+        # supervisor's own frames, which are written where an upload would go.
+        if self.job.settings.shared_output or self.supervisor_worker in (worker, frame.assignee):
+            return False
+        return frame.assignee.ok()
 
     def handle_message(self, worker, message):
         msg_str = message.message.tobytes().decode()
@@ -78,16 +256,31 @@ class Supervisor:
             worker.handle_identity_message(message, msg_str)
         elif msg_str.startswith("CONFIRM SYNCHRONIZE "):
             worker.handle_confirm_sync_message(message, msg_str)
+        elif msg_str.startswith("REQUEST BLOCKS "):
+            worker.handle_request_blocks_message(self.job, message, msg_str)
+        elif msg_str.startswith("CONFIRM MANIFEST "):
+            worker.handle_confirm_manifest_message(message, msg_str)
+        elif msg_str.startswith("COMPLETE CALIBRATE "):
+            worker.handle_calibration_complete_message(message, msg_str)
         elif msg_str.startswith("REJECT RENDER "):
             worker.handle_reject_render_message(self.job, message, msg_str)
         elif msg_str.startswith("CONFIRM CANCEL"):
+            if worker.upload_frame is not None:
+                self.shaper.cancel(worker)
             worker.handle_confirm_cancel_message()
         elif msg_str.startswith("COMPLETE RENDER "):
             worker.handle_render_complete_message(self.job, message, msg_str)
+        elif msg_str.startswith("PREVIEW "):
+            worker.handle_preview_message(self.job, self.previews, message, msg_str)
         elif msg_str.startswith("REJECT UPLOAD "):
+            self.shaper.cancel(worker)
             worker.handle_reject_upload_message(self.job, message, msg_str)
         elif msg_str.startswith("COMPLETE UPLOAD "):
-            worker.handle_upload_complete_message(self.output_dir, self.job, message, msg_str)
+            if worker.connection.local():
+                self.shaper.cancel(worker) # nothing crossed the network
+            else:
+                self.shaper.finish(worker, len(message.data))
+            worker.handle_upload_complete_message(self.writer, self.output_dir, self.job, message, msg_str)
         else:
             worker.err = utils.BadMessageError("Unable to parse unknown message", message)
 
@@ -95,6 +288,20 @@ class Supervisor:
         if worker.status == WorkerView.STATUS_READY:
             if self.job:
                 if not self.job.rendering_complete():
-                    worker.request_render_frame(self.job)
-                elif not self.job.uploading_complete():
-                    worker.request_upload_frame(self.job)
+                    worker.request_render_frame(self.job, self.calibration, self.assign_frame)
+                elif not self.job.uploading_complete() and not self.writer.full() and self.shaper.may_upload(worker, self.uploading):
+                    if worker.request_upload_frame(self.job) is not None:
+                        self.shaper.start(worker)
+                        self.uploading += 1
+
+    def handle_completed_write(self, write):
+        if write.job is not self.job:
+            return
+
+        if write.error:
+            print(f"Unable to write frame {write.frame}: {write.error}")
+            write.job.mark_writing(write.frame, False)
+            write.job.mark_irretrievable(write.frame)
+        else:
+            write.job.mark_uploaded(write.frame, write.path, [ (name, path) for name, path, data in write.outputs ], write.digest)
+            write.worker.confirm_upload(write.frame)
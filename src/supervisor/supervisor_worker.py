@@ -1,11 +1,24 @@
+import time
 from ..blender import blender
 from ..shared.task import RenderTask
 from ..shared import utils
+from ..worker.render_slot import RenderSlot, ProcessRenderSlot
+from .worker_speed import WorkerSpeed
 
 class SupervisorWorker:
-    def __init__(self):
+    def __init__(self, tracer=None, previews=None, speed=None, assign=None):
         self.identity = '__supervisor__'
+        self.tracer = tracer
+        self.previews = previews
+        self.speed = speed or WorkerSpeed()
+        self.assign = assign # picks the next frame, the first one waiting by default
+        self.preview_size = 160
+        self.slot = ProcessRenderSlot(0)
+        self.use_process = True # until a background process fails before any has rendered a frame
+        self.process_rendered = False
+        self.original_settings = None # restored after rendering inside this process
         self.task = None
+        self.started = None
         self.enabled = True
         self.output_dir = None
         self.job = None
@@ -38,42 +51,109 @@ class SupervisorWorker:
     def rendering(self):
         return self.enabled and self.task and self.task.started
 
+    def render_ages(self, now):
+        return [ now - self.started ] if self.task else [ 0.0 ]
+
     def cancel(self):
         if self.task:
             self.job = None
             self.task.remote_cancelled = True
+            self.slot.cancel() # a render inside this process can't be stopped
 
     def update(self):
         if self.ready():
-            frame = self.job.assign_next_frame(self)
+            frame = (self.assign or self.job.assign_next_frame)(self, 0)
 
             if frame:
                 self.task = RenderTask(frame, self.job.frame_end)
+                self.started = time.time()
 
         if self.preparing():
-            path = utils.filename_for_frame(self.task.frame, self.task.max_frame, '', self.output_dir)
-            blender.apply_render_settings(self.job.settings)
-            if 'CANCELLED' not in blender.render_frame(self.task.frame, path):
-                blender.set_render_callbacks(self.handle_render_complete, self.handle_render_cancel)
-                self.task.started = True
+            path = utils.filename_for_frame(self.task.frame, self.task.max_frame, '', self.output_dir, self.job.settings.shard_size)
+            task = self.task
+            self.slot.assign(task)
+
+            # in a background Blender process, so this one keeps serving the network meanwhile
+            if self.use_process and self.slot.start(self.job.settings, path):
+                task.started = True
+                if self.tracer:
+                    self.tracer.begin("supervisor", f"render {task.frame}", "render", frame=task.frame, process=True)
+            else:
+                # an unsaved file can only be rendered here, as can any file without a working process
+                self.slot.release()
+                self.render_in_process(task, path)
+        elif self.task and self.task.started and self.slot.task is self.task:
+            result = self.slot.poll()
+
+            if result == RenderSlot.RESULT_FINISHED:
+                self.slot.release()
+                self.process_rendered = True
+                self.finish_render()
+            elif result == RenderSlot.RESULT_CANCELLED and not self.process_rendered and not self.task.remote_cancelled:
+                # Blender may not run here in the background at all, e.g. unable to import this
+                # add-on, so the frame is rendered in this process instead, as are those after it
+                self.slot.release()
+                self.use_process = False
+                self.trace_end("no render process")
+                self.task.started = False
+            elif result == RenderSlot.RESULT_CANCELLED:
+                self.slot.release()
+                self.fail_render()
+
+    def render_in_process(self, task, path):
+        self.original_settings = self.job.original_settings
+        blender.apply_render_settings(self.job.settings)
+
+        # the callbacks may run before render_frame returns, when Blender runs in the background
+        task.started = True
+        blender.set_render_callbacks(self.handle_render_complete, self.handle_render_cancel)
+        if self.tracer:
+            self.tracer.begin("supervisor", f"render {task.frame}", "render", frame=task.frame)
+
+        if 'CANCELLED' in blender.render_frame(task.frame, path) and self.task is task:
+            blender.clear_render_callbacks()
+            task.started = False
+            self.trace_end("not started")
+
+    def trace_end(self, result):
+        if self.tracer and self.task:
+            self.tracer.end("supervisor", f"render {self.task.frame}", result=result)
 
     def handle_render_complete(self, scene, bpy_context):
-        if self.job:
-            self.job.mark_rendered(self.task.frame)
-            self.job.mark_uploaded(self.task.frame)
+        blender.clear_render_callbacks()
+        self.finish_render()
+
+    def handle_render_cancel(self, scene, bpy_context):
+        if self.fail_render():
+            blender.apply_render_settings(self.original_settings)
             blender.clear_render_callbacks()
+
+    def finish_render(self):
+        self.trace_end("complete")
+        if self.job:
+            path = utils.filename_for_frame(self.task.frame, self.task.max_frame, blender.filename_extension(), self.output_dir, self.job.settings.shard_size)
+            self.speed.record_frame(time.time() - self.started)
+            self.job.mark_rendered(self.task.frame, self)
+            # not hashed for the index, which would hold up this thread
+            self.job.mark_uploaded(self.task.frame, path)
+
+            if self.previews is not None:
+                preview = blender.create_preview(path, self.preview_size)
+                if preview:
+                    self.previews.add(self.task.frame, preview)
         self.task = None
 
-    def handle_render_cancel(self, scene, bpy_context):
+    def fail_render(self):
+        # returns whether the frame was given up on, rather than to be tried again
+        self.trace_end("cancelled")
         if self.task.remote_cancelled:
-            blender.apply_render_settings(self.job.original_settings)
-            blender.clear_render_callbacks()
             self.task = None
-        else:
-            self.task.started = False
-            self.task.record_failed_attempt()
-            if self.task.failed():
-                blender.apply_render_settings(self.job.original_settings)
-                blender.clear_render_callbacks()
-                self.job.unassign_frame(self.task.frame)
-                self.task = None
+            return True
+
+        self.task.started = False
+        self.task.record_failed_attempt()
+        if self.task.failed():
+            self.job.record_failure(self.task.frame, self)
+            self.task = None
+            return True
+        return False
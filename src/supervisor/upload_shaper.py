@@ -0,0 +1,113 @@
+import time
+
+class TokenBucket:
+    # Allows rate bytes per second on average, and bursts of up to burst bytes. Tokens may go
+    # negative, since an upload's size is only known once it has arrived, and then nothing more
+    # is allowed until they have been paid back. A rate of None means no limit.
+    def __init__(self, rate=None, burst=None):
+        self.rate = None
+        self.burst = 0
+        self.tokens = 0.0
+        self.updated = time.time()
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst=None):
+        self.refill()
+        limited = self.rate is not None
+        self.rate = rate or None
+        self.burst = burst if burst is not None else (rate or 0) # a second's worth by default
+        self.tokens = min(self.tokens, self.burst) if limited else self.burst
+
+    def refill(self):
+        now = time.time()
+        if self.rate:
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+    def available(self):
+        self.refill()
+        return not self.rate or self.tokens > 0
+
+    def consume(self, amount):
+        if self.rate:
+            self.refill()
+            self.tokens -= amount
+
+class UploadShaper:
+    # Decides when the supervisor may ask another worker for a frame, so that the uploads after a
+    # render do not all start at once and saturate the supervisor's network and disk. There is a
+    # global byte rate, a default rate per worker that can be overridden for single workers, and
+    # a cap on uploads in progress at once. A frame is charged at the average size of the frames
+    # so far when it is requested, and the difference once its real size is known.
+    def __init__(self, rate=None, worker_rate=None, max_uploads=None):
+        self.bucket = TokenBucket(rate)
+        self.worker_rate = worker_rate or None
+        self.worker_rates = {} # address -> bytes per second, overriding worker_rate
+        self.worker_buckets = {} # address -> TokenBucket
+        self.max_uploads = max_uploads or None
+        self.estimates = {} # address -> what the frame being uploaded was charged
+        self.uploaded_bytes = 0
+        self.uploaded_frames = 0
+        self.throttled = 0
+
+    def configure(self, rate=None, worker_rate=None, max_uploads=None):
+        self.bucket.configure(rate)
+        self.worker_rate = worker_rate or None
+        self.max_uploads = max_uploads or None
+
+        for address, bucket in self.worker_buckets.items():
+            bucket.configure(self.worker_rates.get(address, self.worker_rate))
+
+    def set_worker_rate(self, address, rate):
+        if rate:
+            self.worker_rates[address] = rate
+        else:
+            self.worker_rates.pop(address, None)
+
+        if address in self.worker_buckets:
+            self.worker_buckets[address].configure(self.worker_rates.get(address, self.worker_rate))
+
+    def worker_bucket(self, address):
+        if address not in self.worker_buckets:
+            self.worker_buckets[address] = TokenBucket(self.worker_rates.get(address, self.worker_rate))
+        return self.worker_buckets[address]
+
+    def estimate(self):
+        return self.uploaded_bytes / self.uploaded_frames if self.uploaded_frames else 0
+
+    def limited(self, worker):
+        return self.bucket.rate or self.worker_bucket(worker.address).rate
+
+    def may_upload(self, worker, uploading):
+        # uploading is the number of uploads already in progress
+        if self.max_uploads and uploading >= self.max_uploads:
+            allowed = False
+        elif not self.uploaded_frames and uploading and self.limited(worker):
+            allowed = False # one at a time until there is an idea how large frames are
+        else:
+            allowed = self.bucket.available() and self.worker_bucket(worker.address).available()
+
+        if not allowed:
+            self.throttled += 1
+        return allowed
+
+    def start(self, worker):
+        estimate = self.estimate()
+        self.estimates[worker.address] = estimate
+        self.bucket.consume(estimate)
+        self.worker_bucket(worker.address).consume(estimate)
+
+    def cancel(self, worker):
+        refund = self.estimates.pop(worker.address, 0)
+        self.bucket.consume(-refund)
+        self.worker_bucket(worker.address).consume(-refund)
+
+    def finish(self, worker, size):
+        correction = size - self.estimates.pop(worker.address, 0)
+        self.bucket.consume(correction)
+        self.worker_bucket(worker.address).consume(correction)
+        self.uploaded_bytes += size
+        self.uploaded_frames += 1
+
+    def statistics(self):
+        return { "upload_rate_limit": self.bucket.rate or 0, "upload_tokens": self.bucket.tokens, "uploads_throttled": self.throttled, "upload_average_bytes": self.estimate() }
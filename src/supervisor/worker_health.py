@@ -0,0 +1,50 @@
+import math, time
+
+class WorkerHealth:
+    # How reliable a worker has been during this session, kept across reconnects. A worker that
+    # fails a frame waits before it is given another one, twice as long after each failure in a
+    # row, and a worker with a poor record renders on fewer of its slots at once.
+    BACKOFF_START = 10.0
+    BACKOFF_MAX = 300.0
+
+    def __init__(self):
+        self.renders = 0
+        self.failures = 0 # frames the worker gave up on
+        self.timeouts = 0 # connections lost or timed out while rendering
+        self.reconnects = 0
+        self.consecutive_failures = 0
+        self.benched_until = 0.0
+
+    def record_render(self):
+        self.renders += 1
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        self.back_off()
+
+    def record_timeout(self):
+        self.timeouts += 1
+        self.back_off()
+
+    def record_reconnect(self):
+        self.reconnects += 1
+
+    def back_off(self):
+        self.consecutive_failures += 1
+        delay = min(WorkerHealth.BACKOFF_START * 2 ** (self.consecutive_failures - 1), WorkerHealth.BACKOFF_MAX)
+        self.benched_until = time.time() + delay
+
+    def benched(self):
+        return time.time() < self.benched_until
+
+    def score(self):
+        # the share of attempts that went well, from 0 to 1; a new worker counts as healthy
+        problems = self.failures + self.timeouts + 0.5 * self.reconnects
+        return (self.renders + 1) / (self.renders + 1 + problems)
+
+    def usable_slots(self, slot_count):
+        return max(1, math.ceil(self.score() * slot_count))
+
+    def statistics(self):
+        return { "renders": self.renders, "failures": self.failures, "timeouts": self.timeouts, "reconnects": self.reconnects, "score": self.score() }
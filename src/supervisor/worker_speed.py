@@ -0,0 +1,87 @@
+import heapq, statistics
+
+class WorkerSpeed:
+    # How long a worker takes to render a frame of the current job on one of its slots, first
+    # from a calibration render of a sample frame at a reduced resolution, then from the frames
+    # it completes, weighted towards the latest. Kept across reconnects, and reset when a job
+    # starts, since another scene renders at another pace.
+    SMOOTHING = 0.3 # weight of each completed frame
+    STRAGGLER_FACTOR = 2.0 # a frame taking this many times longer than usual is straggling
+    MARGIN = 1.5 # frame times vary, so another worker only counts as faster by this factor
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calibration = None # seconds for the sample frame
+        self.calibrated = False # tried, whether or not it gave a time
+        self.frame_time = None # seconds per frame
+        self.frames = 0
+
+    def needs_calibration(self):
+        return not self.calibrated and not self.frames
+
+    def record_calibration(self, seconds):
+        self.calibrated = True
+        if seconds is not None and seconds > 0:
+            self.calibration = seconds
+
+    def record_frame(self, seconds):
+        self.frames += 1
+        if self.frame_time is None:
+            self.frame_time = seconds
+        else:
+            self.frame_time += WorkerSpeed.SMOOTHING * (seconds - self.frame_time)
+
+    def statistics(self):
+        return { "frames_timed": self.frames, "frame_seconds": self.frame_time or 0, "calibration_seconds": self.calibration or 0 }
+
+class SpeedTable:
+    # The speeds of every worker of a farm, compared with each other. Until workers have rendered
+    # real frames, calibration times only compare them with each other; then the workers with
+    # both tell how a calibration time translates into a frame time for the others.
+    def __init__(self):
+        self.speeds = {} # address -> WorkerSpeed
+
+    def speed(self, key):
+        return self.speeds.setdefault(key, WorkerSpeed())
+
+    def reset(self):
+        for speed in self.speeds.values():
+            speed.reset()
+
+    def calibration_ratio(self):
+        ratios = [ s.frame_time / s.calibration for s in self.speeds.values() if s.frame_time is not None and s.calibration ]
+        return statistics.median(ratios) if ratios else None
+
+    def frame_time(self, speed):
+        # expected seconds per frame on one slot, or None while nothing is known
+        if speed.frame_time is not None:
+            return speed.frame_time
+
+        ratio = self.calibration_ratio()
+        if speed.calibration and ratio:
+            return speed.calibration * ratio
+
+    def factor(self, speed):
+        # how many times faster than the typical worker, 1 when unknown
+        if any(s.frame_time is not None for s in self.speeds.values()):
+            times, own = [ self.frame_time(s) for s in self.speeds.values() ], self.frame_time(speed)
+        else:
+            times, own = [ s.calibration for s in self.speeds.values() ], speed.calibration
+
+        known = [ t for t in times if t ]
+        return statistics.median(known) / own if own and known else 1.0
+
+def finished_sooner_elsewhere(seconds, waiting, slots):
+    # whether the other slots, as (seconds until free, seconds per frame), get through the frames
+    # still waiting before a slot that takes seconds per frame would finish one of them
+    finishes = [ (free + per_frame, per_frame) for free, per_frame in slots ]
+    heapq.heapify(finishes)
+
+    for _ in range(waiting):
+        if not finishes or finishes[0][0] >= seconds:
+            return False
+        finish, per_frame = heapq.heappop(finishes)
+        heapq.heappush(finishes, (finish + per_frame, per_frame))
+    return True
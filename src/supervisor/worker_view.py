@@ -1,26 +1,48 @@
-import socket, threading
+import socket, errno, os, time
 from ..protocol.connection import ARMBConnection, ARMBMessageTimeoutError, ARMBMessageFormatError
 from ..protocol import armb
 from ..shared import utils
+from .frame_writer import FrameWrite
+from .worker_health import WorkerHealth
+from .worker_speed import WorkerSpeed
+from ..shared.file_sync import pack_blocks
+from ..shared.frame_bundle import unpack_bundle, unpack_paths
+from ..protocol.local import is_local_host, host_address, connect_locally
+
+CONNECT_IN_PROGRESS = { 0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK) }
 
 class WorkerView:
     STATUS_INITIALIZING = 'INITIALIZING'
     STATUS_SYNCHRONIZING = 'SYNCHRONIZING'
+    STATUS_CALIBRATING = 'CALIBRATING'
     STATUS_RENDERING = 'RENDERING'
     STATUS_UPLOADING = 'UPLOADING'
     STATUS_READY = 'READY'
     STATUS_ERROR = 'ERROR'
 
-    def __init__(self, host, port, timeout):
+    def __init__(self, host, port, timeout, tracer=None, health=None, local_transport=True, speed=None):
         self.status = WorkerView.STATUS_INITIALIZING
         self.identity = None
         self.settings_id = -1
+        self.manifest_id = None
+        self.slot_frames = [ None ]
+        self.slot_started = [ None ] # when each slot's frame was sent
+        self.upload_frame = None
+        self.local_directory = None # where a worker on this computer hands frames over from
 
         self.err = None
         self.timeout = timeout
         self.address = (host, port)
+        self.host_address = host_address(host) # to know it when announced by another name
+        self.local_transport = local_transport # use a Unix domain socket for a worker on this computer
         self.socket = None
         self.connection = None
+        self.connect_started = None
+        self.tracer = tracer
+        self.health = health or WorkerHealth()
+        self.speed = speed or WorkerSpeed()
+        self.track = f"{host}:{port}"
+        self.trace_status()
 
     def __eq__(self, other):
         return self.identity == other.identity and self.address == other.address
@@ -28,9 +50,71 @@ class WorkerView:
     def __hash__(self):
         return hash((self.identity, self.address))
 
+    def name(self):
+        return self.identity or f"{self.address[0]}:{self.address[1]}"
+
+    def trace_status(self):
+        if self.tracer:
+            category = "sync" if self.status == WorkerView.STATUS_SYNCHRONIZING else "status"
+            self.tracer.begin(self.track, "status", category, group=self.track, status=self.status)
+
+    def set_status(self, status):
+        if status != self.status:
+            if self.tracer:
+                self.tracer.end(self.track, "status")
+            self.status = status
+            self.trace_status()
+
+    def trace_begin(self, lane, name, category, **args):
+        if self.tracer:
+            self.tracer.begin(f"{self.track} {lane}", name, category, group=self.track, **args)
+
+    def trace_end(self, lane, name, **args):
+        if self.tracer:
+            self.tracer.end(f"{self.track} {lane}", name, **args)
+
+    def trace_instant(self, name, **args):
+        if self.tracer:
+            self.tracer.instant(self.track, name, "event", group=self.track, **args)
+
     def verified(self):
         return not self.identity is None
 
+    def slot_count(self):
+        return len(self.slot_frames)
+
+    def free_slot(self):
+        for slot, frame in enumerate(self.slot_frames):
+            if frame is None:
+                return slot
+
+    def may_render(self):
+        # a worker that has been failing gets no new frames for a while, and then fewer at once
+        rendering = sum(1 for frame in self.slot_frames if frame is not None)
+        return not self.health.benched() and rendering < self.health.usable_slots(self.slot_count())
+
+    def rendering(self):
+        return any(frame is not None for frame in self.slot_frames)
+
+    def render_ages(self, now):
+        # how long each slot it may use has been rendering its frame, 0 for one that is free
+        ages = [ now - started for started in self.slot_started if started is not None ]
+        if not self.health.benched():
+            ages += [ 0.0 ] * max(0, self.health.usable_slots(self.slot_count()) - len(ages))
+        return ages
+
+    def release_slot(self, frame, result="complete"):
+        if frame in self.slot_frames:
+            slot = self.slot_frames.index(frame)
+            if result == "complete" and self.slot_started[slot] is not None:
+                self.speed.record_frame(time.time() - self.slot_started[slot])
+            self.slot_frames[slot] = None
+            self.slot_started[slot] = None
+            self.trace_end(f"slot {slot}", f"render {frame}", result=result)
+
+        if self.status == WorkerView.STATUS_RENDERING:
+            self.set_status(WorkerView.STATUS_READY)
+
     def connected(self):
         return self.connection is not None and self.connection.ok()
 
@@ -39,10 +123,10 @@ class WorkerView:
 
     def error(self):
         if self.err:
-            self.status = WorkerView.STATUS_ERROR
+            self.set_status(WorkerView.STATUS_ERROR)
             return self.err
         elif self.connection and self.connection.error:
-            self.status = WorkerView.STATUS_ERROR
+            self.set_status(WorkerView.STATUS_ERROR)
             return self.connection.error
 
     def error_description(self):
@@ -62,38 +146,80 @@ class WorkerView:
             else:
                 return f"Internal Error: {error}"
 
+    def connecting(self):
+        return self.socket is not None and self.connection is None and self.err is None
+
     def start(self, block=False):
-        def establish_connection():
-            try:
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.local_transport and is_local_host(self.address[0]):
+            self.socket = connect_locally(self.address[1], self.timeout)
+            if self.socket:
+                self.establish_connection()
+                return
+
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if block:
                 self.socket.settimeout(self.timeout)
                 self.socket.connect(self.address)
+                self.establish_connection()
+            else:
+                # connect in the background, so many workers can be connected at once
                 self.socket.setblocking(False)
-                self.connection = ARMBConnection(self.socket, self.timeout)
-                self.connection.send(armb.new_identity_message())
-            except (OSError, socket.timeout) as e:
-                self.err = e
-                self.status = WorkerView.STATUS_ERROR
+                self.connect_started = time.time()
+                result = self.socket.connect_ex(self.address)
+                if result not in CONNECT_IN_PROGRESS:
+                    raise ConnectionRefusedError(result, os.strerror(result))
+        except (OSError, socket.timeout) as e:
+            self.err = e
+            self.set_status(WorkerView.STATUS_ERROR)
 
-        if block:
-            establish_connection()
-        else:
-            threading.Thread(target=establish_connection).start()
+    def continue_connecting(self):
+        readable, writeable = utils.socket_status(self.socket)
+
+        if writeable:
+            result = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if result == 0:
+                self.establish_connection()
+            else:
+                self.err = ConnectionRefusedError(result, os.strerror(result))
+                self.set_status(WorkerView.STATUS_ERROR)
+        elif time.time() - self.connect_started > self.timeout:
+            self.err = socket.timeout("Unable to connect within timeout")
+            self.set_status(WorkerView.STATUS_ERROR)
+
+    def establish_connection(self):
+        self.socket.setblocking(False)
+        self.connection = ARMBConnection(self.socket, self.timeout)
+        self.connection.send(armb.new_identity_message())
 
     def stop(self):
+        if self.tracer:
+            self.tracer.end(self.track, "status")
+            for slot in range(self.slot_count()):
+                self.tracer.end_all(f"{self.track} slot {slot}")
+            self.tracer.end_all(f"{self.track} upload")
+
         if self.connection and not self.connection.closed:
             self.connection.close()
+        elif self.connecting():
+            self.socket.close()
 
     def update_connection(self):
-        if self.connected():
+        if self.connecting():
+            self.continue_connecting()
+        elif self.connected():
             self.connection.update()
 
     def handle_identity_message(self, message, msg_str):
-        self.identity = armb.parse_identity_message(msg_str)
+        self.identity, slots = armb.parse_identity_message(msg_str)
         if self.identity is None:
             self.err = utils.BadMessageError("Unable to parse IDENTITY message", message)
         else:
-            self.status = WorkerView.STATUS_READY
+            self.slot_frames = [ None ] * max(slots, 1)
+            self.slot_started = [ None ] * max(slots, 1)
+            if self.connection.local() and message.data:
+                self.local_directory = bytes(message.data).decode()
+            self.set_status(WorkerView.STATUS_READY)
 
     def handle_confirm_sync_message(self, message, msg_str):
         sync_id = armb.parse_confirm_sync_message(msg_str)
@@ -102,68 +228,221 @@ class WorkerView:
             self.err = utils.BadMessageError("Unable to parse CONFIRM SYNCHRONIZE message", message)
         else:
             self.settings_id = int(sync_id)
-            self.status = WorkerView.STATUS_READY
+            self.set_status(WorkerView.STATUS_READY)
+
+    def handle_request_blocks_message(self, job, message, msg_str):
+        manifest_id = armb.parse_request_blocks_message(msg_str)
+
+        if manifest_id is None:
+            self.err = utils.BadMessageError("Unable to parse REQUEST BLOCKS message", message)
+        elif job and job.manifest and job.manifest.id == manifest_id:
+            try:
+                hashes = message.data.tobytes().decode().split("\n")
+                blocks = [ job.manifest.read_block(h) for h in hashes ]
+                self.connection.send(*armb.new_blocks_message(manifest_id, pack_blocks(blocks)))
+            except KeyError as e:
+                self.err = utils.BadMessageError("Requested an unknown block", message)
+            except OSError as e:
+                self.err = e
+
+    def handle_confirm_manifest_message(self, message, msg_str):
+        manifest_id = armb.parse_confirm_manifest_message(msg_str)
+
+        if manifest_id is None:
+            self.err = utils.BadMessageError("Unable to parse CONFIRM MANIFEST message", message)
+        else:
+            self.manifest_id = manifest_id
+            self.set_status(WorkerView.STATUS_READY)
 
     def handle_reject_render_message(self, job, message, msg_str):
-        frame = armb.parse_reject_render_message(msg_str)
+        frame, failed = armb.parse_reject_render_message(msg_str)
 
         if frame is None:
             self.err = utils.BadMessageError("Unable to parse REJECT RENDER message", message)
-        elif job:
-            job.unassign_frame(int(frame))
-            self.status = WorkerView.STATUS_READY
+        elif failed:
+            if job:
+                job.record_failure(int(frame), self)
+            self.health.record_failure()
+            self.trace_instant("render failed", frame=int(frame))
+            self.release_slot(int(frame), "failed")
+        else:
+            if job:
+                job.unassign_frame(int(frame), self)
+            self.trace_instant("reject render", frame=int(frame))
+            self.release_slot(int(frame), "rejected")
+
+    def handle_lost_connection(self, job):
+        # the frames it was rendering may be what brought it down
+        self.health.record_timeout()
+
+        for frame in self.slot_frames:
+            if frame is not None:
+                if job:
+                    job.record_failure(frame, self)
+                self.release_slot(frame, "lost")
 
     def handle_confirm_cancel_message(self):
-        self.status = WorkerView.STATUS_READY
+        for frame in self.slot_frames:
+            if frame is not None:
+                self.release_slot(frame, "cancelled")
+        # an upload still on its way overtook this confirmation, and is dropped when it arrives
+        self.upload_frame = None
+        self.set_status(WorkerView.STATUS_READY)
 
     def handle_render_complete_message(self, job, message, msg_str):
         try:
+            frame = int(armb.parse_render_complete_message(msg_str))
+            delivered = armb.parse_render_delivered_message(msg_str)
+
+            if job and delivered and job.settings.shared_output:
+                self.verify_delivery(job, frame, int(delivered[1]), delivered[2], delivered[3])
+                return
             if job:
-                frame = int(armb.parse_render_complete_message(msg_str))
-                job.mark_rendered(frame)
-                self.status = WorkerView.STATUS_READY
-        except ValueError as e:
+                job.mark_rendered(frame, self)
+            self.health.record_render()
+            self.release_slot(frame)
+        except (ValueError, TypeError) as e:
             self.err = utils.BadMessageError("Unable to parse COMPLETE RENDER message", message)
 
+    def verify_delivery(self, job, frame, size, digest, extension):
+        # the worker wrote the frame to shared storage; it counts once it is there in full
+        path = job.frame_path(frame, extension, job.settings.shared_output)
+
+        try:
+            found = os.path.getsize(path)
+        except OSError:
+            found = None
+
+        if found == size:
+            job.mark_delivered(frame, path, (size, digest), self)
+            self.health.record_render()
+            self.trace_instant("delivered", frame=frame, size=size)
+            self.release_slot(frame)
+        else:
+            print(f"Frame {frame} from {self.name()} is not in shared storage: expected {size} bytes at {path}, found {found}")
+            self.health.record_failure()
+            job.record_failure(frame, self)
+            self.release_slot(frame, "missing")
+
+    def handle_calibration_complete_message(self, message, msg_str):
+        result = armb.parse_calibration_complete_message(msg_str)
+
+        if result is None:
+            self.err = utils.BadMessageError("Unable to parse COMPLETE CALIBRATE message", message)
+        else:
+            self.speed.record_calibration(result[1])
+            self.trace_instant("calibrated", frame=int(result[0]), seconds=result[1])
+            self.set_status(WorkerView.STATUS_READY)
+
+    def handle_preview_message(self, job, previews, message, msg_str):
+        try:
+            frame_str, extension = armb.parse_preview_message(msg_str)
+            frame = int(frame_str)
+
+            # previews of frames from an earlier job, or that were since given to someone else, are dropped
+            if job and job.frame_start <= frame <= job.frame_end and job.frame_assignments[frame - job.frame_start].assignee is self:
+                previews.add(frame, message.data, extension)
+                self.trace_instant("preview", frame=frame, size=len(message.data))
+        except (ValueError, TypeError) as e:
+            self.err = utils.BadMessageError("Unable to parse PREVIEW message", message)
+
     def handle_reject_upload_message(self, job, message, msg_str):
         try:
             if job:
                 frame = int(armb.parse_reject_upload_message(msg_str))
+                self.upload_frame = None
                 job.mark_irretrievable(frame)
-                self.status = WorkerView.STATUS_READY
+                self.trace_end("upload", f"upload {frame}", result="rejected")
+                self.set_status(WorkerView.STATUS_READY)
         except ValueError as e:
             self.err = utils.BadMessageError("Unable to parse RJECT UPLOAD message", message)
 
-    def handle_upload_complete_message(self, output_dir, job, message, msg_str):
+    def handle_upload_complete_message(self, writer, output_dir, job, message, msg_str):
         try:
-            if job:
-                frame_str, extension = armb.parse_complete_upload_message(msg_str)
-                frame = int(frame_str)
-                job.mark_uploaded(frame)
-                job.write_frame(frame, extension, output_dir, message.data)
-                self.status = WorkerView.STATUS_READY
+            frame_str, extension, mode = armb.parse_complete_upload_message(msg_str)
+            frame = int(frame_str)
+
+            if job and frame == self.upload_frame:
+                path = job.frame_path(frame, extension, output_dir)
+                data, outputs = message.data, []
+
+                if mode:
+                    # the other files go beside the frame, under the names the worker gave them;
+                    # a worker on this computer sends their paths, and they're copied from there
+                    if mode == armb.UPLOAD_LOCAL and not (self.connection.local() and self.local_directory):
+                        raise ValueError("Frame handed over by path without a local connection")
+                    files = unpack_paths(message.data, self.local_directory) if mode == armb.UPLOAD_LOCAL else unpack_bundle(message.data)
+                    data = files[0][1]
+                    outputs = [ (name, os.path.join(os.path.dirname(path), *name.split("/")), file_data) for name, file_data in files[1:] ]
+
+                self.upload_frame = None
+                # the frame only counts as uploaded once the writer has made it durable
+                job.mark_writing(frame)
+                self.trace_end("upload", f"upload {frame}", size=len(message.data), files=1 + len(outputs), local=mode == armb.UPLOAD_LOCAL)
+                if not isinstance(data, str):
+                    message.retain() # a writer thread holds on to the data
+                writer.submit(FrameWrite(self, job, frame, path, data, outputs))
+                self.set_status(WorkerView.STATUS_READY)
         except (ValueError, TypeError) as e:
             self.err = utils.BadMessageError("Unable to parse COMPLETE UPLOAD message", message)
 
-    def request_render_frame(self, job):
-        if self.settings_id == job.settings.synchronization_id:
-            frame = job.assign_next_frame(self)
-            if frame:
-                self.connection.send(armb.new_request_render_message(frame, job.frame_end))
-                self.status = WorkerView.STATUS_RENDERING
+    def request_render_frame(self, job, calibration=0, assign=None):
+        # calibration is a percentage of the job's resolution at which to render a sample frame
+        # first, and assign picks the worker's next frame, the first one waiting by default
+        if not job.manifest and self.manifest_id is not None:
+            self.connection.send(armb.new_clear_manifest_message())
+            self.manifest_id = None
+
+        if job.manifest and self.manifest_id != job.manifest.id:
+            self.connection.send(*armb.new_manifest_message(job.manifest))
+            self.set_status(WorkerView.STATUS_SYNCHRONIZING)
+        elif self.settings_id == job.settings.synchronization_id:
+            if calibration and self.speed.needs_calibration() and not self.rendering():
+                self.request_calibration(job, calibration)
+                return
+
+            slot = self.free_slot() if self.may_render() else None
+            frame = (assign or job.assign_next_frame)(self, slot) if slot is not None else None
+            if frame is not None:
+                self.slot_frames[slot] = frame
+                self.slot_started[slot] = time.time()
+                self.trace_begin(f"slot {slot}", f"render {frame}", "render", frame=frame)
+                self.connection.send(armb.new_request_render_message(frame, job.frame_end, slot))
+                if self.free_slot() is None:
+                    self.set_status(WorkerView.STATUS_RENDERING)
         else:
             self.connection.send(*armb.new_sync_message(job.settings))
-            self.status = WorkerView.STATUS_SYNCHRONIZING
+            self.set_status(WorkerView.STATUS_SYNCHRONIZING)
+
+    def request_calibration(self, job, percentage):
+        frame = (job.frame_start + job.frame_end) // 2
+        self.trace_instant("calibrate", frame=frame, percentage=percentage)
+        self.connection.send(armb.new_calibrate_message(frame, job.frame_end, percentage))
+        self.set_status(WorkerView.STATUS_CALIBRATING)
 
     def request_upload_frame(self, job):
         frame = job.next_for_uploading(self)
 
-        if frame:
+        if frame is not None:
+            self.upload_frame = frame
+            self.trace_begin("upload", f"upload {frame}", "upload", frame=frame)
             self.connection.send(armb.new_request_upload_message(frame, job.frame_end))
-            self.status = WorkerView.STATUS_UPLOADING
+            self.set_status(WorkerView.STATUS_UPLOADING)
+        return frame
+
+    def confirm_upload(self, frame):
+        if self.connected():
+            self.connection.send(armb.new_confirm_upload_message(frame))
 
     def request_clean_frames(self):
         self.connection.send(armb.new_request_cleanup_message())
 
     def cancel_task(self):
         self.connection.send(armb.new_cancel_task_message())
+
+    def cancel_frame(self, frame):
+        # its copy of the frame is no longer needed, so the slot is free for another at once
+        if frame in self.slot_frames:
+            if self.connected():
+                self.connection.send(armb.new_cancel_render_message(frame))
+            self.release_slot(frame, "cancelled")
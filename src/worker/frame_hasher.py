@@ -0,0 +1,47 @@
+import os, threading, queue
+from ..shared import utils
+
+class FrameDigest:
+    def __init__(self, supervisor, frame, path):
+        self.supervisor = supervisor
+        self.frame = frame
+        self.path = path
+        self.size = None
+        self.digest = None
+        self.error = None
+
+    def perform(self):
+        try:
+            self.size = os.path.getsize(self.path)
+            self.digest = utils.file_digest(self.path)
+        except OSError as e:
+            self.error = e
+
+class FrameHasher:
+    # Reads back frames rendered into shared storage on a thread of its own, since hashing a
+    # large frame over the network would hold up every connection until it was done
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = None
+
+    def submit(self, request):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.requests.put(request)
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            request.perform()
+            self.results.put(request)
+
+    def completed(self):
+        finished = []
+
+        while True:
+            try:
+                finished.append(self.results.get_nowait())
+            except queue.Empty:
+                return finished
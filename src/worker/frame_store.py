@@ -0,0 +1,163 @@
+import os, json, time
+
+class FrameRecord:
+    def __init__(self, job, frame, path, size, uploaded=False, created=None, outputs=None):
+        self.job = job
+        self.frame = frame
+        self.path = path
+        self.size = size
+        self.uploaded = uploaded
+        self.created = created or time.time()
+        self.outputs = outputs or [] # the frame's other files, as [name, path], e.g. render passes
+
+    def serialize(self):
+        return [self.job, self.frame, self.path, self.size, self.uploaded, self.created, self.outputs]
+
+class FrameStore:
+    # Tracks the frames this worker rendered, so cleanup and eviction never touch unrelated files.
+    # Each change is appended to a journal, which is folded into the manifest when the store is
+    # loaded or cleaned, so a frame costs one line written rather than the whole manifest.
+    MANIFEST_NAME = ".armb_manifest.json"
+    JOURNAL_NAME = ".armb_manifest.log"
+
+    def __init__(self, directory, quota=None):
+        self.directory = directory
+        self.quota = quota
+        self.records = {}
+        self.total_size = 0
+        self.load()
+
+    def manifest_path(self):
+        return os.path.join(self.directory, FrameStore.MANIFEST_NAME)
+
+    def journal_path(self):
+        return os.path.join(self.directory, FrameStore.JOURNAL_NAME)
+
+    def load(self):
+        try:
+            with open(self.manifest_path(), "r") as f:
+                for entry in json.load(f):
+                    self.add(FrameRecord(*entry))
+        except (OSError, ValueError, TypeError) as e:
+            self.records.clear()
+            self.total_size = 0
+
+        try:
+            with open(self.journal_path(), "r") as f:
+                for line in f:
+                    try:
+                        self.apply(json.loads(line))
+                    except (ValueError, TypeError, IndexError):
+                        pass # a line cut short when the worker stopped
+        except OSError:
+            pass
+
+        if self.records or os.path.exists(self.journal_path()):
+            self.save()
+
+    def apply(self, entry):
+        if entry[0] == "add":
+            self.add(FrameRecord(*entry[1:]))
+        elif entry[0] == "uploaded":
+            record = self.find(entry[1], entry[2])
+            if record:
+                record.uploaded = True
+        elif entry[0] == "remove":
+            self.discard(entry[1], entry[2])
+
+    def log(self, entry):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        with open(self.journal_path(), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def save(self):
+        # writes the manifest afresh, which makes the journal redundant
+        if not self.records:
+            if os.path.exists(self.manifest_path()):
+                os.remove(self.manifest_path())
+        else:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+
+            temp_path = self.manifest_path() + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump([ record.serialize() for record in self.records.values() ], f)
+            os.replace(temp_path, self.manifest_path())
+
+        if os.path.exists(self.journal_path()):
+            os.remove(self.journal_path())
+
+    def add(self, record):
+        self.discard(record.job, record.frame)
+        self.records[(record.job, record.frame)] = record
+        self.total_size += record.size
+
+    def discard(self, job, frame):
+        record = self.records.pop((job, frame), None)
+
+        if record:
+            self.total_size -= record.size
+        return record
+
+    def find(self, job, frame):
+        return self.records.get((job, frame))
+
+    def record_frame(self, job, frame, path, outputs=None):
+        try:
+            outputs = [ [name, output] for name, output in outputs or [] ]
+            size = os.path.getsize(path) + sum(os.path.getsize(output) for name, output in outputs)
+            record = FrameRecord(job, frame, path, size, outputs=outputs)
+            self.add(record)
+            self.log([ "add" ] + record.serialize())
+            self.evict()
+        except OSError as e:
+            print("Unable to record rendered frame", path)
+
+    def confirm_upload(self, job, frame):
+        record = self.find(job, frame)
+
+        if record and not record.uploaded:
+            record.uploaded = True
+            self.log([ "uploaded", job, frame ])
+            self.evict()
+
+    def evict(self):
+        if self.quota is None or self.total_size <= self.quota:
+            return
+
+        confirmed = sorted((r for r in self.records.values() if r.uploaded), key=lambda r: r.created)
+        for record in confirmed:
+            if self.total_size <= self.quota:
+                break
+            self.remove(record)
+
+    def remove(self, record, log=True):
+        for path in [ record.path ] + [ output for name, output in record.outputs ]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.discard(record.job, record.frame)
+        if log:
+            self.log([ "remove", record.job, record.frame ])
+
+        # a sharded layout leaves a directory per shard, which goes with its last frame
+        if os.path.dirname(os.path.abspath(record.path)) != os.path.abspath(self.directory).rstrip(os.sep):
+            self.remove_directory(os.path.dirname(record.path))
+
+    def remove_directory(self, directory):
+        # only empty directories are removed, which needs no listing
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+    def clean(self, jobs=None):
+        for record in list(self.records.values()):
+            if jobs is None or record.job in jobs:
+                self.remove(record, log=False)
+        self.save()
+
+        self.remove_directory(self.directory)
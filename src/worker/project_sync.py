@@ -0,0 +1,56 @@
+import threading
+from collections import deque
+
+class ProjectSync:
+    # Fetches the blocks of a manifest that aren't cached yet, a batch at a time
+    BATCH_SIZE = 8 << 20
+
+    def __init__(self, store, manifest):
+        self.store = store
+        self.manifest = manifest
+        self.block_sizes = manifest.block_sizes()
+        self.missing = deque(store.missing(manifest))
+        self.requested = []
+        self.thread = None # writing out the project, once every block is here
+        self.project_file = None
+        self.error = None
+
+    def complete(self):
+        return not self.missing and not self.requested
+
+    def next_batch(self):
+        batch_size = 0
+
+        while self.missing and (not self.requested or batch_size + self.block_sizes[self.missing[0]] <= ProjectSync.BATCH_SIZE):
+            h = self.missing.popleft()
+            batch_size += self.block_sizes[h]
+            self.requested.append(h)
+
+        return self.requested
+
+    def receive(self, blocks):
+        if len(blocks) != len(self.requested):
+            return False
+
+        for h, data in zip(self.requested, blocks):
+            if not self.store.put(h, data):
+                return False
+
+        self.requested = []
+        return True
+
+    def materialize(self, project_dir=None):
+        # on a thread of its own, since writing out a large project would hold up every
+        # connection until it was done; see materialized
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run_materialize, args=(project_dir,), daemon=True)
+            self.thread.start()
+
+    def run_materialize(self, project_dir):
+        try:
+            self.project_file = self.store.materialize(self.manifest, project_dir)
+        except OSError as e:
+            self.error = e
+
+    def materialized(self):
+        return self.thread is not None and not self.thread.is_alive()
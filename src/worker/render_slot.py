@@ -0,0 +1,133 @@
+import subprocess
+from ..blender import blender
+
+class RenderSlot:
+    RESULT_FINISHED = 'FINISHED'
+    RESULT_CANCELLED = 'CANCELLED'
+
+    def __init__(self, index):
+        self.index = index
+        self.task = None
+        self.result = None
+        self.output_file = None # where the frame was written, if not the usual path
+        self.output_digest = None # its size and hash, if already known
+
+    def idle(self):
+        return self.task is None
+
+    def assign(self, task):
+        self.task = task
+        self.result = None
+        self.output_file = None
+        self.output_digest = None
+
+    def release(self):
+        self.task = None
+        self.result = None
+        self.output_file = None
+        self.output_digest = None
+
+    def activate(self):
+        pass
+
+    def deactivate(self):
+        self.cancel()
+
+    def start(self, settings, path, blend_file=None):
+        return False
+
+    def poll(self):
+        result, self.result = self.result, None
+        return result
+
+    def cancel(self):
+        pass
+
+    def description(self):
+        return f"Slot {self.index}"
+
+class ProcessRenderSlot(RenderSlot):
+    def __init__(self, index, device=None, threads=None):
+        super().__init__(index)
+        self.device = device
+        self.threads = threads
+        self.process = None
+
+    def start(self, settings, path, blend_file=None):
+        command = blender.render_process_command(self.task.frame, path, settings, self.device, self.threads, blend_file)
+
+        if command:
+            try:
+                self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                return True
+            except OSError as e:
+                print("Unable to start render process:", e)
+        return False
+
+    def poll(self):
+        if self.process and self.process.poll() is not None:
+            returncode = self.process.returncode
+            self.process = None
+            return RenderSlot.RESULT_FINISHED if returncode == 0 else RenderSlot.RESULT_CANCELLED
+
+    def cancel(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+    def description(self):
+        details = [ self.device or "default device" ]
+        if self.threads:
+            details.append(f"{self.threads} threads")
+        return f"Slot {self.index} ({', '.join(details)})"
+
+class LocalRenderSlot(ProcessRenderSlot):
+    # renders inside this Blender process, so only one local slot may exist per worker. Files
+    # other than the open one, e.g. synchronized projects, are rendered in a background process.
+    def __init__(self, index, original_settings):
+        super().__init__(index)
+        self.original_settings = original_settings
+
+    def activate(self):
+        blender.set_render_callbacks(self.handle_render_complete, self.handle_render_cancel)
+
+    def deactivate(self):
+        self.cancel()
+        blender.clear_render_callbacks()
+        blender.apply_render_settings(self.original_settings)
+
+    def start(self, settings, path, blend_file=None):
+        if blend_file and blend_file != blender.current_file():
+            return super().start(settings, path, blend_file)
+
+        blender.apply_render_settings(settings)
+        return 'CANCELLED' not in blender.render_frame(self.task.frame, path)
+
+    def poll(self):
+        if self.process:
+            return super().poll()
+        return RenderSlot.poll(self)
+
+    def handle_render_complete(self, scene, bpy_context):
+        blender.apply_render_settings(self.original_settings)
+        self.result = RenderSlot.RESULT_FINISHED
+
+    def handle_render_cancel(self, scene, bpy_context):
+        blender.apply_render_settings(self.original_settings)
+        self.result = RenderSlot.RESULT_CANCELLED
+
+    def description(self):
+        return f"Slot {self.index} (this window)"
+
+def create_render_slots(count, original_settings, local=True, devices=None, threads=None):
+    slots = []
+    devices = devices or [None]
+    process_slots = 0
+
+    for i in range(count):
+        if i == 0 and local:
+            slots.append(LocalRenderSlot(i, original_settings))
+        else:
+            slots.append(ProcessRenderSlot(i, devices[process_slots % len(devices)], threads))
+            process_slots += 1
+
+    return slots
@@ -1,6 +1,108 @@
+import time
+from collections import deque
+
 class SupervisorView:
-    def __init__(self):
+    # One connected supervisor: its connection, job and synchronized files, the frames it has
+    # assigned to this worker, and how much render time it has used
+    def __init__(self, index=0, connection=None, address=None, slot_count=1, output_dir="", project_dir=None, weight=1):
         self.identity = None
+        self.index = index
+        self.connection = connection
+        self.address = address
+        self.output_dir = output_dir
+        self.project_dir = project_dir
+        self.weight = weight
+        self.err = None
+
+        self.render_settings = None
+        self.job_id = 0
+        self.job_ids = set()
+        self.project_sync = None
+        self.project_file = None
+        self.project_manifest = None
+
+        self.tasks = [ None ] * slot_count # by the supervisor's slot numbers
+        self.queue = deque() # tasks waiting for a render slot
+        self.running = {} # task -> start time
+        self.cancel_pending = False
+        self.reserved_since = None # when a free slot started waiting for this supervisor's next frame
+        self.reservation_missed = False
+        self.stopped_at = None # when a render last finished or was cancelled
+
+        self.render_time = 0.0
+        self.frames_rendered = 0
+        self.frames_failed = 0
 
     def verified(self):
         return not self.identity is None
+
+    def name(self):
+        return self.identity or (f"{self.address[0]}:{self.address[1]}" if self.address else "supervisor")
+
+    def connected(self):
+        return self.connection and self.connection.ok()
+
+    def error(self):
+        if self.err:
+            return self.err
+        elif self.connection and self.connection.error:
+            return self.connection.error
+
+    def shared_output(self):
+        return self.render_settings.shared_output if self.render_settings else None
+
+    def shard_size(self):
+        return self.render_settings.shard_size if self.render_settings else 0
+
+    def frame_directory(self):
+        # frames of a job with shared storage go straight there, and are not kept here
+        return self.shared_output() or self.output_dir
+
+    def active(self):
+        return bool(self.queue or self.running)
+
+    def usage(self):
+        # render seconds used, including renders still in progress
+        now = time.time()
+        return self.render_time + sum(now - started for started in self.running.values())
+
+    def share(self):
+        return self.usage() / self.weight
+
+    def add_task(self, slot, task):
+        self.tasks[slot] = task
+        self.queue.append(task)
+
+    def free_slot(self, task):
+        for i, t in enumerate(self.tasks):
+            if t is task:
+                self.tasks[i] = None
+
+    def remove_task(self, task):
+        self.free_slot(task)
+        if task in self.queue:
+            self.queue.remove(task)
+        self.task_stopped(task)
+
+    def task_started(self, task):
+        self.running[task] = time.time()
+
+    def task_stopped(self, task):
+        started = self.running.pop(task, None)
+        if started is not None:
+            self.stopped_at = time.time()
+            self.render_time += self.stopped_at - started
+
+    def task_count(self):
+        return sum(1 for t in self.tasks if t)
+
+    def recently_active(self, now, window):
+        return self.active() or (self.stopped_at is not None and now - self.stopped_at <= window)
+
+    def may_send_task(self, now, window):
+        # rendering or just finished, with a slot free for another frame, which usually arrives
+        # right after a render
+        return self.recently_active(now, window) and self.task_count() < len(self.tasks) and not self.reservation_missed
+
+    def statistics(self):
+        return { "frames_rendered": self.frames_rendered, "frames_failed": self.frames_failed, "render_seconds": self.usage(), "weight": self.weight, "queued": len(self.queue), "rendering": len(self.running) }
@@ -1,4 +1,4 @@
-import socket
+import socket, os, time
 from ..protocol.connection import ARMBConnection, ARMBMessageTimeoutError, ARMBMessageFormatError
 from ..protocol import armb
 from ..shared.render_settings import RenderSettings
@@ -6,62 +6,133 @@ from ..blender import blender
 from ..shared import utils
 from ..shared.task import RenderTask
 from .supervisor_view import SupervisorView
+from .render_slot import RenderSlot, create_render_slots
+from .frame_store import FrameStore
+from .project_sync import ProjectSync
+from .frame_hasher import FrameHasher, FrameDigest
+from ..protocol.discovery import Announcer, DISCOVERY_PORT
+from ..protocol.metrics import ConnectionMetrics, MetricsExporter, metric_name
+from ..shared.trace import Tracer
+from ..shared.file_sync import FileManifest, BlockStore, unpack_blocks
+from ..shared.frame_bundle import pack_bundle, pack_paths, inside
+from ..protocol.local import listen_locally, stop_listening_locally
+
+def parse_supervisor_weights(text):
+    # "studio=3, laptop=1" -> { "studio": 3.0, "laptop": 1.0 }, keyed by the supervisor's host name
+    weights = {}
+    for item in text.split(","):
+        if item.strip():
+            identity, _, weight = item.partition("=")
+            weights[identity.strip()] = float(weight)
+            if weights[identity.strip()] <= 0:
+                raise ValueError(f"Weight for {identity.strip()} must be positive")
+    return weights
+
+def error_description(error):
+    if isinstance(error, ConnectionRefusedError):
+        return "Unable to connect"
+    elif isinstance(error, ConnectionError):
+        return "Connection lost or rejected"
+    elif isinstance(error, ARMBMessageFormatError):
+        return "Received an invalid message (is this an ARMB supervisor?)"
+    elif isinstance(error, ARMBMessageTimeoutError):
+        return "Connection timed out"
+    elif isinstance(error, utils.BadMessageError):
+        return "Received an unknown message (check version)"
+    else:
+        return f"Internal Error: {error}"
 
 class Worker:
-    def __init__(self, output_dir, port, timeout=10):
+    RESERVATION_TIME = 1.0
+
+    def __init__(self, output_dir, port, timeout=10, slots=None, storage_quota=None, announce=False, announce_address='<broadcast>', discovery_port=DISCOVERY_PORT, max_supervisors=4, supervisor_weights=None, preview_size=160, local_socket=True):
         self.output_dir = output_dir
+        self.store = FrameStore(output_dir, storage_quota)
+        self.hasher = FrameHasher() # for frames rendered into shared storage
+        self.block_store = BlockStore(os.path.join(output_dir, ".armb_sync"))
         self.port = port
         self.local_ip = utils.get_local_ip()
         self.timeout = timeout
         self.socket = None
-        self.connection = None
-        self.supervisor = None
+        self.local_socket = local_socket # also listen on a Unix domain socket for supervisors on this computer
+        self.local_listener = None
+        self.supervisors = []
+        self.max_supervisors = max_supervisors
+        self.supervisor_weights = supervisor_weights or {}
+        self.preview_size = preview_size # pixels across the previews sent after each frame, 0 for none
         self.err = None
+        self.announce = announce
+        self.announce_destination = (announce_address, discovery_port)
+        self.announcer = None
+        self.metrics_exporter = None
+        self.tracer = Tracer("ARMB Worker")
 
-        self.render_settings = None
         self.original_render_settings = blender.create_render_settings()
-        self.task = None
+        self.slots = slots or create_render_slots(1, self.original_render_settings)
         self.closed = False
 
     def connected(self):
-        return self.connection and self.connection.ok() and not self.closed
+        return not self.closed and any(supervisor.connected() for supervisor in self.supervisors)
 
     def ok(self):
         return self.error() is None
 
+    def tasks(self):
+        return [ slot.task for slot in self.slots if slot.task ]
+
     def error(self):
-        if self.err:
-            return self.err
-        elif self.connection and self.connection.error:
-            return self.connection.error
+        return self.err
+
+    def connection_metrics(self):
+        return { supervisor.name(): supervisor.connection.metrics for supervisor in self.supervisors }
+
+    def supervisor_statistics(self):
+        return { supervisor.name(): supervisor.statistics() for supervisor in self.supervisors }
+
+    def enable_metrics_export(self, path, format='json', interval=10):
+        self.metrics_exporter = MetricsExporter(path, format, interval)
+
+    def disable_metrics_export(self):
+        self.metrics_exporter = None
+
+    def metrics_extra(self):
+        extra = { "slots_busy": len(self.tasks()), "slots": len(self.slots), "supervisors": len(self.supervisors) }
+
+        for supervisor in self.supervisors:
+            name = metric_name(supervisor.name())
+            extra[f"supervisor_{name}_render_seconds"] = supervisor.usage()
+            extra[f"supervisor_{name}_frames_rendered"] = supervisor.frames_rendered
+        return extra
+
+    def export_trace(self, path):
+        self.tracer.export_chrome(path)
+
+    def utilization(self):
+        return self.tracer.utilization()
 
     def status_message(self):
         error = self.error()
+        syncing = [ supervisor.project_sync for supervisor in self.supervisors if supervisor.project_sync ]
+        connected = [ supervisor for supervisor in self.supervisors if supervisor.connected() ]
+        sharing = f" for {len(connected)} supervisors" if len(connected) > 1 else ""
 
         if error:
-            if isinstance(error, ConnectionRefusedError):
-                return "Unable to connect"
-            elif isinstance(error, ConnectionError):
-                return "Connection lost or rejected"
-            elif isinstance(error, ARMBMessageFormatError):
-                return "Received an invalid message (is this an ARMB supervisor?)"
-            elif isinstance(error, ARMBMessageTimeoutError):
-                return "Connection timed out"
-            elif isinstance(error, utils.BadMessageError):
-                return "Received an unknown message (check version)"
-            else:
-                return f"Internal Error: {error}"
-        elif self.task:
-            return f"Rendering frame {self.task.frame}"
-        elif self.connected():
-            return f"Ready on port {self.port}"
+            return error_description(error)
+        elif syncing:
+            return f"Synchronizing files ({sum(len(sync.missing) + len(sync.requested) for sync in syncing)} blocks left)"
+        elif self.tasks():
+            frames = ", ".join(str(task.frame) for task in self.tasks())
+            return f"Rendering frame{'s' if len(self.tasks()) > 1 else ''} {frames}{sharing}"
+        elif connected:
+            return f"Ready on port {self.port}{sharing}"
         else:
             if self.local_ip:
                 return f"Waiting on {self.local_ip}:{self.port}"
             return f"Waiting on port {self.port}"
 
     def start(self):
-        blender.set_render_callbacks(self.handle_render_complete, self.handle_render_cancel)
+        for slot in self.slots:
+            slot.activate()
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -69,151 +140,490 @@ class Worker:
         self.socket.bind(("", self.port))
         self.socket.listen()
 
+        if self.local_socket:
+            self.local_listener = listen_locally(self.port)
+
+        if self.announce:
+            self.announcer = Announcer(self.port, *self.announce_destination)
+
     def restart(self):
         if self.closed:
             self.stop()
             self.start()
-        elif self.connection and not self.connect.closed:
-            self.connection.close()
+        else:
+            for supervisor in self.supervisors:
+                supervisor.connection.close()
 
-        self.task = None
-        self.supervisor = None
-        self.connection = None
+        for slot in self.slots:
+            slot.release()
+        self.supervisors.clear()
         self.closed = False
         self.err = None
 
     def stop(self):
         self.closed = True
-        blender.clear_render_callbacks()
-        blender.apply_render_settings(self.original_render_settings)
-        if self.connection:
-            self.connection.close()
+        for slot in self.slots:
+            slot.deactivate()
+        for supervisor in self.supervisors:
+            supervisor.connection.close()
+        if self.announcer:
+            self.announcer.close()
+            self.announcer = None
         self.socket.close()
+        stop_listening_locally(self.local_listener)
+        self.local_listener = None
 
     def update(self):
+        if self.metrics_exporter:
+            self.metrics_exporter.update(self.connection_metrics(), self.metrics_extra())
+
         if self.ok():
             if not self.closed:
-                readable, writeable = utils.socket_status(self.socket)
-                if readable:
-                    if self.connected():
-                        self.reject_connection()
-                    else:
-                        self.accept_connection()
-
-            if self.connected():
-                self.connection.update()
-
-                if self.connection.finished_receiving():
-                    self.handle_message(self.connection.receive())
-
-                if self.task and not self.task.started:
-                    blender.apply_render_settings(self.render_settings)
-                    path = utils.filename_for_frame(self.task.frame, self.task.max_frame, '', self.output_dir)
-                    if 'CANCELLED' not in blender.render_frame(self.task.frame, path):
-                        self.task.started = True
-            elif self.connection and self.connection.closed:
-                self.stop()
-
-    def accept_connection(self):
-        sock, addr = self.socket.accept()
+                if self.announcer and len(self.supervisors) < self.max_supervisors:
+                    self.announcer.update()
+
+                for listener in (self.socket, self.local_listener):
+                    if listener and utils.socket_status(listener)[0]:
+                        if len(self.supervisors) < self.max_supervisors:
+                            self.accept_connection(listener)
+                        else:
+                            self.reject_connection(listener)
+
+            for supervisor in list(self.supervisors):
+                if supervisor.connected():
+                    supervisor.connection.update()
+
+                    if supervisor.connection.finished_receiving():
+                        self.handle_message(supervisor, supervisor.connection.receive())
+
+                if supervisor.error() or supervisor.connection.closed:
+                    self.disconnect(supervisor)
+
+            self.schedule()
+            for slot in self.slots:
+                self.update_slot(slot)
+
+            for request in self.hasher.completed():
+                if request.supervisor in self.supervisors and request.supervisor.connected():
+                    self.deliver_frame(request.supervisor, request.frame, request.path, request.size, request.digest, request.error)
+
+            for supervisor in self.supervisors:
+                if supervisor.project_sync and supervisor.project_sync.materialized():
+                    self.finish_project_sync(supervisor)
+                if supervisor.cancel_pending and not supervisor.running:
+                    supervisor.connection.send(armb.new_confirm_cancelled_message())
+                    supervisor.cancel_pending = False
+
+    def schedule(self):
+        for slot in self.slots:
+            if slot.idle():
+                supervisor = self.next_supervisor()
+                if not supervisor or not supervisor.queue:
+                    return
+
+                supervisor.reserved_since = None
+                slot.assign(supervisor.queue.popleft())
+
+    def next_supervisor(self):
+        # The supervisor that has used the least render time for its weight gets the next slot. If
+        # it has no frame waiting yet but is about to send one, the slot is held for it briefly,
+        # otherwise whoever already has a frame queued would take every slot that comes free.
+        now = time.time()
+
+        while True:
+            candidates = [ supervisor for supervisor in self.supervisors if supervisor.queue or supervisor.may_send_task(now, Worker.RESERVATION_TIME) ]
+            if not candidates:
+                return None
+
+            supervisor = min(candidates, key=lambda s: s.share())
+            if supervisor.queue:
+                return supervisor
+            elif supervisor.reserved_since is None:
+                supervisor.reserved_since = now
+                return supervisor
+            elif now - supervisor.reserved_since <= Worker.RESERVATION_TIME:
+                return supervisor
+
+            supervisor.reserved_since = None
+            supervisor.reservation_missed = True
+
+    def update_slot(self, slot):
+        if slot.task and not slot.task.started:
+            supervisor = slot.task.owner
+            settings = supervisor.render_settings
+            path = utils.filename_for_frame(slot.task.frame, slot.task.max_frame, '', supervisor.frame_directory(), supervisor.shard_size())
+            if slot.task.calibration:
+                settings, path = self.calibration_settings(settings, slot.task.calibration), self.calibration_path(slot.task, '')
+            if slot.start(settings, path, supervisor.project_file):
+                slot.task.started = True
+                supervisor.task_started(slot.task)
+                self.tracer.begin(f"slot {slot.index}", "render", "render", group="worker", frame=slot.task.frame, attempt=slot.task.attempts + 1, supervisor=supervisor.name())
+        elif slot.task:
+            result = slot.poll()
+
+            if result == RenderSlot.RESULT_FINISHED:
+                self.handle_render_complete(slot)
+            elif result == RenderSlot.RESULT_CANCELLED:
+                self.handle_render_cancel(slot)
+
+    def accept_connection(self, listener):
+        sock, addr = listener.accept()
         sock.setblocking(False)
-        self.connection = ARMBConnection(sock, self.timeout)
-        self.supervisor = SupervisorView()
-        self.connection.send(armb.new_identity_message())
-        self.update()
+        if listener is self.local_listener:
+            addr = ("unix", listener.getsockname())
+
+        # the first supervisor uses the output directory itself, so a single supervisor sees no change
+        used = { supervisor.index for supervisor in self.supervisors }
+        index = min(i for i in range(self.max_supervisors) if i not in used)
+        output_dir = os.path.join(self.output_dir, f"supervisor{index}", "") if index else self.output_dir
+        project_dir = os.path.join(self.block_store.directory, f"project{index}") if index else None
+
+        supervisor = SupervisorView(index, ARMBConnection(sock, self.timeout, ConnectionMetrics()), addr, len(self.slots), output_dir, project_dir)
+        self.supervisors.append(supervisor)
+        self.tracer.instant("connection", "connect", "event", group="worker", address=f"{addr[0]}:{addr[1]}")
+        if listener is self.local_listener:
+            supervisor.connection.send(*armb.new_local_identity_message(len(self.slots), os.path.abspath(self.output_dir)))
+        else:
+            supervisor.connection.send(armb.new_identity_message(len(self.slots)))
 
-    def reject_connection(self):
-        sock, addr = self.socket.accept()
+    def reject_connection(self, listener):
+        sock, addr = listener.accept()
+        if listener is self.local_listener:
+            addr = ("unix", listener.getsockname())
+        self.tracer.instant("connection", "reject connection", "event", group="worker", address=f"{addr[0]}:{addr[1]}")
         sock.close()
 
-    def handle_message(self, message):
+    def disconnect(self, supervisor):
+        if supervisor.error():
+            print(f"Disconnected from {supervisor.name()}: {error_description(supervisor.error())}")
+        self.tracer.instant("connection", "disconnect", "event", group="worker", supervisor=supervisor.name())
+
+        self.cancel_tasks(supervisor)
+        supervisor.connection.close()
+        self.supervisors.remove(supervisor)
+
+    def handle_message(self, supervisor, message):
         msg_str = message.message.tobytes().decode()
 
         if msg_str.startswith("IDENTITY "):
-            self.handle_identity_message(message, msg_str)
+            self.handle_identity_message(supervisor, message, msg_str)
         elif msg_str.startswith("SYNCHRONIZE "):
-            self.handle_synchronize_message(message, msg_str)
+            self.handle_synchronize_message(supervisor, message, msg_str)
+        elif msg_str.startswith("MANIFEST "):
+            self.handle_manifest_message(supervisor, message, msg_str)
+        elif msg_str.startswith("BLOCKS "):
+            self.handle_blocks_message(supervisor, message, msg_str)
+        elif msg_str.startswith("CLEAR MANIFEST"):
+            self.handle_clear_manifest_message(supervisor)
         elif msg_str.startswith("RENDER "):
-            self.handle_render_message(message, msg_str)
+            self.handle_render_message(supervisor, message, msg_str)
+        elif msg_str.startswith("CALIBRATE "):
+            self.handle_calibrate_message(supervisor, message, msg_str)
         elif msg_str.startswith("UPLOAD "):
-            self.handle_upload_message(message, msg_str)
+            self.handle_upload_message(supervisor, message, msg_str)
+        elif msg_str.startswith("CONFIRM UPLOAD "):
+            self.handle_confirm_upload_message(supervisor, message, msg_str)
+        elif msg_str.startswith("CANCEL RENDER "):
+            self.handle_cancel_render_message(supervisor, message, msg_str)
         elif msg_str.startswith("CANCEL"):
-            self.handle_cancel_message()
+            self.handle_cancel_message(supervisor)
         elif msg_str.startswith("CLEANUP"):
-            self.handle_cleanup_message()
+            self.handle_cleanup_message(supervisor)
         else:
-            self.err = utils.BadMessageError("Unable to parse unknown message", message)
+            supervisor.err = utils.BadMessageError("Unable to parse unknown message", message)
 
-    def handle_identity_message(self, message, msg_str):
-        id = armb.parse_identity_message(msg_str)
+    def handle_identity_message(self, supervisor, message, msg_str):
+        id, slots = armb.parse_identity_message(msg_str)
         if id:
-            self.supervisor.identity = id
+            supervisor.identity = id
+            supervisor.weight = self.supervisor_weights.get(id, supervisor.weight)
         else:
-            self.err = utils.BadMessageError("Unable to parse IDENTITY message", message)
+            supervisor.err = utils.BadMessageError("Unable to parse IDENTITY message", message)
 
-    def handle_synchronize_message(self, message, msg_str):
+    def handle_synchronize_message(self, supervisor, message, msg_str):
         id = armb.parse_sync_message(msg_str) or 0
         data = message.data.tobytes().decode()
-        self.render_settings = RenderSettings.deserialize(data)
-        self.connection.send(armb.new_confirm_sync_message(id))
+        supervisor.render_settings = RenderSettings.deserialize(data)
+        supervisor.job_id = int(id)
+        supervisor.job_ids.add(supervisor.job_id)
+        supervisor.connection.send(armb.new_confirm_sync_message(id))
 
-    def handle_render_message(self, message, msg_str):
+    def handle_manifest_message(self, supervisor, message, msg_str):
         try:
-            frame_str, max_frame_str = armb.parse_request_render_message(msg_str)
-            frame, max_frame = int(frame_str), int(max_frame_str)
+            manifest = FileManifest.deserialize(message.data.tobytes().decode())
+            supervisor.project_sync = ProjectSync(self.block_store, manifest)
+            self.tracer.begin(f"sync {supervisor.index}", "synchronize files", "sync", group="worker", manifest=manifest.id, blocks=len(supervisor.project_sync.missing))
+            self.continue_project_sync(supervisor)
+        except (ValueError, KeyError, TypeError) as e:
+            supervisor.err = utils.BadMessageError("Unable to parse MANIFEST message", message)
+
+    def handle_blocks_message(self, supervisor, message, msg_str):
+        manifest_id = armb.parse_blocks_message(msg_str)
+
+        if supervisor.project_sync and manifest_id == supervisor.project_sync.manifest.id:
+            if supervisor.project_sync.receive(unpack_blocks(message.data)):
+                self.continue_project_sync(supervisor)
+            else:
+                supervisor.err = utils.BadMessageError("Received corrupted BLOCKS message", message)
 
-            if not self.supervisor.verified() or self.task:
-                self.connection.send(armb.new_reject_render_message(frame))
+    def finish_project_sync(self, supervisor):
+        sync = supervisor.project_sync
+        supervisor.project_sync = None
+
+        if sync.error:
+            supervisor.err = sync.error
+        else:
+            supervisor.project_file = sync.project_file
+            supervisor.project_manifest = sync.manifest
+            self.tracer.end(f"sync {supervisor.index}", "synchronize files")
+            supervisor.connection.send(armb.new_confirm_manifest_message(sync.manifest.id))
+
+    def handle_clear_manifest_message(self, supervisor):
+        if supervisor.project_sync:
+            self.tracer.end(f"sync {supervisor.index}", "synchronize files")
+        supervisor.project_sync = None
+        supervisor.project_file = None
+        supervisor.project_manifest = None
+
+    def continue_project_sync(self, supervisor):
+        manifest_id = supervisor.project_sync.manifest.id
+
+        if supervisor.project_sync.complete():
+            supervisor.project_sync.materialize(supervisor.project_dir)
+        else:
+            supervisor.connection.send(*armb.new_request_blocks_message(manifest_id, supervisor.project_sync.next_batch()))
+
+    def handle_render_message(self, supervisor, message, msg_str):
+        try:
+            frame_str, max_frame_str, slot_str = armb.parse_request_render_message(msg_str)
+            frame, max_frame, slot = int(frame_str), int(max_frame_str), int(slot_str)
+
+            if not supervisor.verified() or slot >= len(supervisor.tasks) or supervisor.tasks[slot]:
+                self.tracer.instant("connection", "reject render", "event", group="worker", frame=frame, slot=slot)
+                supervisor.connection.send(armb.new_reject_render_message(frame))
             else:
-                self.task = RenderTask(frame, max_frame)
+                if not supervisor.recently_active(time.time(), Worker.RESERVATION_TIME):
+                    # a supervisor returning from idle starts level with the busiest, instead of
+                    # taking every slot until it has caught up on the time it did not need
+                    shares = [ s.share() for s in self.supervisors if s is not supervisor and s.active() ]
+                    if shares:
+                        supervisor.render_time = max(supervisor.render_time, min(shares) * supervisor.weight)
+                supervisor.add_task(slot, RenderTask(frame, max_frame, supervisor))
+                supervisor.reservation_missed = False
         except ValueError as e:
-            self.err = utils.BadMessageError("Unable to parse RENDER message", message)
+            supervisor.err = utils.BadMessageError("Unable to parse RENDER message", message)
 
-    def handle_upload_message(self, message, msg_str):
+    def handle_calibrate_message(self, supervisor, message, msg_str):
+        try:
+            frame_str, max_frame_str, percentage_str = armb.parse_calibrate_message(msg_str)
+            frame, max_frame, percentage = int(frame_str), int(max_frame_str), int(percentage_str)
+
+            # the supervisor only asks while it has no frames here, so the first slot is free
+            if not supervisor.verified() or not supervisor.render_settings or supervisor.tasks[0] or not 0 < percentage <= 100:
+                supervisor.connection.send(armb.new_calibration_complete_message(frame))
+            else:
+                task = RenderTask(frame, max_frame, supervisor)
+                task.calibration = percentage
+                supervisor.add_task(0, task)
+        except (ValueError, TypeError) as e:
+            supervisor.err = utils.BadMessageError("Unable to parse CALIBRATE message", message)
+
+    def calibration_settings(self, settings, percentage):
+        # the job's settings at a fraction of its resolution, written here rather than to shared storage
+        settings = RenderSettings.deserialize(settings.serialize())
+        settings.percentage = max(1, round(settings.percentage * percentage / 100))
+        settings.shared_output = None
+        return settings
+
+    def calibration_path(self, task, extension):
+        return utils.filename_for_frame(task.frame, task.max_frame, extension, os.path.join(self.output_dir, ".armb_calibration", ""))
+
+    def finish_calibration(self, slot, finished):
+        # only the time it took goes back, and the sample frame is deleted
+        supervisor = slot.task.owner
+        started = supervisor.running.get(slot.task)
+        seconds = time.time() - started if finished and started is not None else None
+        self.tracer.end(f"slot {slot.index}", "render", result="calibrated" if seconds is not None else "cancelled")
+
+        supervisor.remove_task(slot.task)
+        supervisor.connection.send(armb.new_calibration_complete_message(slot.task.frame, seconds))
+        try:
+            os.remove(slot.output_file or self.calibration_path(slot.task, blender.filename_extension()))
+        except OSError:
+            pass
+        slot.release()
+
+    def handle_upload_message(self, supervisor, message, msg_str):
         try:
             frame_str, max_frame_str = armb.parse_request_upload_message(msg_str)
             frame, max_frame = int(frame_str), int(max_frame_str)
-            filepath = utils.filename_for_frame(frame, max_frame, blender.filename_extension(), self.output_dir)
+            record = self.store.find(supervisor.job_id, frame)
+            filepath = record.path if record else utils.filename_for_frame(frame, max_frame, blender.filename_extension(), supervisor.output_dir, supervisor.shard_size())
+            extension = os.path.splitext(filepath)[1] if record else blender.filename_extension()
 
-            if not self.supervisor.verified():
-                self.connection.send(armb.new_reject_upload_message(frame))
+            if not supervisor.verified():
+                supervisor.connection.send(armb.new_reject_upload_message(frame))
             else:
                 try:
-                    with open(filepath, "rb") as f:
-                        self.connection.send(armb.new_complete_upload_message(frame, blender.filename_extension()), f.read())
-                except FileNotFoundError:
+                    self.tracer.begin("upload", "upload", "upload", group="worker", frame=frame, supervisor=supervisor.name())
+                    if supervisor.connection.local() or (record and record.outputs):
+                        self.upload_files(supervisor, frame, extension, filepath, record.outputs if record else [])
+                    else:
+                        with open(filepath, "rb") as f:
+                            supervisor.connection.send(armb.new_complete_upload_message(frame, extension), f.read())
+                except OSError:
                     print("Unable to open", filepath)
-                    self.connection.send(armb.new_reject_upload_message(frame))
+                    supervisor.connection.send(armb.new_reject_upload_message(frame))
+                finally:
+                    self.tracer.end("upload", "upload")
         except ValueError as e:
-            self.err = utils.BadMessageError("Unable to parse UPLOAD message", message)
+            supervisor.err = utils.BadMessageError("Unable to parse UPLOAD message", message)
+
+    def upload_files(self, supervisor, frame, extension, filepath, outputs):
+        # every file of the frame in one message, rather than a round trip for each, and a
+        # supervisor on this computer only needs to know where they are
+        if not os.path.exists(filepath):
+            raise FileNotFoundError(filepath)
+
+        files = [ ("", filepath) ]
+        for name, path in outputs:
+            if os.path.exists(path):
+                files.append((name, path))
+            else:
+                print("Unable to open", path)
 
-    def handle_cancel_message(self):
-        if self.task:
-            self.task.remote_cancelled = True
+        # the supervisor only copies files from the output directory, e.g. not File Output passes elsewhere
+        if supervisor.connection.local() and all(inside(os.path.realpath(path), os.path.realpath(self.output_dir)) for name, path in files):
+            supervisor.connection.send(armb.new_complete_upload_message(frame, extension, armb.UPLOAD_LOCAL), pack_paths(files))
         else:
-            self.connection.send(armb.new_confirm_cancelled_message())
+            supervisor.connection.send(armb.new_complete_upload_message(frame, extension, armb.UPLOAD_BUNDLE), pack_bundle(files))
 
-    def handle_render_complete(self, scene, bpy_context):
-        if self.task.remote_cancelled:
-            self.connection.send(armb.new_confirm_cancelled_message())
+    def handle_confirm_upload_message(self, supervisor, message, msg_str):
+        frame = armb.parse_confirm_upload_message(msg_str)
+
+        if frame is None:
+            supervisor.err = utils.BadMessageError("Unable to parse CONFIRM UPLOAD message", message)
         else:
-            self.connection.send(armb.new_render_complete_message(self.task.frame))
+            self.store.confirm_upload(supervisor.job_id, int(frame))
+
+    def handle_cancel_message(self, supervisor):
+        self.tracer.instant("connection", "cancel", "event", group="worker", supervisor=supervisor.name())
 
-        blender.apply_render_settings(self.original_render_settings)
-        self.task = None
+        self.cancel_tasks(supervisor)
 
-    def handle_render_cancel(self, scene, bpy_context):
-        if self.task.remote_cancelled:
-            self.connection.send(armb.new_confirm_cancelled_message())
-            self.task = None
+        if supervisor.running:
+            supervisor.cancel_pending = True
         else:
-            self.task.started = False
-            self.task.record_failed_attempt()
-            if self.task.failed():
-                self.connection.send(armb.new_reject_render_message(self.task.frame))
-                self.task = None
+            supervisor.connection.send(armb.new_confirm_cancelled_message())
 
-        blender.apply_render_settings(self.original_render_settings)
+    def handle_cancel_render_message(self, supervisor, message, msg_str):
+        # the supervisor has already freed the slot, so there is nothing to confirm
+        frame = armb.parse_cancel_render_message(msg_str)
 
-    def handle_cleanup_message(self):
-        utils.delete_rendered_images(self.output_dir, blender.filename_extension())
+        if frame is None:
+            supervisor.err = utils.BadMessageError("Unable to parse CANCEL RENDER message", message)
+        else:
+            self.tracer.instant("connection", "cancel render", "event", group="worker", supervisor=supervisor.name(), frame=int(frame))
+            self.cancel_tasks(supervisor, int(frame))
+
+    def cancel_tasks(self, supervisor, frame=None):
+        # every task of the supervisor, or only those rendering frame
+        def cancelled(task):
+            return task.owner is supervisor and (frame is None or (task.frame == frame and not task.calibration))
+
+        for task in list(supervisor.queue):
+            if cancelled(task):
+                supervisor.remove_task(task)
+
+        for slot in self.slots:
+            if slot.task and cancelled(slot.task):
+                if slot.task.started:
+                    slot.task.remote_cancelled = True
+                    if frame is not None:
+                        # the supervisor has freed its slot, and may send another frame before this one stops
+                        supervisor.free_slot(slot.task)
+                    slot.cancel()
+                else:
+                    supervisor.remove_task(slot.task)
+                    slot.release()
+
+    def handle_render_complete(self, slot):
+        if slot.task.calibration:
+            self.finish_calibration(slot, True)
+            return
+
+        supervisor = slot.task.owner
+        self.tracer.end(f"slot {slot.index}", "render", result="complete")
+        supervisor.remove_task(slot.task)
+
+        if not slot.task.remote_cancelled:
+            prefix = utils.filename_for_frame(slot.task.frame, slot.task.max_frame, '', supervisor.frame_directory(), supervisor.shard_size())
+            path = slot.output_file or prefix + blender.filename_extension()
+            outputs = self.frame_outputs(supervisor, slot.task.frame, prefix) # also clears the render process's list away
+
+            if supervisor.shared_output() and slot.output_digest:
+                self.deliver_frame(supervisor, slot.task.frame, path, *slot.output_digest)
+            elif supervisor.shared_output():
+                self.hasher.submit(FrameDigest(supervisor, slot.task.frame, path))
+            else:
+                self.store.record_frame(supervisor.job_id, slot.task.frame, path, outputs)
+                supervisor.frames_rendered += 1
+                supervisor.connection.send(armb.new_render_complete_message(slot.task.frame))
+                self.send_preview(supervisor, slot.task.frame, path)
+
+        slot.release()
+
+    def deliver_frame(self, supervisor, frame, path, size, digest, error=None):
+        # the frame is already where the supervisor wants it, so only its size and hash are sent,
+        # and it is not recorded in the store, whose cleanup would delete it
+        if error is not None:
+            print("Unable to read", path, error)
+            supervisor.frames_failed += 1
+            supervisor.connection.send(armb.new_reject_render_message(frame, failed=True))
+            return
+
+        supervisor.frames_rendered += 1
+        supervisor.connection.send(armb.new_render_delivered_message(frame, size, digest, os.path.splitext(path)[1]))
+        self.send_preview(supervisor, frame, path)
+
+    def frame_outputs(self, supervisor, frame, path):
+        # files written for the frame besides the main image, which are uploaded along with it.
+        # A render process lists them beside the frame, rendered to path; the open scene only
+        # describes frames rendered in this window, from the file that is open.
+        outputs = blender.read_output_list(path)
+        if outputs is None and supervisor.project_file in (None, blender.current_file()):
+            outputs = blender.file_output_paths(frame)
+        return outputs or []
+
+    def frame_preview(self, frame, path):
+        return blender.create_preview(path, self.preview_size)
+
+    def send_preview(self, supervisor, frame, path):
+        # sent behind other messages, since nothing waits for it
+        preview = self.frame_preview(frame, path)
+        if preview:
+            supervisor.connection.send(*armb.new_preview_message(frame, ".jpg", preview), bulk=True)
+
+    def handle_render_cancel(self, slot):
+        if slot.task.calibration:
+            self.finish_calibration(slot, False)
+            return
+
+        supervisor = slot.task.owner
+        self.tracer.end(f"slot {slot.index}", "render", result="cancelled")
+
+        if slot.task.remote_cancelled:
+            supervisor.remove_task(slot.task)
+            slot.release()
+        else:
+            slot.task.started = False
+            slot.task.record_failed_attempt()
+            supervisor.task_stopped(slot.task)
+            if slot.task.failed():
+                supervisor.remove_task(slot.task)
+                supervisor.frames_failed += 1
+                supervisor.connection.send(armb.new_reject_render_message(slot.task.frame, failed=True))
+                slot.release()
+
+    def handle_cleanup_message(self, supervisor):
+        self.store.clean(supervisor.job_ids)
@@ -0,0 +1,59 @@
+import json, os, shutil, subprocess, sys, textwrap
+
+# The command a render slot runs renders in a second Blender, which imports this module again
+# by the name it has here. Blender is stood in for by Python with a minimal bpy, under both
+# ways the module is imported: as the add-on's package, and from a checkout by the command line.
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STUB_BPY = textwrap.dedent("""
+    import sys, types
+
+    class Scene:
+        def __init__(self):
+            self.render = types.SimpleNamespace(filepath="")
+            self.use_nodes = False
+            self.node_tree = None
+            self.frame_current = 1
+
+        def frame_set(self, frame):
+            self.frame_current = frame
+
+    def render(**kwargs):
+        with open(context.scene.render.filepath + ".png", "w") as f:
+            f.write(str(context.scene.frame_current))
+        return {'FINISHED'}
+
+    app = types.SimpleNamespace(binary_path=sys.executable, background=True)
+    context = types.SimpleNamespace(scene=Scene())
+    data = types.SimpleNamespace(filepath="")
+    ops = types.SimpleNamespace(render=types.SimpleNamespace(render=render))
+    path = types.SimpleNamespace(abspath=lambda path: path)
+""")
+
+def render_in_child(tmp_path, root, module):
+    stub = tmp_path / "stub"
+    stub.mkdir()
+    (stub / "bpy.py").write_text(STUB_BPY)
+    output = str(tmp_path / "frame")
+
+    # the command, as the slot builds it
+    build = f"import sys, json, importlib; sys.path[:0] = [{str(stub)!r}, {root!r}]; print(json.dumps(importlib.import_module({module!r}).render_process_command(7, {output!r}, None, blend_file='scene.blend')))"
+    built = subprocess.run([ sys.executable, "-c", build ], cwd=tmp_path, capture_output=True, text=True, check=True)
+    command = json.loads(built.stdout.splitlines()[-1])
+    assert command[:3] == [ sys.executable, "--background", "scene.blend" ]
+
+    # what Blender runs, with only bpy importable beforehand
+    script = command[command.index("--python-expr") + 1]
+    result = subprocess.run([ sys.executable, "-c", script ], cwd=tmp_path, env=dict(os.environ, PYTHONPATH=str(stub)), capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert (tmp_path / "frame.png").read_text() == "7"
+
+def test_command_line_layout(tmp_path):
+    render_in_child(tmp_path, REPO, "src.blender.blender")
+
+def test_addon_layout(tmp_path):
+    addons = tmp_path / "addons"
+    shutil.copytree(os.path.join(REPO, "src"), addons / "armb" / "src", ignore=shutil.ignore_patterns("__pycache__"))
+    (addons / "armb" / "__init__.py").write_text("") # the add-on itself needs Blender
+    render_in_child(tmp_path, str(addons), "armb.src.blender.blender")